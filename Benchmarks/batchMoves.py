@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Compares generating a dense toolpath one move at a time (extrudeMove)
+with the batch function (extrudeMoves), and checks that both write
+exactly the same G-code.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import sys, os
+import time
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
+
+
+def makeToolpath(points):
+    """
+    An Nx5 (X, Y, Z, E, F) spiral over a 4in wafer.
+    """
+    theta = np.linspace(0, 200 * np.pi, points)
+    radius = np.linspace(40, 1, points)
+    return np.column_stack(
+        (
+            (marlinPrinter.X_MAX / 2) + radius * np.cos(theta),
+            (marlinPrinter.Y_MAX / 2) + radius * np.sin(theta),
+            np.full(points, 1.5),
+            np.linspace(0, 1, points),
+            np.full(points, 80.0),
+        )
+    )
+
+
+def timeSingleMoves(toolpath):
+    printer = marlinPrinter("single")
+    start = time.perf_counter()
+    for x, y, z, e, f in toolpath.tolist():
+        printer.extrudeMove({"X": x, "Y": y, "Z": z, "E": e, "F": f})
+    generated = time.perf_counter()
+    text = printer.program.render()
+    return generated - start, time.perf_counter() - start, text
+
+
+def timeBatchMoves(toolpath):
+    printer = marlinPrinter("batch")
+    start = time.perf_counter()
+    printer.extrudeMoves(toolpath, axes="XYZEF")
+    generated = time.perf_counter()
+    text = printer.program.render()
+    return generated - start, time.perf_counter() - start, text
+
+
+def main(sizes):
+    print(
+        f"{'points':>9} {'single gen':>11} {'batch gen':>10} {'speedup':>8} "
+        f"{'single total':>13} {'batch total':>12} {'speedup':>8}"
+    )
+    for points in sizes:
+        toolpath = makeToolpath(points)
+        singleGen, singleTotal, singleText = timeSingleMoves(toolpath)
+        batchGen, batchTotal, batchText = timeBatchMoves(toolpath)
+
+        if singleText != batchText:
+            raise Exception("Batch moves did not match single moves!")
+
+        print(
+            f"{points:>9} {singleGen:>10.3f}s {batchGen:>9.3f}s "
+            f"{singleGen / batchGen:>7.0f}x {singleTotal:>12.3f}s "
+            f"{batchTotal:>11.3f}s {singleTotal / batchTotal:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    sizes = [int(float(arg)) for arg in args] if args else [100000, 1000000]
+
+    main(sizes)
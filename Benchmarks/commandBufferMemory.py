@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Measures the memory used per move by marlinPrinter's command buffer,
+compared to keeping the same program as a list of formatted strings.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import sys, os
+import tracemalloc
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
+
+
+def generateMoves(printer, moves):
+    """
+    A dense, scan-like toolpath: small XY steps around a circle
+    with the occasional feedrate change and comment.
+    """
+    for i in range(moves):
+        theta = i * 0.01
+        printer.nonExtrudeMove(
+            {
+                "X": 117.5 + 40 * math.cos(theta),
+                "Y": 117.5 + 40 * math.sin(theta),
+                "F": 80 if i % 2 else 2000,
+            },
+            "ring" if i % 100 == 0 else None,
+        )
+
+
+def measure(moves):
+    """
+    Returns (bytes per move as a buffer, bytes per move as a list of strings).
+    """
+    tracemalloc.start()
+    printer = marlinPrinter("benchmark")
+    generateMoves(printer, moves)
+    bufferBytes = tracemalloc.get_traced_memory()[0]
+
+    asList = list(printer.commands)
+    listBytes = tracemalloc.get_traced_memory()[0] - bufferBytes
+    tracemalloc.stop()
+
+    return bufferBytes / moves, listBytes / moves
+
+
+def main(moves):
+    perMoveBuffer, perMoveList = measure(moves)
+    print(f"Moves:           {moves}")
+    print(f"List of strings: {perMoveList:.1f} bytes/move")
+    print(f"Command buffer:  {perMoveBuffer:.1f} bytes/move")
+    print(f"Reduction:       {perMoveList / perMoveBuffer:.2f}x")
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    moves = int(args[0]) if args else 100000
+
+    main(moves)
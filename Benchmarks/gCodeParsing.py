@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Times reading a large G-code program back in with gCodeParser.py
+(all at once, memory-mapped, in batches, and one command at a time)
+against splitting it line by line in plain Python, and checks that
+the parser reads the same values. The target is 1M lines/s for
+parsing a whole program; each result is marked against it.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys, os
+import tempfile
+import time
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
+from gCodeOptimizer import splitLine, splitProgram
+from gCodeParser import iterBatches, iterCommands, parseProgram, readProgram
+from batchMoves import makeToolpath
+
+TARGET = 1e6  # lines/s
+
+
+def makeProgram(moves):
+    """
+    A dense toolpath of 'moves' extruding moves (two lines each, with
+    the M82 before every move), with a comment on every 100th move.
+    """
+    printer = marlinPrinter("parsing")
+    toolpath = makeToolpath(moves)
+    for start in range(0, moves, 100):
+        x, y, z, e, f = toolpath[start].tolist()
+        coords = {"X": x, "Y": y, "Z": z, "E": e, "F": f}
+        printer.extrudeMove(coords, f"Move {start}")
+        printer.extrudeMoves(toolpath[start + 1 : start + 100], axes="XYZEF")
+    return printer.program.render()
+
+
+def splitLines(data):
+    """
+    The plain Python way: split every line (see gCodeOptimizer.py).
+    """
+    return [splitLine(line) for line in splitProgram(data.decode())]
+
+
+def countCommands(data):
+    return sum(1 for _ in iterCommands(data))
+
+
+def countBatches(data):
+    return sum(len(batch) for batch in iterBatches(data))
+
+
+def timeIt(function, data):
+    start = time.perf_counter()
+    result = function(data)
+    return time.perf_counter() - start, result
+
+
+def checkValues(split, program):
+    """
+    The parser has to read exactly what float() does.
+    """
+    for i, (word, params, code) in enumerate(split):
+        for letter, value in (params or {}).items():
+            if program.params[letter][i] != value:
+                raise Exception(
+                    f"Line {i + 1}: {letter} read as "
+                    f"{program.params[letter][i]}, not {value}!"
+                )
+
+
+def main(sizes):
+    print(f"Target: {TARGET:,.0f} lines/s")
+    print(
+        f"{'lines':>9} {'MB':>6} {'method':<18} {'time':>8} {'lines/s':>12} "
+        f"{'target':>7}"
+    )
+    for moves in sizes:
+        text = makeProgram(moves)
+        data = text.encode()
+
+        with tempfile.NamedTemporaryFile(suffix=".gcode", delete=False) as file:
+            file.write(data)
+        try:
+            mapped = readProgram(file.name)
+            methods = [
+                ("python splitLine", splitLines, data),
+                ("parseProgram", parseProgram, data),
+                ("parseProgram mmap", parseProgram, mapped),
+                ("iterBatches mmap", countBatches, mapped),
+                ("iterCommands", countCommands, data),
+            ]
+            results = {}
+            for name, function, source in methods:
+                seconds, results[name] = timeIt(function, source)
+                count = text.count("\n")
+                rate = count / seconds
+                meets = "met" if rate >= TARGET else f"{rate / TARGET:.0%}"
+                print(
+                    f"{count:>9} {len(data) / 1e6:>6.1f} {name:<18} "
+                    f"{seconds:>7.3f}s {rate:>12,.0f} {meets:>7}"
+                )
+            mapped.close()
+        finally:
+            os.remove(file.name)
+
+        checkValues(results["python splitLine"], results["parseProgram"])
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    sizes = [int(float(arg)) for arg in args] if args else [500000]
+
+    main(sizes)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+The benchmark suite for making G-code: moves per second through the
+single move functions, a full doWaferScan for 2, 4 and 6 inch wafers,
+writeToFile throughput, and peak memory for a program of a million
+commands. Every run is added to a history file (one JSON object per
+line) and compared with the last run on the same computer, so a change
+that slows generation down shows up right away. Timings are the median
+of several runs, and a change only counts as a regression if it is
+bigger than both the tolerance and the run-to-run noise of the two runs.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python generationSuite.py [--quick] [--only NAME ...] [--history FILE]
+        [--tolerance 0.1] [--check]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import numpy as np
+import platform
+import subprocess
+import sys, os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
+from batchMoves import makeToolpath
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+# Sizes for a full run, and for a --quick one
+SIZES = {
+    "moves": (200000, 20000),
+    "scans": (20, 3),
+    "write_commands": (1000000, 100000),
+    "memory_commands": (1000000, 100000),
+}
+
+WAFERS = {"2in": 50.8, "4in": 100.0, "6in": 150.0}
+
+REPEATS = 7  # Runs per timing; the median is kept
+NOISE_MARGIN = 3  # How many times the combined noise a change has to beat
+
+BENCHMARKS = []
+
+
+def benchmark(unit, higher_is_better=True):
+    """
+    Adds a function to the suite. It's called with the sizes to use and
+    returns {result name: (value, noise)}, every value in 'unit' and its
+    noise as a fraction of it (see medianOf).
+    """
+
+    def register(func):
+        BENCHMARKS.append((func.__name__, unit, higher_is_better, func))
+        return func
+
+    return register
+
+
+def medianOf(repeats, func):
+    """
+    Runs func() 'repeats' times. Returns the median time in seconds and
+    the noise: the median absolute deviation of the times, as a fraction
+    of the median. Unlike the fastest run, the median doesn't move much
+    when one run happens to be lucky or unlucky.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return median, float(np.median(np.abs(np.subtract(times, median)))) / median
+
+
+def rate(work, timing):
+    """
+    (work per second, noise) for a medianOf() timing of 'work'.
+    """
+    seconds, noise = timing
+    return work / seconds, noise
+
+
+def _circlePoints(moves):
+    return [
+        (117.5 + 40 * math.cos(i * 0.01), 117.5 + 40 * math.sin(i * 0.01))
+        for i in range(moves)
+    ]
+
+
+@benchmark("moves/s")
+def singleMoves(sizes):
+    moves = sizes["moves"]
+    points = _circlePoints(moves)
+
+    def travel():
+        printer = marlinPrinter("benchmark")
+        for x, y in points:
+            printer.nonExtrudeMove({"X": x, "Y": y, "F": 2000})
+
+    def extrude():
+        printer = marlinPrinter("benchmark")
+        for i, (x, y) in enumerate(points):
+            printer.extrudeMove({"X": x, "Y": y, "E": i / moves, "F": 80})
+
+    return {
+        "nonExtrudeMove": rate(moves, medianOf(REPEATS, travel)),
+        "extrudeMove": rate(moves, medianOf(REPEATS, extrude)),
+    }
+
+
+@benchmark("scans/s")
+def waferScans(sizes):
+    """
+    A whole doWaferScan, on a new scanner each time (the scan itself
+    isn't a cached fragment, so every one is made from scratch).
+    """
+    results = {}
+    for name, diameter in WAFERS.items():
+
+        def scan():
+            scanner = VPDScanner("benchmark", sample_volume=0.05)
+            scanner.WAFER_DIAM = diameter
+            with contextlib.redirect_stdout(io.StringIO()):
+                scanner.doWaferScan()
+
+        results[f"doWaferScan {name}"] = rate(
+            sizes["scans"],
+            medianOf(REPEATS, lambda: [scan() for _ in range(sizes["scans"])]),
+        )
+    return results
+
+
+@benchmark("MB/s")
+def writing(sizes):
+    printer = marlinPrinter("benchmark")
+    printer.extrudeMoves(makeToolpath(sizes["write_commands"] // 2), axes="XYZEF")
+
+    with tempfile.TemporaryDirectory() as directory:
+        printer.filename = os.path.join(directory, "benchmark.gcode")
+        timing = medianOf(REPEATS, printer.writeToFile)
+        megabytes = os.path.getsize(printer.gcodeFilename()) / 1e6
+    return {"writeToFile": rate(megabytes, timing)}
+
+
+@benchmark("MB", higher_is_better=False)
+def memory(sizes):
+    """
+    Peak memory while making a program of memory_commands moves and
+    writing it out.
+    """
+    toolpath = makeToolpath(sizes["memory_commands"])[:, [0, 1, 2, 4]]
+
+    tracemalloc.start()
+    printer = marlinPrinter("benchmark")
+    printer.travelMoves(toolpath)
+    built = tracemalloc.get_traced_memory()[1]
+
+    tracemalloc.reset_peak()
+    with tempfile.TemporaryDirectory() as directory:
+        printer.filename = os.path.join(directory, "benchmark.gcode")
+        printer.writeToFile()
+    written = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Peaks are the same on every run
+    return {"peak making": (built / 1e6, 0.0), "peak writing": (written / 1e6, 0.0)}
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runSuite(quick=False, only=None):
+    """
+    Runs the suite (or the benchmarks named in 'only') and returns the
+    record added to the history: when, where, and every result as
+    {"name", "unit", "higher_is_better", "value", "noise"}.
+    """
+    sizes = {name: size[1 if quick else 0] for name, size in SIZES.items()}
+    results = []
+    for name, unit, higher, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for result, (value, noise) in func(sizes).items():
+            results.append(
+                {
+                    "name": result,
+                    "unit": unit,
+                    "higher_is_better": higher,
+                    "value": value,
+                    "noise": noise,
+                }
+            )
+            print(
+                f"{result:<24} {value:>14.1f} {unit:<8} ±{100 * noise:.1f}%",
+                flush=True,
+            )
+
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "quick": quick,
+        "sizes": sizes,
+        "results": results,
+    }
+
+
+def readHistory(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def compare(record, history, tolerance=0.1):
+    """
+    Compares each result with the last run in 'history' on the same
+    computer, with the same sizes. Returns the lines to print and the
+    results that got worse by more than 'tolerance' (a fraction) and by
+    more than NOISE_MARGIN times the noise of the two runs together.
+    Runs recorded before the noise was kept count as noiseless.
+    """
+    previous = None
+    for old in reversed(history):
+        if old["host"] == record["host"] and old["sizes"] == record["sizes"]:
+            previous = old
+            break
+    if previous is None:
+        return ["No earlier run on this computer to compare with."], []
+
+    before = {result["name"]: result for result in previous["results"]}
+    lines = [f"Compared with {previous['commit'] or 'a run'} from {previous['time']}:"]
+    regressions = []
+    for result in record["results"]:
+        old = before.get(result["name"])
+        if not old or not old["value"]:
+            continue
+        change = result["value"] / old["value"] - 1
+        worse = -change if result["higher_is_better"] else change
+        noise = math.hypot(old.get("noise", 0.0), result.get("noise", 0.0))
+        threshold = max(tolerance, NOISE_MARGIN * noise)
+        flag = ""
+        if worse > threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(result["name"])
+        lines.append(
+            f"    {result['name']:<24} {100 * change:>+7.1f}%"
+            f"  (limit {100 * threshold:.1f}%){flag}"
+        )
+    return lines, regressions
+
+
+def main(quick, only, history_file, tolerance, check):
+    history = readHistory(history_file)
+    record = runSuite(quick, only)
+
+    lines, regressions = compare(record, history, tolerance)
+    print("\n".join(lines))
+
+    with open(history_file, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+    if check and regressions:
+        sys.exit(f"{len(regressions)} result(s) regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark G-code generation.")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes.")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=[name for name, *_ in BENCHMARKS],
+        help="Run only these benchmarks.",
+    )
+    parser.add_argument("--history", default=HISTORY)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="How much worse (a fraction) counts as a regression, at least.",
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="Exit with an error on a regression."
+    )
+    args = parser.parse_args()
+
+    main(args.quick, args.only, args.history, args.tolerance, args.check)
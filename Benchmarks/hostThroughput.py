@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Streams programs through printHost.py to the simulated printer in
+fakeMarlin.py, and compares how long the printer took with how long
+motionEstimator.py says the moves take, along with how often the
+planner ran dry. Checks that the printer got every line, in order.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python hostThroughput.py [time_scale] [resend_rate]
+"""
+
+import asyncio
+import sys, os
+import time
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
+from fakeMarlin import fakeMarlin
+from motionEstimator import estimateTime
+from printHost import printHost, stripLine
+from batchMoves import makeToolpath
+
+
+def waferScan(mode):
+    scanner = VPDScanner(None, sample_volume=0.05)
+    scanner.SCAN_MODE = mode
+    scanner.startGCode()
+    scanner.loadSyringe()
+    scanner.doWaferScan()
+    scanner.unloadSyringe()
+    scanner.endGCode()
+    return list(scanner.program.lines())
+
+
+def denseMoves(moves):
+    """
+    Short extruding moves at 50 mm/s, much more than a scan asks of the host.
+    """
+    printer = marlinPrinter("dense")
+    printer.program.append("M302 S0")
+    toolpath = makeToolpath(moves)
+    toolpath[:, 4] = 3000
+    printer.extrudeMoves(toolpath, axes="XYZEF")
+    return list(printer.program.lines())
+
+
+def checkLines(lines, printer):
+    """
+    The printer has to have run every line of the program, in order.
+    """
+    sent = [stripLine(line) for line in lines if stripLine(line)]
+    taken = printer.commands[1 : len(sent) + 1]  # After the M110 from connect()
+    for i, (code, got) in enumerate(zip(sent, taken)):
+        if code != got:
+            raise Exception(f"Command {i + 1}: printer ran {got!r}, not {code!r}!")
+    if len(taken) != len(sent):
+        raise Exception(f"Printer ran {len(taken)} commands, not {len(sent)}!")
+
+
+async def run(lines, time_scale, resend_rate):
+    async with fakeMarlin(
+        time_scale=time_scale, resend_rate=resend_rate, user_wait=0.01, seed=0
+    ) as printer:
+        host = await printHost.open(printer.port)
+        start = time.perf_counter()
+        stats = await host.stream(lines)
+        await host.command("M400")
+        seconds = (time.perf_counter() - start) / time_scale
+        await host.close()
+    checkLines(lines, printer)
+    return seconds, stats, printer.stats
+
+
+def main(time_scale, resend_rate):
+    programs = [
+        ("concentric scan", waferScan("concentric")),
+        ("spiral scan", waferScan("spiral")),
+        ("dense moves", denseMoves(5000)),
+    ]
+    print(
+        f"{'program':<16} {'lines':>6} {'estimate':>9} {'ran':>9} {'lines/s':>8} "
+        f"{'resends':>7} {'stalls':>6} {'stalled':>8}"
+    )
+    for name, lines in programs:
+        estimate = estimateTime("\n".join(lines)).total
+        seconds, stats, printed = asyncio.run(run(lines, time_scale, resend_rate))
+        print(
+            f"{name:<16} {stats.lines:>6} {estimate:>8.1f}s {seconds:>8.1f}s "
+            f"{stats.lines / seconds:>8.1f} {stats.resends:>7} "
+            f"{printed.stalls:>6} {printed.stall_seconds:>7.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    time_scale = float(args[0]) if args else 0.05
+    resend_rate = float(args[1]) if len(args) > 1 else 0.0
+
+    main(time_scale, resend_rate)
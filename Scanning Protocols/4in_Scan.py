@@ -49,6 +49,12 @@ def changeDefaultParams(classInstance):
     # PROCESS VALUES (in mm unless otherwuise noted)
     # VPDScanner.TRAVEL_FEEDRATE = 2000  # Standard is 3000
     # VPDScanner.SCANNING_MOVE_FEEDRATE = 80  # Adjust as needed to maintain hold of drop
+    # VPDScanner.RING_FEEDRATES = False  # Per ring feedrates from the limits below
+    # VPDScanner.DROPLET_MAX_SPEED = 80  # mm/min (measure before raising)
+    # VPDScanner.DROPLET_MAX_ACCELERATION = 0.5  # mm/s^2 (centripetal)
+    # VPDScanner.PLAN_RINGS = False  # Space the rings with planRingRadii
+    # VPDScanner.RING_OVERLAP = 0.0  # Fraction of the droplet diameter
+    # VPDScanner.CENTER_GAP = 0  # Radius of the center left unscanned
     # VPDScanner.EXTRUSION_MOTOR_FEEDRATE = 6
 
     # VPDScanner.SCAN_HEIGHT = 1.5
@@ -62,6 +68,7 @@ def changeDefaultParams(classInstance):
     # Wafer specific global vars (in mm unless otherwuise noted)
     # VPDScanner.WAFER_DIAM = 100  # 4in wafer
     # VPDScanner.EDGE_GAP = 10.0  # How far in from the wafer edge to scan
+    # VPDScanner.SCAN_MODE = "concentric"  # or "spiral"
 
     # VPDScanner.RACK_TEETH_PER_CM = 3.183
     # VPDScanner.GEAR_TEETH = 16
@@ -90,6 +97,24 @@ def main(filename):
     scanner.writeToFile()
 
 
+def compare():
+    """
+    Prints the scanned area and estimated scan time with planned rings,
+    per ring feedrates and the spiral scan, next to the current settings.
+    """
+    scanner = VPDScanner(None, sample_volume=0.05)
+    changeDefaultParams(scanner)
+    scanner.compareScans(
+        {
+            "current settings": {},
+            "planned rings": {"PLAN_RINGS": True},
+            "ring feedrates": {"RING_FEEDRATES": True},
+            "spiral": {"SCAN_MODE": "spiral"},
+            "spiral + ring feedrates": {"SCAN_MODE": "spiral", "RING_FEEDRATES": True},
+        }
+    )
+
+
 if __name__ == "__main__":
     """
     This is executed when run from the command line.
@@ -97,6 +122,8 @@ if __name__ == "__main__":
     """
     args = sys.argv[1:]
 
-    filename = args[0]
-
-    main(filename)
+    if args[0] == "--compare":
+        compare()
+    else:
+        filename = args[0]
+        main(filename)
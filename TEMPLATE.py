@@ -66,6 +66,7 @@ def changeDefaultParams(classInstance):
     # # WAFER VARIABLES
     # VPDScanner.WAFER_DIAM = 100.0  # 100mm = 4in wafer
     # VPDScanner.EDGE_GAP = 10  # How far in from the wafer edge to scan
+    # VPDScanner.SCAN_MODE = "concentric"  # or "spiral"
     # VPDScanner.DROPLET_DIAMETER = 4  # mm
 
     # # SCAN HEAD VARIABLES
@@ -103,8 +104,9 @@ if __name__ == "__main__":
     This is executed when run from the command line.
     Parses command line args.
     """
-    args = sys.argv[1:]
+    args, profile = profileFlag(sys.argv[1:])
 
     filename = args[0]
 
-    main(filename)
+    with profileGeneration(profile):
+        main(filename)
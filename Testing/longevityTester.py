@@ -1,41 +1,57 @@
 #!/usr/bin/env python3
 """
 Take N lines and repeat them n times, counting the number of repeats in the gcode
+
+With --markers the lines are written once inside an M808 loop instead
+(Marlin built with GCODE_REPEAT_MARKERS, printing from the SD card), so
+the file stays the size of one cycle however many repeats there are.
+
+Usage (from the command line):
+    python longevityTester.py filename.gcode repeats [--markers] [--profile]
 """
 
 __author__ = "Your Name"
 __version__ = "0.1.0"
 __license__ = "MIT"
 
-import sys
+import sys, os
 
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import *
 
-def main(filename, repeats):
+
+def main(filename, repeats, markers=False):
     """Main entry point of the app"""
 
     if ".gcode" not in filename:
         filename += ".gcode"
 
-    ogCommandsList = []
     with open(filename, "r") as file:
-        ogLines = file.readlines()
-        print(ogLines)
-        for line in ogLines:
-            ogCommandsList.append(line.strip())
+        ogCommandsList = [line.strip() for line in file]
 
+    # Copies are streamed to the file as they're made, not held in memory
     with open(filename, "w") as file:
-        for repetition in range(repeats):
-            for ogCommand in ogCommandsList:
-                # print(ogCommand)
-                file.write(ogCommand + "\n")
-            file.write(f"; {repetition + 1} repeat \n")
+        printer = marlinPrinter(filename, sink=file)
+        printer.REPEAT_MARKERS = markers
+        with printer.repeat(repeats, label="Repeat"):
+            printer.program.extend(ogCommandsList)
+        printer.writeToFile()
 
 
 if __name__ == "__main__":
-    """This is executed when run from the command line"""
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args, profile = profileFlag(sys.argv[1:])
 
-    args = sys.argv[1:]
+    markers = "--markers" in args
+    if markers:
+        args.remove("--markers")
 
     filename = args[0]
     repeats = int(args[1])
-    main(filename, repeats)
+
+    with profileGeneration(profile):
+        main(filename, repeats, markers)
@@ -25,6 +25,7 @@ Stanford Nanofabrication Facility 2023
 
 import numpy as np
 import sys, os
+from dataclasses import replace
 
 # Allow imports from parent directory
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -36,62 +37,80 @@ def changeDefaultParams(classInstance):
     If you would like to change any of the defualt parameters,
     you may do so by uncommenting and changing these lines. Otherwise,
     they will remain as defuault and configured for the Ender 3.
+    The changes only apply to classInstance, not to the VPDScanner class.
     """
     ###########################################
     # ALL VALUES IN MM UNLESS OTHERWISE NOTED #
     ###########################################
 
     ### ENDER 3 CONSTRAINTS ###
-    # marlinPrinter.X_MAX = 220
-    # marlinPrinter.Y_MAX = 220
-    # marlinPrinter.Z_MAX = 250
+    machine = replace(
+        classInstance.machineProfile,
+        # X_MAX=220,
+        # Y_MAX=220,
+        # Z_MAX=250,
+    )
     ###########################
 
-    # PROCESS VALUES (in mm unless otherwuise noted)
-    VPDScanner.TRAVEL_FEEDRATE = 2000  # Standard is 3000
-    VPDScanner.SCANNING_MOVE_FEEDRATE = 90  # Adjust as needed to maintain hold of drop
-    VPDScanner.EXTRUSION_MOTOR_FEEDRATE = 10
+    scan = replace(
+        classInstance.scanProfile,
+        # PROCESS VALUES (in mm unless otherwuise noted)
+        TRAVEL_FEEDRATE=2000,  # Standard is 3000
+        SCANNING_MOVE_FEEDRATE=90,  # Adjust as needed to maintain hold of drop
+        EXTRUSION_MOTOR_FEEDRATE=10,
+        # SCAN_HEIGHT=3.0,
+        # TRAVEL_HEIGHT=40, # Make sure this is well above the highest point (cuevette lid)
+        DROPLET_DIAMETER=40,  # mm
+        # CUEVETTE_X=190.5,
+        # CUEVETTE_Y=47.5,
+        # CUEVETTE_Z=4,
+        # Wafer specific global vars (in mm unless otherwuise noted)
+        WAFER_DIAM=100,  # 4in wafer
+        EDGE_GAP=10,  # How far in from the wafer edge to scan
+        # SCAN_MODE="spiral",  # or "concentric"
+        # RACK_TEETH_PER_CM=3.183,
+        # GEAR_TEETH=16,
+        RACK_TEETH_PER_CM=6.36619,
+        GEAR_TEETH=30,
+        SYRINGE_CAPACITY=1.0,
+        SYRINGE_LENGTH=58.0,
+    )
+
+    classInstance.applyProfile(machine, scan)
 
-    # VPDScanner.SCAN_HEIGHT = 3.0
-    # VPDScanner.TRAVEL_HEIGHT = 40 # Make sure this is well above the highest point (cuevette lid)
-    VPDScanner.DROPLET_DIAMETER = 40  # mm
 
-    # VPDScanner.CUEVETTE_X = 190.5
-    # VPDScanner.CUEVETTE_Y = 47.5
-    # VPDScanner.CUEVETTE_Z = 4
-
-    # Wafer specific global vars (in mm unless otherwuise noted)
-    VPDScanner.WAFER_DIAM = 100  # 4in wafer
-    VPDScanner.EDGE_GAP = 10  # How far in from the wafer edge to scan
-
-    # VPDScanner.RACK_TEETH_PER_CM = 3.183
-    # VPDScanner.GEAR_TEETH = 16
-    VPDScanner.RACK_TEETH_PER_CM = 6.36619
-    VPDScanner.GEAR_TEETH = 30
+def main(filename):
+    """
+    Initializes, calls, and executes G-Code commands.
+    Commands are streamed straight to the file as they are made,
+    so the number of sweep cycles doesn't affect memory use.
+    """
+    if ".gcode" not in filename:
+        filename += ".gcode"
 
-    VPDScanner.SYRINGE_CAPACITY = 1.0
-    VPDScanner.SYRINGE_LENGTH = 58.0
+    with open(filename, "w") as file:
+        scanner = VPDScanner(filename, sample_volume=0.05, sink=file)
+        runSweep(scanner)
 
 
-def main(filename):
+def runSweep(scanner):
     """
-    Initializes, calls, and executes G-Code commands.
+    Scans the wafer once at each height of the sweep.
     """
-    scanner = VPDScanner(filename, sample_volume=0.05)
     changeDefaultParams(scanner)
 
     start_height = 1.0
     end_height = 2.0
     increment = 0.2
 
-    VPDScanner.SCAN_HEIGHT = start_height
+    scanner.applyProfile(replace(scanner.scanProfile, SCAN_HEIGHT=start_height))
 
     num_cycles = (end_height - start_height) // increment + 1
     print(f"The loop will run {num_cycles} cycles.")
 
     scanner.startGCode()
     for height in np.arange(start_height, end_height, increment):
-        VPDScanner.SCAN_HEIGHT = height
+        scanner.applyProfile(replace(scanner.scanProfile, SCAN_HEIGHT=height))
 
         scanner.loadSyringe()
         scanner.doWaferScan()
@@ -106,8 +125,9 @@ if __name__ == "__main__":
     This is executed when run from the command line.
     Parses command line args.
     """
-    args = sys.argv[1:]
+    args, profile = profileFlag(sys.argv[1:])
 
     filename = args[0]
 
-    main(filename)
+    with profileGeneration(profile):
+        main(filename)
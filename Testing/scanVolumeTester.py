@@ -121,8 +121,9 @@ if __name__ == "__main__":
     This is executed when run from the command line.
     Parses command line args.
     """
-    args = sys.argv[1:]
+    args, profile = profileFlag(sys.argv[1:])
 
     filename = args[0]
 
-    main(filename)
+    with profileGeneration(profile):
+        main(filename)
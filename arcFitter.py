@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+arcFitter.py does the opposite of arcLinearizer.py: it finds chains of
+short G0/G1 moves whose points lie on a circle (to within 'tolerance'
+mm) and replaces each chain with one G2/G3 arc. Dense toolpaths (from
+the batch move functions, or sliced in Cura) become many times smaller,
+both as a file and as lines sent to the printer, and Marlin's planner
+gets a few long moves instead of a flood of tiny ones.
+
+An arc only replaces moves that are all the same command, at the same
+feedrate and height, in the same positioning mode, and that extrude
+(or not) evenly along the way. It starts and ends exactly where the
+chain did, and neither the old points nor the middles of the old
+segments are further than 'tolerance' from it.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python arcFitter.py input.gcode [output.gcode] [tolerance]
+"""
+
+import sys
+
+import numpy as np
+
+from gCodeOptimizer import splitProgram
+from gCodeParser import (
+    AXES,
+    G0,
+    G1,
+    G90,
+    G91,
+    M82,
+    M83,
+    forwardFill,
+    parseProgram,
+    resolvePositions,
+)
+
+TOLERANCE = 0.01  # mm
+MAX_RADIUS = 1000.0  # mm, anything flatter is left as straight moves
+MIN_SEGMENTS = 3  # Fewest moves worth replacing with an arc
+E_TOLERANCE = 0.001  # mm the extruder may get ahead of or behind an arc
+
+
+class arcFitter:
+    """
+    Replaces chains of moves along a circle with G2/G3 arcs, and keeps
+    count of what it did for report(). Works on a whole program at once.
+    """
+
+    def __init__(self, tolerance=TOLERANCE, max_radius=MAX_RADIUS):
+        self.tolerance = tolerance
+        self.max_radius = max_radius
+
+        self.arcs = 0
+        self.moves_replaced = 0
+        self.max_deviation = 0.0
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def fitText(self, text):
+        """
+        Fit arcs to a program (newline-terminated lines), returning the
+        new program.
+        """
+        program = parseProgram(text)
+        words, params = program.words, program.params
+        positions, feedrate = resolvePositions(words, params)
+        lines = splitProgram(text)
+        self.lines_in += len(lines)
+        self.bytes_in += len(text.encode())
+
+        modeSet = np.isin(words, (G90, G91))
+        relative = forwardFill(modeSet, words == G91, False)
+        modeSetE = modeSet | np.isin(words, (M82, M83))
+        relativeE = forwardFill(modeSetE, (words == G91) | (words == M83), False)
+        points = np.stack([positions[a] for a in AXES], axis=1)
+
+        replaced = {}  # First line of an arc: (last line, the arc)
+        for rows in self._chains(program, points, feedrate, relative, relativeE):
+            path = points[rows]
+            i = 0
+            while i + MIN_SEGMENTS < len(path):
+                end, fit = self._longestArc(path, i)
+                if fit is None:
+                    i += 1
+                    continue
+                line = rows[i + 1]
+                arc = self._arc(
+                    lines[line],
+                    path[i],
+                    path[end],
+                    fit,
+                    params,
+                    line,
+                    relative[line],
+                    relativeE[line],
+                )
+                replaced[line] = (rows[end], arc)
+                self.arcs += 1
+                self.moves_replaced += end - i
+                self.max_deviation = max(self.max_deviation, fit[3])
+                i = end
+
+        out = []
+        i = 0
+        while i < len(lines):
+            if i in replaced:
+                i, arc = replaced[i]
+                out.append(arc)
+            else:
+                out.append(lines[i])
+            i += 1
+
+        fitted = "".join([f"{line}\n" for line in out])
+        self.lines_out += len(out)
+        self.bytes_out += len(fitted.encode())
+        return fitted
+
+    def _chains(self, program, points, feedrate, relative, relativeE):
+        """
+        The lines of every run of at least MIN_SEGMENTS moves that could
+        be one arc (the same G0 or G1, feedrate, height and modes, XY
+        moves with only X, Y, Z, E and F, and no comment after the first
+        move), each run starting with the line before its first move.
+        Mode changes to the mode the printer is already in (like the M82
+        before every extrudeMove) don't break a run, and go with it.
+        """
+        words, params = program.words, program.params
+
+        modes = np.isin(words, (G90, G91, M82, M83))
+        sameMode = np.zeros(len(words), dtype=bool)
+        sameMode[1:] = (relative[1:] == relative[:-1]) & (
+            relativeE[1:] == relativeE[:-1]
+        )
+        kept = np.flatnonzero(~(modes & sameMode))
+        words, points = words[kept], points[kept]
+        feedrate, relative = feedrate[kept], relative[kept]
+        relativeE = relativeE[kept]
+
+        if not len(kept):
+            return
+        given = {k: ~np.isnan(v[kept]) for k, v in params.items()}
+        nothing = np.zeros(len(kept), dtype=bool)
+
+        plain = ~program.invalid[kept]
+        for letter in given.keys() - set("XYZEF"):
+            plain &= ~given[letter]
+        moves = (
+            np.isin(words, (G0, G1))
+            & plain
+            & (given.get("X", nothing) | given.get("Y", nothing))
+        )
+        moves[0] = False  # Needs a line before it to start from
+
+        hasE = given.get("E", nothing)
+        same = np.zeros(len(words), dtype=bool)
+        same[1:] = (
+            moves[:-1]
+            & (words[1:] == words[:-1])
+            & ((feedrate[1:] == feedrate[:-1]) | np.isnan(feedrate[1:] - feedrate[:-1]))
+            & (points[1:, 2] == points[:-1, 2])
+            & (relative[1:] == relative[:-1])
+            & (relativeE[1:] == relativeE[:-1])
+            & (hasE[1:] == hasE[:-1])
+            & (program.comment_starts[kept][1:] < 0)
+        )
+        chain = moves & same
+        starts = np.flatnonzero(moves & ~chain)
+        ends = np.flatnonzero(moves & ~np.append(chain[1:], False))
+        for first, last in zip(starts.tolist(), ends.tolist()):
+            if last - first + 1 >= MIN_SEGMENTS:
+                yield kept[first - 1 : last + 1]
+
+    def _longestArc(self, path, i):
+        """
+        The furthest point along 'path' (from point i) that one arc can
+        reach, and the fit from _fit(), or (i, None) if not even
+        MIN_SEGMENTS moves fit. Doubles the arc until it stops fitting,
+        then narrows it down.
+        """
+        best, fit = i, None
+        step = MIN_SEGMENTS
+        while i + step < len(path):
+            trial = self._fit(path[i : i + step + 1])
+            if trial is None:
+                break
+            best, fit = i + step, trial
+            step *= 2
+        if fit is None:
+            return i, None
+
+        low, high = best, min(i + step, len(path))  # high doesn't fit
+        while high - low > 1:
+            middle = (low + high) // 2
+            trial = self._fit(path[i : middle + 1])
+            if trial is None:
+                high = middle
+            else:
+                low, best, fit = middle, middle, trial
+        return best, fit
+
+    def _fit(self, path):
+        """
+        The arc through the first, middle and last of the (N, 4) points,
+        if it runs through all of them: (center, radius, sweep, deviation)
+        with the sweep in radians, positive counterclockwise. None if the
+        points stray too far, turn both ways or go all the way round, or
+        if extruding doesn't keep up evenly.
+        """
+        xy = path[:, :2]
+        a, b, c = xy[0], xy[len(xy) // 2], xy[-1]
+        ab, ac = b - a, c - a
+        cross = ab[0] * ac[1] - ab[1] * ac[0]
+        if abs(cross) < 1e-12:
+            return None
+        # Circumcenter of a, b and c
+        center = a + np.array(
+            [
+                ac[1] * (ab @ ab) - ab[1] * (ac @ ac),
+                ab[0] * (ac @ ac) - ac[0] * (ab @ ab),
+            ]
+        ) / (2 * cross)
+        radius = np.hypot(*(a - center))
+        if radius > self.max_radius:
+            return None
+
+        spokes = xy - center
+        middles = (spokes[1:] + spokes[:-1]) / 2
+        deviation = max(
+            np.abs(np.hypot(*spokes.T) - radius).max(),
+            np.abs(np.hypot(*middles.T) - radius).max(),
+        )
+        if deviation > self.tolerance:
+            return None
+
+        turns = np.arctan2(
+            spokes[:-1, 0] * spokes[1:, 1] - spokes[:-1, 1] * spokes[1:, 0],
+            (spokes[:-1] * spokes[1:]).sum(axis=1),
+        )
+        if not (np.all(turns > 0) or np.all(turns < 0)):
+            return None
+        sweep = turns.sum()
+        if abs(sweep) >= 2 * np.pi:
+            return None
+
+        extruded = path[:, 3] - path[0, 3]
+        if extruded[-1]:
+            lengths = np.cumsum(np.hypot(*np.diff(xy, axis=0).T))
+            even = extruded[-1] * lengths / lengths[-1]
+            if np.abs(extruded[1:] - even).max() > E_TOLERANCE:
+                return None
+
+        return center, radius, sweep, float(deviation)
+
+    @staticmethod
+    def _arc(source, start, end, fit, params, line, relative, relativeE):
+        """
+        The G2/G3 line for a fitted arc, in the positioning mode of the
+        moves it replaces, with the feedrate and comment of the first.
+        """
+        center, _, sweep, _ = fit
+        x, y = end[:2] - start[:2] if relative else end[:2]
+        i, j = center - start[:2]
+        arc = f"{'G3' if sweep > 0 else 'G2'} X{x:.4f} Y{y:.4f} I{i:.4f} J{j:.4f}"
+        if "E" in params and not np.isnan(params["E"][line]):
+            e = end[3] - start[3] if relativeE else end[3]
+            arc += f" E{e:.4f}"
+        if "F" in params and not np.isnan(params["F"][line]):
+            arc += f" F{params['F'][line]:g}"
+        if ";" in source:
+            arc += " ;" + source.split(";", 1)[1]
+        return arc
+
+    def report(self):
+        if not self.arcs:
+            return f"No arcs found in {self.lines_in} lines."
+        return (
+            f"Replaced {self.moves_replaced} moves with {self.arcs} arcs: "
+            f"{self.lines_in} lines to {self.lines_out} "
+            f"({self.lines_in / self.lines_out:.1f}x), {self.bytes_in} bytes to "
+            f"{self.bytes_out} ({self.bytes_in / self.bytes_out:.1f}x). "
+            f"Arcs stray at most {self.max_deviation:.4f} mm from the moves."
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    source = args[0]
+    destination = args[1] if len(args) > 1 else source
+    tolerance = float(args[2]) if len(args) > 2 else TOLERANCE
+
+    with open(source) as file:
+        text = file.read()
+
+    fitter = arcFitter(tolerance)
+    text = fitter.fitText(text)
+    with open(destination, "w") as file:
+        file.write(text)
+    print(fitter.report())
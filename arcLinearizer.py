@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+arcLinearizer.py rewrites G2/G3 arcs as G1 chords, for printers whose
+firmware is built without ARC_SUPPORT (which Marlin leaves out on small
+boards). Each chord strays at most 'tolerance' mm from the true arc,
+so small rings get short chords and large ones long chords, but none
+is shorter than the head covers in 'min_segment_time' at the arc's
+feedrate: Marlin slows down moves shorter than that (MIN_SEGMENT_TIME)
+rather than let its planner run dry. All the chords of a program (or
+of a streamed chunk) are worked out at once with NumPy.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python arcLinearizer.py input.gcode [output.gcode] [tolerance]
+"""
+
+import sys
+
+import numpy as np
+
+from gCodeOptimizer import splitProgram
+from gCodeParser import (
+    AXES,
+    G2,
+    G3,
+    G90,
+    G91,
+    M82,
+    M83,
+    forwardFill,
+    parseProgram,
+    resolvePositions,
+)
+from motionEstimator import PlannerProfile, arcGeometry, expandSegments
+
+TOLERANCE = 0.01  # mm
+MIN_SEGMENT_TIME = 0.02  # s, Marlin's DEFAULT_MINSEGMENTTIME
+
+
+class arcLinearizer:
+    """
+    Turns the arcs in a program into G1 chords and leaves every other
+    line as it is. Like modalOptimizer, it keeps the printer's state
+    (position, positioning modes, feedrate) between calls, so a program
+    can be fed to it in chunks of whole lines (see writer()). Chords are
+    written in the positioning mode the arc was in.
+    """
+
+    def __init__(
+        self, tolerance=TOLERANCE, min_segment_time=MIN_SEGMENT_TIME, profile=None
+    ):
+        self.tolerance = tolerance
+        self.min_segment_time = min_segment_time
+        self.profile = profile or PlannerProfile()
+
+        self._seed = ""  # G-code that puts the parser where the last chunk ended
+
+        self.arcs = 0
+        self.chords = 0
+        self.max_deviation = 0.0
+        self.shortest_chord = np.inf  # mm
+        self.lines_in = 0
+        self.lines_out = 0
+
+    def linearizeText(self, text):
+        """
+        Linearize a block of newline-terminated lines.
+        """
+        source = self._seed + text
+        program = parseProgram(source)
+        words, params = program.words, program.params
+        positions, feedrate = resolvePositions(words, params)
+        skip = self._seed.count("\n")
+
+        modeSet = np.isin(words, (G90, G91))
+        relative = forwardFill(modeSet, words == G91, False)
+        modeSetE = modeSet | np.isin(words, (M82, M83))
+        relativeE = forwardFill(modeSetE, (words == G91) | (words == M83), False)
+        self._seed = self._state(positions, relative, relativeE, feedrate)
+
+        lines = splitProgram(source)[skip:]
+        self.lines_in += len(lines)
+        arcs = np.flatnonzero(np.isin(words, (G2, G3)))
+        arcs = arcs[arcs >= skip]
+        if not len(arcs):
+            self.lines_out += len(lines)
+            return text
+
+        # Chords no shorter than the head covers in min_segment_time
+        speed = np.where(np.isnan(feedrate), self.profile.DEFAULT_FEEDRATE, feedrate)
+        shortest = speed / 60 * self.min_segment_time
+        line, starts, ends = expandSegments(
+            words, params, positions, tolerance=self.tolerance, min_length=shortest
+        )
+        chord = np.isin(line, arcs)
+        line, starts, ends = line[chord], starts[chord], ends[chord]
+
+        # How far the chords of each arc stray from it
+        end = np.stack([positions[a] for a in AXES], axis=1)
+        start = np.vstack((np.zeros((1, 4)), end[:-1]))
+        _, _, radius, _, sweep = arcGeometry(words, params, start, end, arcs)
+        counts = np.bincount(line, minlength=len(words))[arcs]
+        deviation = radius * (1 - np.cos(np.abs(sweep) / counts / 2))
+        lengths = np.sqrt(((ends - starts)[:, :3] ** 2).sum(axis=1))
+
+        self.arcs += len(arcs)
+        self.chords += len(line)
+        self.max_deviation = max(self.max_deviation, float(deviation.max()))
+        self.shortest_chord = min(self.shortest_chord, float(lengths.min()))
+
+        chords = self._format(line, starts, ends, relative, relativeE, params)
+        firsts = np.searchsorted(line, arcs)
+        for arc, first, count in zip(arcs.tolist(), firsts.tolist(), counts.tolist()):
+            i = arc - skip
+            comment = lines[i].split(";", 1)[1] if ";" in lines[i] else None
+            block = chords[first : first + count]
+            if "F" in params and not np.isnan(params["F"][arc]):
+                block[0] += f" F{params['F'][arc]:g}"
+            if comment is not None:
+                block[0] += f" ;{comment}"
+            lines[i] = "\n".join(block)
+
+        self.lines_out += len(lines) - len(arcs) + len(line)
+        return "".join([f"{line}\n" for line in lines])
+
+    def _format(self, line, starts, ends, relative, relativeE, params):
+        """
+        The G1 for every chord: X and Y, and Z and E if the arc has them.
+        """
+        nan = np.full(len(relative), np.nan)
+        # Relative chords are the differences of rounded ends, so the
+        # rounding doesn't add up along an arc
+        starts, ends = np.round(starts, 4), np.round(ends, 4)
+        values = np.where(relative[line][:, None], ends - starts, ends)
+        values[:, 3] = np.where(relativeE[line], ends[:, 3] - starts[:, 3], ends[:, 3])
+        hasZ = ~np.isnan(params.get("Z", nan)[line])
+        hasE = ~np.isnan(params.get("E", nan)[line])
+
+        chords = []
+        for (x, y, z, e), withZ, withE in zip(values.tolist(), hasZ, hasE):
+            chord = f"G1 X{x:.4f} Y{y:.4f}"
+            if withZ:
+                chord += f" Z{z:.4f}"
+            if withE:
+                chord += f" E{e:.4f}"
+            chords.append(chord)
+        return chords
+
+    @staticmethod
+    def _state(positions, relative, relativeE, feedrate):
+        """
+        G-code that sets up the state the printer is in after the last line.
+        """
+        if not len(relative):
+            return ""
+        seed = ["G91" if relative[-1] else "G90", "M83" if relativeE[-1] else "M82"]
+        seed.append("G92 " + " ".join(f"{a}{positions[a][-1]:.6f}" for a in AXES))
+        if not np.isnan(feedrate[-1]):
+            seed.append(f"G0 F{feedrate[-1]:g}")
+        return "".join([f"{line}\n" for line in seed])
+
+    def writer(self, write):
+        """
+        Wrap a function that writes text (ex. file.write) so that every
+        chunk is linearized first.
+        """
+        return lambda text: write(self.linearizeText(text))
+
+    def report(self):
+        if not self.arcs:
+            return f"No arcs in {self.lines_in} lines."
+        return (
+            f"Replaced {self.arcs} arcs with {self.chords} chords "
+            f"({self.lines_in} lines in, {self.lines_out} out). Chords stray at most "
+            f"{self.max_deviation:.4f} mm, the shortest is {self.shortest_chord:.3f} mm."
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    source = args[0]
+    destination = args[1] if len(args) > 1 else source
+    tolerance = float(args[2]) if len(args) > 2 else TOLERANCE
+
+    with open(source) as file:
+        text = file.read()
+
+    linearizer = arcLinearizer(tolerance)
+    text = linearizer.linearizeText(text)
+    with open(destination, "w") as file:
+        file.write(text)
+    print(linearizer.report())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+coverageAnalyzer.py works out which parts of the wafer a program's scan
+droplet actually passes over. Every move made with the tip down at
+scanning height is swept by a disk the size of the droplet and drawn
+onto a fine grid over the wafer, giving the covered fraction of the
+scan area, how many times each spot was passed over, and a mask of the
+spots that were missed.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python coverageAnalyzer.py filename.gcode [resolution_mm] [wafer_diam_mm]
+"""
+
+import math
+import os
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+
+from gCodeClass import MachineProfile, ScanProfile, marlinPrinter
+from gCodeParser import parseProgram, readProgram, resolvePositions
+from motionEstimator import expandSegments
+
+
+@dataclass
+class CoverageMap:
+    """
+    The result of analyzeCoverage. Grids are (rows, columns) = (Y, X),
+    cell [i, j] centered at (x0 + (j + 0.5) * resolution,
+    y0 + (i + 0.5) * resolution) in wafer coordinates (head offset
+    undone), with the wafer center at 'center'.
+    """
+
+    counts: np.ndarray  # Times the droplet passed over each cell
+    target: np.ndarray  # Cells that should be scanned
+    resolution: float
+    origin: tuple  # (x0, y0)
+    center: tuple
+
+    @property
+    def uncovered(self):
+        """
+        Mask of the target cells the droplet never reached.
+        """
+        return self.target & (self.counts <= 0)
+
+    @property
+    def histogram(self):
+        """
+        histogram[k] is the number of target cells passed over k times.
+        """
+        return np.bincount(np.maximum(self.counts[self.target], 0))
+
+    @property
+    def covered_fraction(self):
+        histogram = self.histogram
+        return 1 - histogram[0] / histogram.sum() if histogram.sum() else 0.0
+
+    @property
+    def cell_area(self):
+        return self.resolution**2
+
+    def gaps(self, step=0.5):
+        """
+        The missed area (mm^2) in each ring of the wafer 'step' mm wide,
+        as a list of (inner radius, outer radius, area) for the rings
+        that have any.
+        """
+        rows, columns = np.nonzero(self.uncovered)
+        x = self.origin[0] + (columns + 0.5) * self.resolution - self.center[0]
+        y = self.origin[1] + (rows + 0.5) * self.resolution - self.center[1]
+        band = np.floor(np.hypot(x, y) / step).astype(np.int64)
+        areas = np.bincount(band) * self.cell_area
+        return [
+            (i * step, (i + 1) * step, float(area))
+            for i, area in enumerate(areas)
+            if area
+        ]
+
+    def __str__(self):
+        histogram = self.histogram
+        total = histogram.sum()
+        lines = [
+            f"Covered: {100 * self.covered_fraction:.2f}% of "
+            f"{total * self.cell_area:.1f} mm^2 "
+            f"({self.resolution} mm grid)",
+            "Passes  Share of scan area",
+        ]
+        for passes, cells in enumerate(histogram):
+            if cells:
+                lines.append(f"{passes:>6}  {100 * cells / total:6.2f}%")
+        for inner, outer, area in self.gaps():
+            lines.append(f"Missed {area:.2f} mm^2 from r={inner:g} to r={outer:g} mm")
+        return "\n".join(lines)
+
+
+def analyzeCoverage(
+    source,
+    resolution=0.05,
+    machine=None,
+    scan=None,
+    droplet_diameter=None,
+    contact_height=None,
+    target_radius=None,
+):
+    """
+    Maps the droplet coverage of a program. 'source' is a marlinPrinter
+    (or VPDScanner), a .gcode filename, or the G-code itself (str or
+    bytes). Settings not given come from the scanner's profiles, or
+    from 'machine'/'scan' (MachineProfile/ScanProfile, default: the
+    class defaults).
+
+    The droplet is a disk of droplet_diameter (default: DROPLET_DIAMETER)
+    dragged along every G0/G1/G2/G3 move made with the tip at or below
+    contact_height (default: SCAN_HEIGHT) while it is dispensed. The
+    target is the disk of target_radius (default: WAFER_DIAM / 2 -
+    EDGE_GAP) around the wafer center, and the grid covers the whole
+    wafer. Returns a CoverageMap.
+    """
+    if isinstance(source, marlinPrinter):
+        if source.program.sink is not None:
+            raise ValueError("Can't analyze a streamed program, use its file.")
+        machine = machine or source.machineProfile
+        if scan is None and hasattr(source, "scanProfile"):
+            scan = source.scanProfile
+        text = source.program.render()
+    elif isinstance(source, (str, os.PathLike)) and os.path.isfile(source):
+        text = readProgram(source)
+    else:
+        text = source
+    machine = machine or MachineProfile()
+    scan = scan or ScanProfile()
+
+    radius = (droplet_diameter or scan.DROPLET_DIAMETER) / 2
+    if contact_height is None:
+        contact_height = scan.SCAN_HEIGHT
+    if target_radius is None:
+        target_radius = scan.WAFER_DIAM / 2 - scan.EDGE_GAP
+
+    # Every straight piece of every move, in wafer coordinates. Arcs are
+    # split finely enough that the chords are within a quarter cell.
+    program = parseProgram(text)
+    words, params = program.words, program.params
+    positions, _ = resolvePositions(words, params)
+    _, start, end = expandSegments(words, params, positions, tolerance=resolution / 4)
+    offset = np.array([machine.X_OFFSET, machine.Y_OFFSET, machine.Z_OFFSET, 0])
+    start, end = start - offset, end - offset
+
+    # Only moves with the tip down wet the wafer, and only once the droplet
+    # is out: from E going down with the tip down (dispensing) until E goes
+    # back up (picking it up). Programs that never dispense at the wafer
+    # count every move with the tip down. The droplet is dragged without a
+    # break between consecutive wetting moves.
+    contact = np.maximum(start[:, 2], end[:, 2]) <= contact_height + 1e-6
+    drawn = end[:, 3] - start[:, 3]
+    dispensed = contact & (drawn < 0)
+    if dispensed.any():
+        index = np.arange(len(start))
+        lastOut = np.maximum.accumulate(np.where(dispensed, index, -1))
+        lastIn = np.maximum.accumulate(np.where(drawn > 0, index, -1))
+        contact &= lastOut > np.concatenate(([-1], lastIn[:-1]))
+    run = np.cumsum(~contact)
+    moving = np.hypot(*(end - start)[:, :2].T) > 1e-9
+    keep = contact & moving
+    run, start, end = run[keep], start[keep, :2], end[keep, :2]
+    joined = np.flatnonzero(run[1:] == run[:-1]) + 1
+
+    # Grid over the whole wafer
+    center = (machine.X_MAX / 2, machine.Y_MAX / 2)
+    cells = math.ceil(scan.WAFER_DIAM / resolution)
+    origin = (
+        center[0] - cells * resolution / 2,
+        center[1] - cells * resolution / 2,
+    )
+
+    # Each move adds its capsule (the segment widened by the droplet
+    # radius). Consecutive moves share the disk around their joint, which
+    # is taken back out so a spot passed over once counts once.
+    counts = _rasterize(
+        [
+            (start, end, 1),
+            (end[joined - 1], None, -1),
+        ],
+        radius,
+        cells,
+        origin,
+        resolution,
+    )
+
+    within = (np.arange(cells) + 0.5) * resolution - cells * resolution / 2
+    target = within[None, :] ** 2 <= (target_radius**2 - within**2)[:, None]
+    return CoverageMap(counts, target, resolution, origin, center)
+
+
+def _rasterize(shapes, radius, cells, origin, resolution):
+    """
+    Draws capsules (a segment from a to b widened by 'radius'; b=None
+    gives a disk around a) onto a cells x cells grid, adding 'weight' to
+    every cell whose center is inside. 'shapes' is a list of (a, b,
+    weight) with a and b (N, 2) arrays. Works one grid row at a time: a
+    capsule covers a single run of cells in a row, so only the two ends
+    of the run are marked, and a cumulative sum along the rows fills
+    them in.
+    """
+    marks, weights = [], []
+    for a, b, weight in shapes:
+        if not len(a):
+            continue
+        # Rows each capsule reaches
+        ends = a if b is None else b
+        low = np.minimum(a[:, 1], ends[:, 1]) - radius
+        high = np.maximum(a[:, 1], ends[:, 1]) + radius
+        first = np.maximum(np.ceil((low - origin[1]) / resolution - 0.5), 0)
+        last = np.minimum(np.floor((high - origin[1]) / resolution - 0.5), cells - 1)
+        rowCounts = np.maximum(last - first + 1, 0).astype(np.int64)
+        owner = np.repeat(np.arange(len(a)), rowCounts)
+        row = np.arange(len(owner)) - np.repeat(np.cumsum(rowCounts), rowCounts)
+        row += np.repeat(first.astype(np.int64) + rowCounts, rowCounts)
+        y = origin[1] + (row + 0.5) * resolution
+
+        left, right = _diskSpan(a[owner, 0], a[owner, 1], y, radius)
+        if b is not None:
+            for span in (
+                _diskSpan(b[owner, 0], b[owner, 1], y, radius),
+                _bandSpan(a[owner], b[owner], y, radius),
+            ):
+                left, right = np.minimum(left, span[0]), np.maximum(right, span[1])
+
+        # Cells whose centers are within [left, right]
+        first = np.maximum(np.ceil((left - origin[0]) / resolution - 0.5), 0)
+        last = np.minimum(np.floor((right - origin[0]) / resolution - 0.5), cells - 1)
+        hit = first <= last
+        at = row[hit] * (cells + 1)
+        marks += [at + first[hit].astype(np.int64), at + last[hit].astype(np.int64) + 1]
+        weights += [np.full(hit.sum(), weight), np.full(hit.sum(), -weight)]
+
+    # Add up the marks a block of rows at a time, to keep memory down
+    marks, weights = np.concatenate(marks), np.concatenate(weights)
+    block = marks // ((cells + 1) * _BLOCK_ROWS)
+    order = np.argsort(block.astype(np.int16), kind="stable")
+    blockCount = math.ceil(cells / _BLOCK_ROWS)
+    blocks = np.searchsorted(block[order], np.arange(blockCount + 1))
+
+    counts = np.empty((cells, cells), dtype=np.int16)
+    for i, top in enumerate(range(0, cells, _BLOCK_ROWS)):
+        rows = min(_BLOCK_ROWS, cells - top)
+        chosen = order[blocks[i] : blocks[i + 1]]
+        total = np.bincount(
+            marks[chosen] - top * (cells + 1),
+            weights[chosen],
+            minlength=rows * (cells + 1),
+        )
+        # Summing int16 is about twice as fast as summing the float counts
+        total = total.astype(np.int16).reshape(rows, cells + 1)[:, :-1]
+        np.cumsum(total, axis=1, out=counts[top : top + rows])
+    return counts
+
+
+_BLOCK_ROWS = 512
+
+
+def _diskSpan(x, y, rowY, radius):
+    """
+    Where the row at rowY crosses the disk around (x, y): (left, right),
+    or (inf, -inf) if it doesn't.
+    """
+    half = np.sqrt(np.maximum(radius**2 - (rowY - y) ** 2, 0))
+    missed = np.abs(rowY - y) > radius
+    return np.where(missed, np.inf, x - half), np.where(missed, -np.inf, x + half)
+
+
+def _bandSpan(a, b, rowY, radius):
+    """
+    Where the row at rowY crosses the rectangle swept by the segment
+    a-b widened by 'radius' to each side, not counting the round ends:
+    (left, right), or (inf, -inf) if it doesn't.
+    """
+    (ax, ay), (dx, dy) = a.T, (b - a).T
+    length = np.hypot(dx, dy)
+    left = np.full(len(ax), -np.inf)
+    right = np.full(len(ax), np.inf)
+    # Along the segment: 0 <= t <= length, and across it: |s| <= radius,
+    # with t and s both linear in x along the row
+    with np.errstate(divide="ignore", invalid="ignore"):
+        along = dx / length, (rowY - ay) * dy / length, 0, length
+        across = -dy / length, (rowY - ay) * dx / length, -radius, radius
+    for slope, intercept, low, high in (along, across):
+        flat = np.abs(slope) < 1e-12
+        with np.errstate(divide="ignore", invalid="ignore"):
+            one = (low - intercept) / slope + ax
+            two = (high - intercept) / slope + ax
+        inside = (intercept >= low) & (intercept <= high)
+        left = np.maximum(
+            left,
+            np.where(flat, np.where(inside, -np.inf, np.inf), np.minimum(one, two)),
+        )
+        right = np.minimum(
+            right,
+            np.where(flat, np.where(inside, np.inf, -np.inf), np.maximum(one, two)),
+        )
+    empty = ~(left <= right)  # NaN (a zero length segment) too
+    return np.where(empty, np.inf, left), np.where(empty, -np.inf, right)
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    resolution = float(args[1]) if len(args) > 1 else 0.05
+    scan = ScanProfile()
+    if len(args) > 2:
+        scan = ScanProfile(WAFER_DIAM=float(args[2]))
+    print(analyzeCoverage(args[0], resolution, scan=scan))
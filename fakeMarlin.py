@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+"""
+fakeMarlin.py is a stand-in for a Marlin printer on a pseudo-terminal, so
+printHost.py (or Repetier Host, or a terminal) can be tried out and timed
+without the scanner. It checks line numbers and checksums, keeps Marlin's
+command queue and planner, runs every move for as long as the printer
+would (see motionEstimator.py), and answers the way Marlin does. It can
+also be told to answer late, lose or garble lines, and halt.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python fakeMarlin.py [time_scale]
+"""
+
+import asyncio
+import math
+import os
+import random
+import re
+import sys
+import tty
+from collections import deque
+from dataclasses import dataclass
+
+from gCodeOptimizer import splitLine
+from gCodeParser import AXES
+from motionEstimator import PlannerProfile
+from printHost import BAUDRATE, checksum, stripLine
+
+STEPS_PER_UNIT = (80, 80, 400, 93)  # X, Y, Z, E (M92), stock Ender 3
+MIN_STEPS_PER_SEGMENT = 6  # Shorter moves are dropped (and added to the next)
+EXTRUDE_MINTEMP = 170  # No extruding below this, unless M302 allows it
+TEMPERATURE = 25.0  # The heaters are never turned on
+
+_LINE_NUMBER = re.compile(r"N(-?\d+)\s*(.*)")
+
+
+@dataclass
+class _Block:
+    target: tuple  # X, Y, Z, E at the end of the move
+    length: float = 0.0  # 0 for a G92 (sets the position, no move)
+    unit: tuple = (0.0, 0.0, 0.0, 0.0)
+    nominal: float = 0.0  # mm/s
+    acceleration: float = 0.0
+    junction: float = 0.0  # Highest entry speed (squared) from the block before
+
+
+@dataclass
+class FakeStats:
+    """
+    What the fake printer saw, to check a host against:
+        lines: lines taken into the command queue
+        resends, dropped, overruns: resend requests (the injected ones
+            too), lines lost on purpose, and lines cut short because the
+            host sent more than fits in the serial buffer
+        moves, move_seconds: planner blocks run, and the time spent moving
+        stalls, stall_seconds: times the planner ran empty between two
+            moves (G4, G28, M0 and M400 empty it on purpose, so those
+            aren't counted) and how long it sat empty, in printer seconds
+    """
+
+    lines: int = 0
+    resends: int = 0
+    dropped: int = 0
+    overruns: int = 0
+    moves: int = 0
+    move_seconds: float = 0.0
+    stalls: int = 0
+    stall_seconds: float = 0.0
+
+    def __str__(self):
+        return (
+            f"Printer took {self.lines} lines, asked for {self.resends} resend(s) "
+            f"({self.dropped} line(s) dropped, {self.overruns} overrun(s))\n"
+            f"Moved for {self.move_seconds:.1f} s in {self.moves} blocks, "
+            f"planner ran dry {self.stalls} time(s) for {self.stall_seconds:.3f} s"
+        )
+
+
+class _SerialProtocol(asyncio.Protocol):
+    def __init__(self, printer):
+        self.printer = printer
+
+    def data_received(self, data):
+        self.printer._received(data)
+
+
+class fakeMarlin:
+    """
+    A simulated Marlin printer on a pty:
+
+        async with fakeMarlin(time_scale=0.1) as printer:
+            host = await printHost.open(printer.port)
+            await host.stream(scanner)
+
+    Times are in printer seconds; time_scale=0.1 runs the whole printer
+    (moves, dwells, the serial line, keepalives) ten times faster.
+    latency delays every answer, like a USB serial adapter does.
+    resend_rate garbles that fraction of lines (Marlin asks for them
+    again), drop_rate loses lines entirely, and halt_after halts the
+    printer (Marlin's kill()) after that many lines. An M0 without S or P
+    waits for M108, or user_wait seconds if given.
+    """
+
+    BUFSIZE = 4  # Command queue, in lines
+    RX_BUFFER_SIZE = 128  # Serial receive buffer, in bytes
+    BLOCK_BUFFER_SIZE = 16  # Planner (one block is always kept free)
+    KEEPALIVE_INTERVAL = 2.0  # s, for "echo:busy:" (HOST_KEEPALIVE)
+
+    def __init__(
+        self,
+        profile=PlannerProfile(),
+        time_scale=1.0,
+        baudrate=BAUDRATE,
+        latency=0.0,
+        resend_rate=0.0,
+        drop_rate=0.0,
+        halt_after=None,
+        user_wait=None,
+        advanced_ok=True,
+        seed=None,
+    ):
+        self.profile = profile
+        self.time_scale = time_scale
+        self.baudrate = baudrate
+        self.latency = latency
+        self.resend_rate = resend_rate
+        self.drop_rate = drop_rate
+        self.halt_after = halt_after
+        self.user_wait = user_wait
+        self.advanced_ok = advanced_ok
+        self.port = None
+
+        # Settings, as M92/M201/M203/M204/M205/M302 leave them
+        self.steps_per_unit = list(STEPS_PER_UNIT)
+        self.max_feedrate = list(profile.MAX_FEEDRATE)
+        self.max_acceleration = list(profile.MAX_ACCELERATION)
+        self.acceleration = profile.ACCELERATION
+        self.retract_acceleration = profile.RETRACT_ACCELERATION
+        self.travel_acceleration = profile.TRAVEL_ACCELERATION
+        self.junction_deviation = profile.JUNCTION_DEVIATION
+        self.extrude_mintemp = EXTRUDE_MINTEMP
+        self.allow_cold_extrude = False
+
+        self.position = [0.0, 0.0, 0.0, 0.0]  # Where the last command left it
+        self.feedrate = profile.DEFAULT_FEEDRATE  # mm/min
+        self.relative = False  # G91
+        self.relative_e = False  # M83
+        self.last_line = 0
+        self.busy = None  # "processing" or "paused for user"
+        self.halted = False
+        self.commands = []  # Every command taken, in order
+        self.stats = FakeStats()
+
+        self._random = random.Random(seed)
+        self._rx = deque()  # (arrival time, line) in the serial buffer
+        self._rxBytes = 0
+        self._partial = b""
+        self._wireFree = 0.0  # When the serial line is done with the bytes sent
+        self._queue = deque()  # Marlin's command queue
+        self._planner = deque()
+        self._planned = [0.0, 0.0, 0.0, 0.0]  # Where the planner's last block ends
+        self._stepped = [0.0, 0.0, 0.0, 0.0]  # Where the steppers are
+        self._previous = None  # The last block, for the junction speed
+        self._idleSince = None  # When the planner ran dry after a move
+        self._busySince = 0.0
+        self._userContinue = False
+        self._lastReply = 0.0
+        self._changed = asyncio.Event()
+        self._tasks = []
+
+    async def start(self):
+        """
+        Opens the pty (its name is in self.port) and boots.
+        """
+        loop = asyncio.get_running_loop()
+        master, self._slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(self._slave)  # No echo, even before a host opens the port
+        self.port = os.ttyname(self._slave)
+
+        self._readTransport, _ = await loop.connect_read_pipe(
+            lambda: _SerialProtocol(self), open(master, "rb", buffering=0)
+        )
+        self._writeTransport, _ = await loop.connect_write_pipe(
+            asyncio.Protocol, open(os.dup(master), "wb", buffering=0)
+        )
+        self._tasks = [
+            loop.create_task(run())
+            for run in (
+                self._serialLoop,
+                self._commandLoop,
+                self._stepperLoop,
+                self._keepaliveLoop,
+            )
+        ]
+        self._say("start")
+        return self
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._readTransport.close()
+        self._writeTransport.close()
+        os.close(self._slave)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def halt(self, reason="Printer halted. kill() called!"):
+        """
+        Stops everything, like Marlin's kill(): nothing is answered after.
+        """
+        self._say(f"Error:{reason}")
+        self.halted = True
+        self._queue.clear()
+        self._planner.clear()
+        for task in self._tasks:
+            task.cancel()
+
+    def _clock(self):
+        return asyncio.get_running_loop().time() / self.time_scale
+
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds * self.time_scale)
+
+    def _wake(self):
+        self._changed.set()
+
+    async def _until(self, predicate, seconds=None):
+        """
+        Waits until predicate() is true (returns True), or for 'seconds'
+        (returns False).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if seconds is None else loop.time() + seconds * self.time_scale
+        while not predicate():
+            self._changed.clear()
+            if deadline is None:
+                await self._changed.wait()
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _say(self, text):
+        data = f"{text}\n".encode()
+        if not self.latency:
+            self._writeTransport.write(data)
+            return
+        # Answers keep their order, however close together they are
+        loop = asyncio.get_running_loop()
+        due = max(loop.time() + self.latency * self.time_scale, self._lastReply + 1e-6)
+        self._lastReply = due
+        loop.call_at(due, self._writeTransport.write, data)
+
+    def _received(self, data):
+        """
+        Bytes from the host. They take 10 bits each to come down the
+        serial line, and bytes that don't fit in the serial buffer are
+        lost. Like Marlin's emergency parser, M108 and M112 take effect
+        as soon as they arrive, however many lines are waiting.
+        """
+        if self.halted:
+            return
+        now = asyncio.get_running_loop().time()
+        *lines, self._partial = (self._partial + data).split(b"\n")
+        for line in lines:
+            text = line.decode(errors="replace").strip()
+            numbered = _LINE_NUMBER.fullmatch(text)
+            code = stripLine((numbered.group(2) if numbered else text).split("*")[0])
+            if code == "M108":
+                self._userContinue = True
+            elif code == "M112":
+                self.halt()
+                return
+
+            size = len(line) + 1
+            if self._rxBytes + size > self.RX_BUFFER_SIZE:
+                line = line[: max(self.RX_BUFFER_SIZE - self._rxBytes - 1, 0)]
+                size = len(line) + 1
+                self.stats.overruns += 1
+            self._wireFree = max(self._wireFree, now)
+            self._wireFree += size * 10 / self.baudrate * self.time_scale
+            self._rx.append((self._wireFree, line))
+            self._rxBytes += size
+        self._wake()
+
+    async def _serialLoop(self):
+        """
+        Reads lines from the serial buffer into the command queue, while
+        there is room in the queue.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._until(lambda: self._rx and len(self._queue) < self.BUFSIZE)
+            arrival, line = self._rx[0]
+            if arrival > loop.time():
+                await asyncio.sleep(arrival - loop.time())
+                continue  # The buffer may have been emptied meanwhile
+            self._rx.popleft()
+            self._rxBytes -= len(line) + 1
+            self._take(line.decode(errors="replace").strip())
+
+            if self.halt_after is not None and self.stats.lines >= self.halt_after:
+                self.halt()
+                return
+
+    def _take(self, text):
+        """
+        Checks a line the way Marlin does and queues its command.
+        """
+        if self._random.random() < self.drop_rate:
+            self.stats.dropped += 1
+            return
+        garbled = self._random.random() < self.resend_rate
+
+        numbered = _LINE_NUMBER.fullmatch(text)
+        if numbered:
+            number, code = int(numbered.group(1)), numbered.group(2)
+            if number != self.last_line + 1 and "M110" not in code:
+                return self._lineError("Line Number is not Last Line Number+1")
+            if "*" not in code:
+                return self._lineError("No Checksum with line number")
+            code, _, given = code.rpartition("*")
+            expected = checksum(text[: text.rindex("*")])
+            if garbled or not given.isdigit() or int(given) != expected:
+                return self._lineError("checksum mismatch")
+            self.last_line = number
+        elif "*" in text:
+            return self._lineError("No Line Number with checksum")
+        else:
+            code = text
+
+        code = stripLine(code)
+        if code:
+            self._queue.append(code)
+            self.commands.append(code)
+            self.stats.lines += 1
+            self._wake()
+
+    def _lineError(self, message):
+        """
+        Marlin empties its serial buffer (lines still on their way get
+        there afterwards) and asks for the line after the last good one.
+        """
+        now = asyncio.get_running_loop().time()
+        self._say(f"Error:{message}, Last Line: {self.last_line}")
+        while self._rx and self._rx[0][0] <= now:
+            self._rxBytes -= len(self._rx.popleft()[1]) + 1
+        self._say(f"Resend: {self.last_line + 1}")
+        self._say("ok")
+        self.stats.resends += 1
+
+    async def _commandLoop(self):
+        while True:
+            await self._until(lambda: self._queue)
+            self.busy, self._busySince = "processing", self._clock()
+            reply = await self._execute(self._queue[0])
+            self.busy = None
+            if reply is None:
+                reply = "ok"
+                if self.advanced_ok:
+                    blocks = self.BLOCK_BUFFER_SIZE - 1 - len(self._planner)
+                    lines = self.BUFSIZE - len(self._queue)
+                    reply += f" N{self.last_line} P{blocks} B{lines}"
+            self._queue.popleft()
+            self._say(reply)
+            self._wake()
+
+    async def _keepaliveLoop(self):
+        while True:
+            await self._sleep(self.KEEPALIVE_INTERVAL)
+            waited = self._clock() - self._busySince
+            if self.busy and waited >= self.KEEPALIVE_INTERVAL:
+                self._say(f"echo:busy: {self.busy}")
+
+    async def _execute(self, code):
+        """
+        Runs one command. Returns the ok line if it isn't the usual one.
+        """
+        word, params, _ = splitLine(code)
+        params = params or {}
+
+        if word in ("G0", "G1"):
+            await self._line(self._target(params))
+        elif word in ("G2", "G3"):
+            await self._arc(params, clockwise=word == "G2")
+        elif word == "G4":
+            await self._synchronize()
+            await self._sleep(params.get("S", params.get("P", 0) / 1000))
+        elif word == "G28":
+            await self._home(params)
+        elif word in ("G90", "G91"):
+            self.relative = self.relative_e = word == "G91"
+        elif word in ("M82", "M83"):
+            self.relative_e = word == "M83"
+        elif word == "G92":
+            await self._setPosition(params)
+        elif word in ("M0", "M1"):
+            await self._waitForUser(params)
+        elif word in ("M400", "M18", "M84"):
+            await self._synchronize()
+        elif word == "M92":
+            self._setAxes(self.steps_per_unit, params)
+        elif word == "M201":
+            self._setAxes(self.max_acceleration, params)
+        elif word == "M203":
+            self._setAxes(self.max_feedrate, params)
+        elif word == "M204":
+            both = params.get("S")  # Sets the print and travel acceleration
+            self.acceleration = params.get("P", both or self.acceleration)
+            self.travel_acceleration = params.get("T", both or self.travel_acceleration)
+            self.retract_acceleration = params.get("R", self.retract_acceleration)
+        elif word == "M205":
+            self.junction_deviation = params.get("J", self.junction_deviation)
+        elif word == "M302":
+            self._coldExtrude(params)
+        elif word == "M105":
+            return f"ok T:{TEMPERATURE:.2f} /0.00 B:{TEMPERATURE:.2f} /0.00 @:0 B@:0"
+        elif word == "M114":
+            self._reportPosition()
+        elif word == "M110":
+            self.last_line = int(params.get("N", self.last_line))
+        elif word == "M115":
+            self._say(
+                "FIRMWARE_NAME:Marlin (fakeMarlin.py) PROTOCOL_VERSION:1.0 "
+                "MACHINE_TYPE:VPD Scanner EXTRUDER_COUNT:1"
+            )
+        elif word in ("G21", "M108", "M117", "M300"):
+            pass  # Millimeters already, M108 took effect on arrival, no LCD/buzzer
+        else:
+            self._say(f'echo:Unknown command: "{code}"')
+
+    def _setAxes(self, values, params):
+        for i, axis in enumerate(AXES):
+            values[i] = params.get(axis, values[i])
+
+    def _target(self, params):
+        """
+        Where a move ends, in absolute coordinates. Also takes its F.
+        """
+        target = list(self.position)
+        for i, axis in enumerate(AXES):
+            if axis in params:
+                relative = self.relative_e if axis == "E" else self.relative
+                target[i] = target[i] + params[axis] if relative else params[axis]
+        if params.get("F", 0) > 0:
+            self.feedrate = params["F"]
+        return target
+
+    def _coldExtrude(self, params):
+        if "S" in params:
+            self.extrude_mintemp = params["S"]
+            self.allow_cold_extrude = self.extrude_mintemp == 0
+        if "P" in params:
+            self.allow_cold_extrude = self.extrude_mintemp == 0 or params["P"] > 0
+        elif "S" not in params:
+            state = "enabled" if self.allow_cold_extrude else "disabled"
+            self._say(
+                f"echo:Cold extrudes are {state} (min temp {self.extrude_mintemp:g}C)"
+            )
+
+    def _reportPosition(self):
+        position = " ".join(f"{a}:{p:.2f}" for a, p in zip(AXES, self.position))
+        count = " ".join(
+            f"{a}:{round(p * s)}"
+            for a, p, s in zip("XYZ", self._stepped, self.steps_per_unit)
+        )
+        self._say(f"{position} Count {count}")
+
+    async def _synchronize(self):
+        """
+        Waits for every queued move to finish (Marlin's planner.synchronize).
+        """
+        await self._until(lambda: not self._planner)
+        self._idleSince = None  # Stopping here was the program's idea
+
+    async def _waitForUser(self, params):
+        await self._synchronize()
+        self.busy, self._busySince = "paused for user", self._clock()
+        seconds = params.get("S", params.get("P", 0) / 1000) or self.user_wait
+        self._userContinue = False
+        await self._until(lambda: self._userContinue, seconds)
+
+    async def _home(self, params):
+        await self._synchronize()
+        axes = [i for i, a in enumerate("XYZ") if a in params] or [0, 1, 2]
+        await self._sleep(
+            sum(abs(self._stepped[i]) / self.profile.HOMING_FEEDRATE[i] for i in axes)
+        )
+        for i in axes:
+            self.position[i] = self._planned[i] = self._stepped[i] = 0.0
+        self._previous = None
+        self._reportPosition()
+
+    async def _setPosition(self, params):
+        """
+        G92: the steppers are told once the moves before it are done.
+        """
+        for i, axis in enumerate(AXES):
+            if axis in params:
+                self.position[i] = self._planned[i] = params[axis]
+        await self._until(lambda: len(self._planner) < self.BLOCK_BUFFER_SIZE - 1)
+        self._planner.append(_Block(tuple(self._planned)))
+        self._previous = None
+        self._wake()
+
+    async def _line(self, target):
+        """
+        Adds a straight move to the planner (Marlin's planner.buffer_line),
+        waiting for room first.
+        """
+        self.position = list(target)
+        delta = [t - p for t, p in zip(target, self._planned)]
+        tooCold = not self.allow_cold_extrude and TEMPERATURE < self.extrude_mintemp
+        if delta[3] and tooCold:
+            self._say("echo: cold extrusion prevented")
+            self._planned[3] = target[3]
+            delta[3] = 0.0
+        steps = max(abs(d) * s for d, s in zip(delta, self.steps_per_unit))
+        if steps < MIN_STEPS_PER_SEGMENT:
+            return  # Left for the next move to make up
+
+        length = math.sqrt(sum(d * d for d in delta[:3]))
+        eOnly = length < 1e-6
+        if eOnly:
+            length = abs(delta[3])
+        unit = tuple(d / length for d in delta)
+
+        nominal = self.feedrate / 60
+        acceleration = (
+            self.retract_acceleration
+            if eOnly
+            else self.acceleration if delta[3] else self.travel_acceleration
+        )
+        for u, speed, accel in zip(unit, self.max_feedrate, self.max_acceleration):
+            if u:
+                nominal = min(nominal, speed / abs(u))
+                acceleration = min(acceleration, accel / abs(u))
+
+        junction = 0.0
+        previous = self._previous
+        if previous is not None and self._planner:
+            cosTheta = -sum(a * b for a, b in zip(unit, previous.unit))
+            cosTheta = min(max(cosTheta, -0.999999), 0.999999)
+            sinHalf = math.sqrt(0.5 * (1 - cosTheta))
+            junction = acceleration * self.junction_deviation * sinHalf / (1 - sinHalf)
+            junction = min(junction, nominal**2, previous.nominal**2)
+
+        await self._until(lambda: len(self._planner) < self.BLOCK_BUFFER_SIZE - 1)
+        if self._idleSince is not None:
+            self.stats.stalls += 1
+            self.stats.stall_seconds += self._clock() - self._idleSince
+            self._idleSince = None
+
+        block = _Block(tuple(target), length, unit, nominal, acceleration, junction)
+        self._planner.append(block)
+        self._previous = block
+        self._planned = list(target)
+        self._wake()
+
+    async def _arc(self, params, clockwise):
+        """
+        G2/G3 with I J (or R), split into short straight moves like Marlin.
+        """
+        start = list(self.position)
+        target = self._target(params)
+        x0, y0 = start[0], start[1]
+        if "R" in params and (target[0], target[1]) != (x0, y0):
+            radius = params["R"]
+            dx, dy = target[0] - x0, target[1] - y0
+            chord = math.hypot(dx, dy)
+            height = math.sqrt(max(radius**2 - (chord / 2) ** 2, 0))
+            sign = -1 if clockwise ^ (radius < 0) else 1
+            cx = (x0 + target[0]) / 2 - sign * height * dy / chord
+            cy = (y0 + target[1]) / 2 + sign * height * dx / chord
+        else:
+            cx, cy = x0 + params.get("I", 0.0), y0 + params.get("J", 0.0)
+
+        radius = math.hypot(x0 - cx, y0 - cy)
+        a0 = math.atan2(y0 - cy, x0 - cx)
+        a1 = math.atan2(target[1] - cy, target[0] - cx)
+        sweep = (a0 - a1 if clockwise else a1 - a0) % (2 * math.pi)
+        if sweep == 0 or math.hypot(target[0] - x0, target[1] - y0) < 1e-6:
+            sweep = 2 * math.pi  # Back to the start: a full circle
+        sweep += 2 * math.pi * int(params.get("P", 0) or 0)
+        if clockwise:
+            sweep = -sweep
+
+        length = math.hypot(sweep * radius, target[2] - start[2])
+        segments = max(1, math.floor(length / self.profile.MM_PER_ARC_SEGMENT))
+        for k in range(1, segments):
+            t = k / segments
+            angle = a0 + sweep * t
+            point = [
+                cx + radius * math.cos(angle),
+                cy + radius * math.sin(angle),
+                start[2] + (target[2] - start[2]) * t,
+                start[3] + (target[3] - start[3]) * t,
+            ]
+            await self._line(point)
+        await self._line(target)
+
+    async def _stepperLoop(self):
+        """
+        Runs the planner's blocks one after another. A block only slows
+        down at its end as much as the block after it needs, if that one
+        was already planned when it started; otherwise it stops.
+        """
+        loop = asyncio.get_running_loop()
+        speed = 0.0
+        deadline = None
+        while True:
+            await self._until(lambda: self._planner)
+            block = self._planner[0]
+            seconds = 0.0
+            if block.length:
+                upcoming = self._planner[1] if len(self._planner) > 1 else None
+                twice = 2 * block.acceleration * block.length
+                exit = math.sqrt(upcoming.junction) if upcoming else 0.0
+                exit = min(exit, math.sqrt(speed**2 + twice))
+                entry = min(speed, math.sqrt(exit**2 + twice))
+                seconds = _trapezoid(block, entry, exit)
+                speed = exit
+            else:
+                speed = 0.0
+
+            now = loop.time()
+            if deadline is None:
+                deadline = now
+            deadline += seconds * self.time_scale  # Catches up if sleeps run long
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+
+            self._planner.popleft()
+            self._stepped = list(block.target)
+            if block.length:
+                self.stats.moves += 1
+                self.stats.move_seconds += seconds
+            if not self._planner:
+                speed, deadline = 0.0, None
+                if block.length:
+                    self._idleSince = self._clock()
+            self._wake()
+
+
+def _trapezoid(block, entry, exit):
+    """
+    Seconds to run a block starting at 'entry' and ending at 'exit' mm/s.
+    """
+    accel, nominal = block.acceleration, block.nominal
+    rampUp = (nominal**2 - entry**2) / (2 * accel)
+    rampDown = (nominal**2 - exit**2) / (2 * accel)
+    cruise = block.length - rampUp - rampDown
+    if cruise >= 0:
+        return (2 * nominal - entry - exit) / accel + cruise / nominal
+    peak = math.sqrt(max((2 * accel * block.length + entry**2 + exit**2) / 2, 0))
+    return (2 * peak - entry - exit) / accel
+
+
+async def main(time_scale):
+    async with fakeMarlin(time_scale=time_scale) as printer:
+        print(f"Simulated printer on {printer.port} (Ctrl-C to stop)")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    try:
+        asyncio.run(main(float(args[0]) if args else 1.0))
+    except KeyboardInterrupt:
+        pass
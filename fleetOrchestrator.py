@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""
+fleetOrchestrator.py runs a queue of wafer scans on several scanners at
+once. Each job is a wafer ID and a recipe (the VPDScanner settings to
+use); a scanner that comes free takes the next job, and the steps that
+need the operator (the M0 waits to load and take out the syringe) are
+offered to the operator in the order that keeps the most scanners busy.
+It's headless: steps are confirmed on stdin (or with the printer's knob),
+and --simulate runs it against simulated printers (fakeMarlin.py).
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python fleetOrchestrator.py jobs.json port [port ...]
+    python fleetOrchestrator.py jobs.json --simulate 3 --time-scale 0.01
+
+jobs.json is a list of jobs, ex.
+    [{"wafer_id": "W-0042", "recipe": {"SCAN_HEIGHT": 1.5}},
+     {"wafer_id": "W-0043", "recipe": {"SCAN_MODE": "spiral"},
+      "sample_volume": 0.1}]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import sys
+from dataclasses import dataclass, field
+
+from gCodeClass import MachineProfile, ScanProfile, VPDScanner
+from motionEstimator import estimateTime, formatDuration
+from printHost import BAUDRATE, printHost, stripLine
+from sweepRunner import splitParams
+
+USER_WAITS = {"M0", "M1"}
+
+
+@dataclass
+class ScanJob:
+    """
+    One wafer to scan. The recipe holds the settings that differ from
+    the defaults, by the same names a sweep takes (any MachineProfile or
+    ScanProfile field), ex. {"SCAN_HEIGHT": 1.5, "SCAN_MODE": "spiral"}.
+    Jobs with a higher priority run first, then the longest scans.
+    """
+
+    wafer_id: str
+    recipe: dict = field(default_factory=dict)
+    sample_volume: float = 0.05
+    priority: int = 0
+
+
+@dataclass
+class _Segment:
+    state: str  # What the printer is doing while it runs
+    lines: list
+    seconds: float = 0.0  # Estimated
+    prompt: str = None  # For an M0: what the operator has to do
+
+
+@dataclass
+class OperatorStep:
+    """
+    A printer waiting at an M0 for the operator. runs_after is how long
+    (estimated) the printer then runs before it needs the operator again.
+    """
+
+    printer: str
+    wafer_id: str
+    prompt: str
+    since: float
+    runs_after: float
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+
+@dataclass
+class JobResult:
+    job: ScanJob
+    printer: str
+    started: float
+    finished: float = None
+    lines: int = 0
+    resends: int = 0
+    operator_seconds: float = 0.0  # Spent waiting at M0s
+    error: str = None
+
+
+@dataclass
+class FleetPrinter:
+    """
+    One scanner: its state ("offline", "idle", "loading syringe",
+    "scanning", "unloading syringe", "waiting at M0" or "error"), the
+    wafer it's on, and the time it has spent in each state.
+    """
+
+    name: str
+    port: str
+    state: str = "offline"
+    wafer_id: str = None
+    since: float = 0.0
+    seconds: dict = field(default_factory=dict)
+    jobs: int = 0
+    host: printHost = field(default=None, repr=False)
+
+
+def jobSegments(job, machine=None, scan=None):
+    """
+    The job's program, split into what the printer does in turn:
+    loading the syringe, the M0 to load it, scanning, unloading, the M0
+    to take the syringe out, and the end G-code. Each part comes with
+    its estimated run time.
+    """
+    machine = machine or MachineProfile.fromAttributes(VPDScanner)
+    scan = scan or ScanProfile.fromAttributes(VPDScanner)
+    machine, scan, volume = splitParams(job.recipe, machine, scan, job.sample_volume)
+    scanner = VPDScanner(None, volume, machine=machine, scan=scan)
+
+    phases = (
+        ("loading syringe", "Load the wafer and syringe", scanner.startGCode),
+        ("loading syringe", "Load the wafer and syringe", scanner.loadSyringe),
+        ("scanning", None, scanner.doWaferScan),
+        ("unloading syringe", "Take out the syringe", scanner.unloadSyringe),
+        ("unloading syringe", None, scanner.endGCode),
+    )
+    segments = [_Segment("loading syringe", [])]
+    with contextlib.redirect_stdout(io.StringIO()):  # doWaferScan reports the area
+        for state, prompt, phase in phases:
+            start = len(scanner.program)
+            phase()
+            if segments[-1].state != state:
+                segments.append(_Segment(state, []))
+            for line in scanner.program.lines(start, len(scanner.program)):
+                word = stripLine(line).split(None, 1)[:1]
+                if word and word[0].upper() in USER_WAITS:
+                    segments.append(_Segment("waiting at M0", [line], prompt=prompt))
+                    segments.append(_Segment(state, []))
+                else:
+                    segments[-1].lines.append(line)
+    segments = [s for s in segments if s.lines]
+
+    # Estimate up to the end of each part, so every part starts from
+    # where the one before left the printer
+    lines, previous = [], 0.0
+    for segment in segments:
+        lines.extend(segment.lines)
+        total = estimateTime("\n".join(lines)).total
+        segment.seconds, previous = total - previous, total
+    return segments
+
+
+class fleetOrchestrator:
+    """
+    Runs a queue of ScanJobs on several printers:
+
+        fleet = fleetOrchestrator(["/dev/ttyUSB0", "/dev/ttyUSB1"])
+        fleet.submit(ScanJob("W-0042", {"SCAN_HEIGHT": 1.5}))
+        results = await fleet.run()
+
+    Each printer takes the next job as soon as it's free: the highest
+    priority, then the longest (estimated) scan. When printers are
+    waiting for the operator, steps() lists them with the one to do first
+    on top: the printer that will then run the longest on its own (so
+    loading a syringe for a scan comes before taking one out), then the
+    one that has waited longest. Call done(printer) when a step is done,
+    or press the printer's knob, which ends the M0 too.
+
+    on_event(printer, text) is called with what happens (default: print).
+    For simulated printers, time_scale is how much faster than real time
+    they run, so times are reported in printer seconds.
+    """
+
+    def __init__(self, ports, baudrate=BAUDRATE, on_event=None, time_scale=1.0):
+        self.printers = [FleetPrinter(port, port) for port in ports]
+        self.baudrate = baudrate
+        self.on_event = on_event or _printEvent
+        self.time_scale = time_scale
+        self.results = []
+        self.started = None
+
+        self._queue = []  # (job, its segments)
+        self._steps = []
+        self._stepAdded = asyncio.Event()
+
+    def submit(self, job):
+        """
+        Adds a job to the queue (also while the fleet is running, as long
+        as a printer is still taking jobs).
+        """
+        self._queue.append((job, jobSegments(job)))
+        return job
+
+    @property
+    def queued(self):
+        return [job for job, segments in self._queue]
+
+    def steps(self):
+        """
+        The printers waiting for the operator, the one to do first on top.
+        """
+        return sorted(self._steps, key=lambda step: (-step.runs_after, step.since))
+
+    def nextStep(self):
+        steps = self.steps()
+        return steps[0] if steps else None
+
+    async def waitForStep(self):
+        """
+        Waits until a printer needs the operator, and returns nextStep().
+        """
+        while not self._steps:
+            self._stepAdded.clear()
+            await self._stepAdded.wait()
+        return self.nextStep()
+
+    def done(self, printer=None):
+        """
+        The operator is done with the step on 'printer' (a name or port),
+        or with nextStep() if none is given.
+        """
+        for step in self.steps():
+            if printer is None or step.printer == printer:
+                self._steps.remove(step)
+                step.done.set()
+                return step
+        if printer is None:
+            raise ValueError("No printer is waiting for the operator.")
+        raise ValueError(f"{printer} isn't waiting for the operator.")
+
+    async def run(self):
+        """
+        Connects to every printer and runs jobs until the queue is empty.
+        A printer that fails stops taking jobs (its job goes to the
+        results with the error). Returns the JobResults.
+        """
+        self.started = self._clock()
+        await asyncio.gather(*(self._worker(printer) for printer in self.printers))
+        for printer in self.printers:
+            self._setState(printer, printer.state, printer.wafer_id)  # Count the rest
+        return self.results
+
+    def _clock(self):
+        return asyncio.get_running_loop().time() / self.time_scale
+
+    def _setState(self, printer, state, wafer_id=None):
+        now = self._clock()
+        if printer.state != "offline":
+            spent = printer.seconds.get(printer.state, 0.0)
+            printer.seconds[printer.state] = spent + now - printer.since
+        printer.state, printer.since, printer.wafer_id = state, now, wafer_id
+
+    def _takeJob(self):
+        """
+        The next job: the highest priority, then the longest (estimated).
+        Starting the long scans first keeps one from running on alone at
+        the end, while the other printers sit idle.
+        """
+        entry = max(
+            self._queue,
+            key=lambda entry: (entry[0].priority, _estimate(entry[1])),
+        )
+        self._queue.remove(entry)
+        return entry
+
+    async def _worker(self, printer):
+        if not self._queue:
+            return
+        try:
+            printer.host = await printHost.open(printer.port, self.baudrate)
+        except Exception as error:
+            self.on_event(printer, f"Couldn't connect: {error}")
+            self._setState(printer, "error")
+            return
+        self._setState(printer, "idle")
+
+        try:
+            while self._queue:
+                if not await self._runJob(printer, *self._takeJob()):
+                    return
+            self._setState(printer, "idle")
+        finally:
+            await printer.host.close()
+
+    async def _runJob(self, printer, job, segments):
+        result = JobResult(job, printer.name, self._clock())
+        self.results.append(result)
+        estimate = formatDuration(_estimate(segments))
+        self.on_event(printer, f"Started {job.wafer_id} (estimated {estimate})")
+
+        try:
+            for i, segment in enumerate(segments):
+                self._setState(printer, segment.state, job.wafer_id)
+                if segment.prompt is None:
+                    stats = await printer.host.stream(segment.lines)
+                    result.lines += stats.lines
+                    result.resends += stats.resends
+                    continue
+
+                runsAfter = 0.0
+                for later in segments[i + 1 :]:
+                    if later.prompt is not None:
+                        break
+                    runsAfter += later.seconds
+                started = self._clock()
+                await self._waitForOperator(printer, job, segment, runsAfter)
+                result.operator_seconds += self._clock() - started
+        except Exception as error:
+            result.error = str(error)
+            self.on_event(printer, f"Failed on {job.wafer_id}: {error}")
+            self._setState(printer, "error", job.wafer_id)
+            return False
+
+        result.finished = self._clock()
+        printer.jobs += 1
+        self.on_event(
+            printer,
+            f"Finished {job.wafer_id} in "
+            f"{formatDuration(result.finished - result.started)}",
+        )
+        return True
+
+    async def _waitForOperator(self, printer, job, segment, runs_after):
+        """
+        Sends the M0 once the printer has stopped, and waits for done()
+        (then continues the printer with M108) or the printer's knob.
+        """
+        await printer.host.command("M400")
+        step = OperatorStep(
+            printer.name, job.wafer_id, segment.prompt, self._clock(), runs_after
+        )
+        self._steps.append(step)
+        self._stepAdded.set()
+        self.on_event(printer, f"Waiting for the operator: {segment.prompt}")
+
+        paused = asyncio.ensure_future(printer.host.stream(segment.lines))
+        confirmed = asyncio.ensure_future(step.done.wait())
+        try:
+            await asyncio.wait({paused, confirmed}, return_when=asyncio.FIRST_COMPLETED)
+            if not paused.done():
+                printer.host.resume()
+            await paused
+        finally:
+            confirmed.cancel()
+            if step in self._steps:  # Ended with the printer's knob
+                self._steps.remove(step)
+
+
+def _estimate(segments):
+    return sum(segment.seconds for segment in segments)
+
+
+def formatSummary(fleet):
+    """
+    Jobs done, and how each printer spent its time.
+    """
+    done = [result for result in fleet.results if result.finished is not None]
+    failed = [result for result in fleet.results if result.error]
+    elapsed = max((r.finished for r in done), default=fleet.started) - fleet.started
+    lines = [
+        f"{len(done)} job(s) done, {len(failed)} failed, {len(fleet.queued)} "
+        f"left in the queue, in {formatDuration(elapsed)}"
+    ]
+    for printer in fleet.printers:
+        spent = ", ".join(
+            f"{state} {seconds / elapsed:.0%}" if elapsed else state
+            for state, seconds in printer.seconds.items()
+        )
+        lines.append(f"    {printer.name}: {printer.jobs} job(s); {spent}")
+    waits = [result.operator_seconds for result in done]
+    if waits:
+        lines.append(
+            f"Waited for the operator {formatDuration(sum(waits) / len(waits))} "
+            f"per job on average"
+        )
+    return "\n".join(lines)
+
+
+def loadJobs(filename):
+    with open(filename) as file:
+        return [ScanJob(**job) for job in json.load(file)]
+
+
+def _printEvent(printer, text):
+    print(f"[{printer.name}] {text}", flush=True)
+
+
+async def autoOperator(fleet, seconds=60.0):
+    """
+    A simulated operator, for testing: always does nextStep(), and takes
+    'seconds' (printer seconds) for each step.
+    """
+    while True:
+        step = await fleet.waitForStep()
+        await asyncio.sleep(seconds * fleet.time_scale)
+        fleet.done(step.printer)
+
+
+async def _stdinOperator(fleet):
+    """
+    The operator at the terminal: Enter does the suggested step, a port
+    does the step on that printer, and "status" lists every printer.
+    """
+    reader = asyncio.StreamReader()
+    try:
+        await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+    except (ValueError, OSError, NotImplementedError):
+        return  # No terminal: steps are done with the printers' knobs
+    while True:
+        text = (await reader.readline()).decode()
+        if not text:
+            return
+        text = text.strip()
+        if text == "status":
+            for printer in fleet.printers:
+                print(f"{printer.name}: {printer.state} {printer.wafer_id or ''}")
+            for step in fleet.steps():
+                print(f"Waiting: {step.printer} ({step.wafer_id}) {step.prompt}")
+            continue
+        try:
+            step = fleet.done(text or None)
+            print(f"Continuing {step.printer}.")
+        except ValueError as error:
+            print(error)
+        step = fleet.nextStep()
+        if step is not None:
+            print(f"Next: {step.printer} ({step.wafer_id}) {step.prompt}")
+
+
+async def main(jobs, ports, simulate=0, time_scale=1.0, operator_seconds=60.0):
+    """
+    Runs the jobs on the ports, and on 'simulate' simulated printers
+    (with a simulated operator) if given. Returns the fleetOrchestrator.
+    """
+    async with contextlib.AsyncExitStack() as stack:
+        if simulate:
+            from fakeMarlin import fakeMarlin
+
+            for _ in range(simulate):
+                printer = fakeMarlin(time_scale=time_scale)
+                ports.append((await stack.enter_async_context(printer)).port)
+
+        fleet = fleetOrchestrator(ports, time_scale=time_scale)
+        for job in jobs:
+            fleet.submit(job)
+        operator = asyncio.ensure_future(
+            autoOperator(fleet, operator_seconds) if simulate else _stdinOperator(fleet)
+        )
+        await fleet.run()
+        operator.cancel()
+        print(formatSummary(fleet))
+        return fleet
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="Run scan jobs on several scanners.")
+    parser.add_argument("jobs", help="JSON file with the list of jobs.")
+    parser.add_argument("ports", nargs="*")
+    parser.add_argument("--simulate", type=int, default=0, metavar="PRINTERS")
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    parser.add_argument(
+        "--operator-seconds",
+        type=float,
+        default=60.0,
+        help="How long the simulated operator takes per step.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        main(
+            loadJobs(args.jobs),
+            args.ports,
+            args.simulate,
+            args.time_scale,
+            args.operator_seconds,
+        )
+    )
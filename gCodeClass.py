@@ -24,7 +24,873 @@ tjehl@stanford.edu
 Stanford Nanofabrication Facility 2023
 """
 
+import contextlib
+import functools
+import hashlib
+import io
+import json
 import math
+import numbers
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass, fields, replace
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the batch (array) move functions
+    np = None
+
+# Coordinates are held as integers in units of 1/FIXED_SCALE mm (tenths of
+# a micron, the 4 decimal places written to the G-code). A value is rounded
+# once, with the head offset added, and each value is formatted exactly once.
+FIXED_SCALE = 10000
+# Scaled values this close to halfway are rounded from their decimal text
+TIE_WINDOW = 1e-6
+
+
+def toFixed(value):
+    """
+    Convert a number (int, float or numeric string) to fixed point,
+    rounded exactly as f"{value:.4f}" rounds it.
+    >>> toFixed(5.00010)
+    50001
+    >>> toFixed("10.00000")
+    100000
+    >>> toFixed(0.00005)
+    1
+    """
+    if isinstance(value, numbers.Integral):
+        return int(value) * FIXED_SCALE
+    if isinstance(value, (numbers.Real, str)):
+        value = float(value)
+        scaled = value * FIXED_SCALE
+        fixed = round(scaled)
+        if abs(abs(scaled - fixed) - 0.5) < TIE_WINDOW:
+            # Halfway (or nearly): the float's exact value decides
+            fixed = int(f"{value:.4f}".replace(".", ""))
+        return fixed
+    raise Exception("Attempted to convert an incompatible data class to a coordinate.")
+
+
+def toFixedArray(values):
+    """
+    Vectorized toFixed for a NumPy array of floats, returned as
+    whole-number floats so that NaN stays NaN.
+    """
+    scaled = values * FIXED_SCALE
+    fixed = np.rint(scaled)
+    ties = np.flatnonzero(np.abs(np.abs(scaled - fixed) - 0.5) < TIE_WINDOW)
+    for i in ties.tolist():
+        fixed.flat[i] = toFixed(float(values.flat[i]))
+    return fixed
+
+
+def formatFixed(value):
+    """
+    Format a fixed-point value with 4 decimal places.
+    >>> formatFixed(1255000)
+    '125.5000'
+    >>> formatFixed(-5)
+    '-0.0005'
+    """
+    sign = "-" if value < 0 else ""
+    whole, fraction = divmod(abs(value), FIXED_SCALE)
+    return f"{sign}{whole}.{fraction:04d}"
+
+
+_digitGroups = None  # "0000" to "9999" as a (10000, 4) character array
+
+
+def _formatFixedColumn(values, styles):
+    """
+    Vectorized formatFixed for a NumPy array of fixed-point values.
+    'styles' picks the format of each value (see commandBuffer.FIXED,
+    WHOLE and SHORT). Digits are looked up 4 at a time with integer
+    arithmetic and written, right-aligned, into one row of characters
+    per value. Returns (characters, start, length): the text of value k
+    is characters[k, start[k] : start[k] + length[k]].
+    """
+    global _digitGroups
+    if _digitGroups is None:
+        text = "".join(f"{group:04d}" for group in range(10000)).encode()
+        _digitGroups = np.frombuffer(text, dtype=np.uint8).reshape(10000, 4)
+    digitGroups = _digitGroups
+
+    negative = values < 0
+    whole, fraction = np.divmod(np.abs(values), FIXED_SCALE)
+
+    groups = [whole % 10000]
+    rest = whole // 10000
+    while rest.any():
+        groups.insert(0, rest % 10000)
+        rest //= 10000
+    width = 4 * len(groups)
+
+    # Columns: [sign] [whole digits, right-aligned] [.] [4 decimals]
+    chars = np.empty((len(values), width + 6), dtype=np.uint8)
+    for i, group in enumerate(groups):
+        chars[:, 1 + 4 * i : 5 + 4 * i] = digitGroups[group]
+    chars[:, width + 1] = ord(".")
+    chars[:, width + 2 :] = digitGroups[fraction]
+
+    wholeDigits = np.ones(len(values), dtype=np.int64)
+    power = 10
+    while (whole >= power).any():
+        wholeDigits += whole >= power
+        power *= 10
+
+    start = width + 1 - wholeDigits - negative
+    chars[negative, start[negative]] = ord("-")
+
+    # WHOLE values stop before the decimal point, SHORT ones lose trailing zeros
+    end = np.full(len(values), width + 6, dtype=np.int64)
+    end[styles == commandBuffer.WHOLE] = width + 1
+    short = styles == commandBuffer.SHORT
+    for power in (10, 100, 1000):
+        end -= short & (fraction % power == 0)
+
+    return chars, start, end - start
+
+
+class commandBuffer(Sequence):
+    """
+    Compact, column-oriented storage for a G-code program.
+
+    Instead of keeping one formatted string per command, every command is
+    stored as a typed record: an opcode, a presence mask telling which
+    parameters (X, Y, Z, E, F, I, J, P, S) it carries, an offset into a
+    single packed column of parameter values, and an index into a table
+    of (de-duplicated) comment strings. Commands that are not generated
+    by one of the emitters (ex. scanner.commands.append("G21")) are kept
+    as RAW records whose text lives in that same string table.
+
+    Text is only produced when the program is rendered, either line by
+    line through this class (it behaves like a read-only list of strings)
+    or in bulk by marlinPrinter.writeToFile.
+
+    If a 'sink' is given, the buffer streams instead: every 'chunk_lines'
+    commands are rendered and written to the sink in one chunk, and only
+    the last 'tail_lines' commands are kept in memory.
+
+    Values are fixed point (see toFixed) and are only turned into text
+    by formatFixed, or by its vectorized version when NumPy is available.
+    """
+
+    FIELDS = "XYZEFIJPS"
+    FIELD_BITS = {axis: 1 << bit for bit, axis in enumerate(FIELDS)}
+
+    # Default feedrates (ex. F{TRAVEL_FEEDRATE}) have always been written
+    # the way Python prints them: "2000" for an int, "1250.0" for a float.
+    F_AS_INT = 1 << 14
+    F_AS_FLOAT = 1 << 15
+
+    # Value formats: 4 decimals, no decimals, trailing zeros trimmed
+    FIXED = 0
+    WHOLE = 1
+    SHORT = 2
+
+    # Opcodes
+    RAW = 0
+    G0 = 1
+    G1 = 2
+    G2 = 3
+    G3 = 4
+    G4 = 5
+    M92 = 6
+    M300 = 7
+
+    # opcode: (command word, parameter order, comment separator)
+    LAYOUTS = {
+        G0: ("G0", "XYZEF", " ;"),
+        G1: ("G1", "XYZEF", " ; "),
+        G2: ("G2", "XYIJF", " ; "),
+        G3: ("G3", "EIJXY", " ; "),
+        G4: ("G4", "S", " ; "),
+        M92: ("M92", "XYZE", " ; "),
+        M300: ("M300", "P", " ; "),
+    }
+
+    def __init__(self, sink=None, chunk_lines=4096, tail_lines=256):
+        self._templates = {}
+        self.sink = sink
+        self.chunk_lines = chunk_lines
+        self.tail_lines = tail_lines
+        self._write = None if sink is None else _sinkWriter(sink)
+        self._holds = 0  # Open capture() blocks, which pause streaming
+        self.on_flush = None  # Called with (first command, text) as it's written
+
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all commands still held in memory.
+        """
+        self._ops = array("B")
+        self._masks = array("H")
+        self._offsets = array("I")
+        self._comments = array("i")
+        self._values = array("q")
+
+        self._strings = []
+        self._stringIndex = {}
+
+        self.start = 0  # Commands dropped from memory after being streamed
+        self._valueBase = 0  # Values dropped along with them
+        self._unwritten = 0  # First command not yet sent to the sink
+
+    def _intern(self, text):
+        """
+        Return the string table index for 'text', adding it if needed.
+        Repeated comments (and RAW commands) are only stored once.
+        """
+        index = self._stringIndex.get(text)
+        if index is None:
+            index = len(self._strings)
+            self._strings.append(text)
+            self._stringIndex[text] = index
+        return index
+
+    def addRecord(self, op, params, comment=None, flags=0):
+        """
+        Append one command. 'params' is an {axis: fixed-point value}
+        dict whose keys must appear in the opcode's layout; values are
+        stored in layout order so they can be rendered without lookups.
+        """
+        order = self.LAYOUTS[op][1]
+        mask = flags
+        at = len(self._values)
+        for axis in order:
+            if axis in params:
+                mask |= self.FIELD_BITS[axis]
+                self._values.append(params[axis])
+
+        self._ops.append(op)
+        self._masks.append(mask)
+        self._offsets.append(at + self._valueBase)
+        self._comments.append(-1 if comment is None else self._intern(comment))
+
+        if self._write and self._pending() >= self.chunk_lines:
+            self.flush()
+
+    def addRecords(self, op, values, flags=0, before=None):
+        """
+        Bulk version of addRecord for NumPy arrays. 'values' is an
+        (N, len(layout)) float array of fixed-point values (already
+        rounded) in the opcode's layout order, with NaN for parameters
+        a command doesn't have. 'flags' is a single value
+        or one per command. If 'before' is given, that text is stored as
+        a RAW command in front of every record.
+        """
+        order = self.LAYOUTS[op][1]
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(order))
+        flags = np.broadcast_to(np.asarray(flags, dtype=np.uint16), len(values))
+        before = None if before is None else self._intern(before)
+
+        step = self.chunk_lines if self._write else max(len(values), 1)
+        for start in range(0, len(values), step):
+            self._appendColumns(
+                op, values[start : start + step], flags[start : start + step], before
+            )
+            if self._write and self._pending() >= self.chunk_lines:
+                self.flush()
+
+    def _appendColumns(self, op, values, flags, before):
+        """
+        Pack a block of records and extend every column at once.
+        """
+        order = self.LAYOUTS[op][1]
+        bits = np.array([self.FIELD_BITS[axis] for axis in order], dtype=np.uint16)
+
+        present = ~np.isnan(values)
+        masks = (present * bits).sum(axis=1).astype(np.uint16) | flags
+        counts = present.sum(axis=1)
+        offsets = len(self._values) + self._valueBase + np.cumsum(counts) - counts
+
+        if before is None:
+            ops = np.full(len(values), op, dtype=np.uint8)
+            comments = np.full(len(values), -1, dtype=np.int32)
+        else:
+            # Interleave a RAW command in front of every record
+            ops = np.repeat(np.array([[self.RAW, op]], dtype=np.uint8), len(values), 0)
+            masks = np.stack([np.zeros_like(masks), masks], axis=1)
+            offsets = np.repeat(offsets, 2)
+            comments = np.repeat(
+                np.array([[before, -1]], dtype=np.int32), len(values), 0
+            )
+
+        columns = (
+            (self._ops, ops),
+            (self._masks, masks),
+            (self._offsets, offsets),
+            (self._comments, comments),
+            (self._values, values[present]),
+        )
+        for column, data in columns:
+            column.frombytes(
+                np.ascontiguousarray(data, dtype=column.typecode).tobytes()
+            )
+
+    def append(self, command):
+        """
+        Append an already formatted command (stored as a RAW record).
+        """
+        self._ops.append(self.RAW)
+        self._masks.append(0)
+        self._offsets.append(len(self._values) + self._valueBase)
+        self._comments.append(self._intern(command))
+
+        if self._write and self._pending() >= self.chunk_lines:
+            self.flush()
+
+    def extend(self, commands):
+        for command in commands:
+            self.append(command)
+
+    def _pending(self):
+        """
+        Streaming mode: commands not yet written that may be (none while
+        a capture() block is open).
+        """
+        return 0 if self._holds else len(self._ops) - self._unwritten
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Collects the rendered lines of every command added inside the
+        'with' block into the list it yields. Streaming is paused until
+        the block ends, so none of them are dropped before being read.
+        """
+        lines = []
+        begin = self.start + len(self._ops)
+        self._holds += 1
+        try:
+            yield lines
+            lines.extend(self.lines(begin - self.start))
+        finally:
+            self._holds -= 1
+            if self._write and self._pending() >= self.chunk_lines:
+                self.flush()
+
+    def render(self, start=0, stop=None):
+        """
+        Render commands 'start' to 'stop' as one newline-terminated string.
+        """
+        if stop is None or stop > len(self._ops):
+            stop = len(self._ops)
+        if np is not None and stop - start >= 64:
+            # Blocks of a few thousand lines keep the arrays in cache
+            return "".join(
+                [
+                    self._renderColumns(block, min(block + 4096, stop))
+                    for block in range(start, stop, 4096)
+                ]
+            )
+        return "".join([f"{line}\n" for line in self.lines(start, stop)])
+
+    def _renderColumns(self, start, stop):
+        """
+        Vectorized render. Every value in the range is formatted at once by
+        _formatFixedColumn. Each line is then a list of pieces (command word,
+        axis letters, values, comment, newline), and the characters of all
+        pieces are copied into the output in a single NumPy gather.
+        """
+        ops = np.frombuffer(self._ops[start:stop], dtype=np.uint8)
+        masks = np.frombuffer(self._masks[start:stop], dtype=np.uint16)
+        comments = np.frombuffer(self._comments[start:stop], dtype=np.int32)
+        first = self._offsets[start] - self._valueBase
+        last = len(self._values)
+        if stop < len(self._ops):
+            last = self._offsets[stop] - self._valueBase
+        values = np.array(self._values[first:last], dtype=np.int64)
+
+        # Fixed text: command words, separators, axis letters, newline, then
+        # the string table (comments and RAW commands)
+        opcodes = max(self.LAYOUTS) + 1
+        pieces = [
+            self.LAYOUTS[op][0] if op in self.LAYOUTS else "" for op in range(opcodes)
+        ]
+        pieces += [
+            self.LAYOUTS[op][2] if op in self.LAYOUTS else "" for op in range(opcodes)
+        ]
+        pieces += [f" {axis}" for axis in self.FIELDS] + ["\n"] + self._strings
+        encoded = [piece.encode() for piece in pieces]
+        lengths = np.array([len(piece) for piece in encoded], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        WORD, SEPARATOR, LETTER = 0, opcodes, 2 * opcodes
+        NEWLINE = LETTER + len(self.FIELDS)
+        STRING = NEWLINE + 1
+
+        raw = ops == self.RAW
+        commented = ~raw & (comments >= 0)
+        counts = np.array([bin(mask).count("1") for mask in range(512)])[masks & 0x1FF]
+        perLine = 2 + 2 * counts + 2 * commented
+        lineEnds = np.cumsum(perLine)
+        lineStarts = lineEnds - perLine
+
+        # Where each piece's characters come from, and how many there are
+        source = np.empty(int(lineEnds[-1]), dtype=np.int64)
+        size = np.empty(len(source), dtype=np.int64)
+
+        head = np.where(raw, STRING + comments, WORD + ops)
+        source[lineStarts] = offsets[head]
+        size[lineStarts] = lengths[head]
+        source[lineEnds - 1] = offsets[NEWLINE]
+        size[lineEnds - 1] = lengths[NEWLINE]
+
+        at = lineEnds[commented] - 3
+        separator = SEPARATOR + ops[commented]
+        source[at] = offsets[separator]
+        size[at] = lengths[separator]
+        comment = STRING + comments[commented]
+        source[at + 1] = offsets[comment]
+        size[at + 1] = lengths[comment]
+
+        text = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        if len(values):
+            owner = np.repeat(np.arange(len(ops)), counts)
+            within = np.arange(len(values)) - (np.cumsum(counts) - counts)[owner]
+
+            # Axis letter and style of every value, one opcode/mask pair at a time
+            keys = (ops.astype(np.uint32) << 16) | masks
+            valueKeys = keys[owner]
+            letters = np.empty(len(values), dtype=np.int64)
+            styles = np.empty(len(values), dtype=np.uint8)
+            for key in np.unique(keys[~raw]):
+                op, mask = int(key) >> 16, int(key) & 0xFFFF
+                keyLetters = [self.FIELDS.index(axis) for axis in self._axes(op, mask)]
+                keyStyles = self._template(op, mask)[1]
+                rows = valueKeys == key
+                letters[rows] = np.array(keyLetters)[within[rows]]
+                styles[rows] = np.array(keyStyles, dtype=np.uint8)[within[rows]]
+
+            at = lineStarts[owner] + 1 + 2 * within
+            source[at] = offsets[LETTER + letters]
+            size[at] = lengths[LETTER + letters]
+
+            chars, valueStart, valueLength = _formatFixedColumn(values, styles)
+            rowStart = len(text) + np.arange(len(values)) * chars.shape[1]
+            source[at + 1] = rowStart + valueStart
+            size[at + 1] = valueLength
+            text = np.concatenate((text, chars.ravel()))
+
+        # Copy every piece into place: output byte i comes from text[index[i]]
+        destination = np.cumsum(size) - size
+        index = np.repeat(source - destination, size)
+        index += np.arange(len(index))
+        return text[index].tobytes().decode()
+
+    def flush(self):
+        """
+        Streaming mode only: write every command not yet sent to the sink,
+        then drop everything but the last 'tail_lines' commands.
+        """
+        if self._write is None:
+            raise ValueError("flush() needs a sink to write to.")
+
+        first = self.start + self._unwritten
+        text = self.render(self._unwritten)
+        if text:
+            self._write(text)
+            if self.on_flush is not None:
+                self.on_flush(first, text)
+        self._unwritten = len(self._ops)
+        if not self._holds:
+            self._dropFront(len(self._ops) - self.tail_lines)
+
+    def _dropFront(self, count):
+        """
+        Forget the first 'count' commands, rebuilding the string table so
+        it only holds text still referenced by the remaining commands.
+        """
+        if count <= 0:
+            return
+
+        if count < len(self._ops):
+            cut = self._offsets[count] - self._valueBase
+        else:
+            cut = len(self._values)
+        del self._values[:cut]
+        self._valueBase += cut
+
+        del self._ops[:count]
+        del self._masks[:count]
+        del self._offsets[:count]
+        del self._comments[:count]
+
+        strings = self._strings
+        self._strings = []
+        self._stringIndex = {}
+        for i, index in enumerate(self._comments):
+            if index >= 0:
+                self._comments[i] = self._intern(strings[index])
+
+        self.start += count
+        self._unwritten -= count
+
+    def renderLine(self, i):
+        """
+        Format record 'i' as a line of G-code (without the newline).
+        """
+        op = self._ops[i]
+        comment = self._comments[i]
+        if op == self.RAW:
+            return self._strings[comment]
+
+        template, styles = self._template(op, self._masks[i])
+        at = self._offsets[i] - self._valueBase
+        values = self._values[at : at + len(styles)]
+        line = template.format(
+            *[self._formatValue(value, style) for value, style in zip(values, styles)]
+        )
+
+        if comment >= 0:
+            line += f"{self.LAYOUTS[op][2]}{self._strings[comment]}"
+        return line
+
+    @staticmethod
+    def _formatValue(value, style):
+        text = formatFixed(value)
+        if style == commandBuffer.WHOLE:
+            return text[:-5]
+        if style == commandBuffer.SHORT:
+            text = text.rstrip("0")
+            return text + "0" if text.endswith(".") else text
+        return text
+
+    def _template(self, op, mask):
+        """
+        The format string and value styles for a command with this
+        opcode and presence mask. Cached, since a program only uses
+        a handful of different combinations.
+        """
+        key = (op, mask)
+        cached = self._templates.get(key)
+        if cached is not None:
+            return cached
+
+        word, order, separator = self.LAYOUTS[op]
+        template = word
+        styles = []
+        for axis in self._axes(op, mask):
+            template += f" {axis}{{}}"
+            styles.append(self._style(axis, mask))
+
+        self._templates[key] = (template, tuple(styles))
+        return self._templates[key]
+
+    @classmethod
+    def _style(cls, axis, mask):
+        """
+        The format of an axis' value in a command with this mask.
+        """
+        if axis == "F" and mask & cls.F_AS_INT:
+            return cls.WHOLE
+        if axis == "F" and mask & cls.F_AS_FLOAT:
+            return cls.SHORT
+        return cls.FIXED
+
+    def _axes(self, op, mask):
+        """
+        The axes a command with this opcode and mask has, in layout order.
+        """
+        return [axis for axis in self.LAYOUTS[op][1] if mask & self.FIELD_BITS[axis]]
+
+    def lines(self, start=0, stop=None):
+        """
+        Generator over the rendered lines from 'start' up to 'stop'.
+        """
+        if stop is None or stop > len(self._ops):
+            stop = len(self._ops)
+        for i in range(start, stop):
+            yield self.renderLine(i)
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory held by the program (columns + string table).
+        """
+        columns = (self._ops, self._masks, self._offsets, self._comments, self._values)
+        size = sum(column.buffer_info()[1] * column.itemsize for column in columns)
+        return size + sum(len(text) + 49 for text in self._strings)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.renderLine(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("command index out of range")
+        return self.renderLine(index)
+
+    def __iter__(self):
+        return self.lines()
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _sinkWriter(sink):
+    """
+    Wrap a streaming sink (socket, text or binary file/pipe, raw file
+    descriptor, or a callback taking a string) in a function that
+    writes one chunk of text to it.
+    """
+    if hasattr(sink, "sendall"):
+        return lambda text: sink.sendall(text.encode())
+    if isinstance(sink, io.TextIOBase):
+        return sink.write
+    if hasattr(sink, "write"):
+        return lambda text: sink.write(text.encode())
+    if isinstance(sink, int):
+
+        def writeToDescriptor(text):
+            data = memoryview(text.encode())
+            while data:
+                data = data[os.write(sink, data) :]
+
+        return writeToDescriptor
+    if callable(sink):
+        return sink
+
+    raise TypeError(f"Can't stream G-code to a {type(sink).__name__}.")
+
+
+@functools.lru_cache(maxsize=None)
+def _sourceVersion(*filenames):
+    """
+    A short hash of the source files, part of every cached fragment's key:
+    blocks saved to disk by another version of the code aren't reused.
+    """
+    digest = hashlib.sha1()
+    for filename in sorted(set(filenames)):
+        with open(filename, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:12]
+
+
+class fragmentCache:
+    """
+    Memoized blocks of G-code (see marlinPrinter.cachedFragment), keyed on
+    a string describing everything the block depends on. The most recently
+    used 'maxsize' blocks are kept in memory (maxsize=0 turns caching off).
+    If a 'directory' is set, blocks are also saved there, one file per key,
+    so other processes (ex. sweep workers) and later runs can reuse them.
+    """
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key):
+        """
+        The lines stored for 'key', or None.
+        """
+        with self._lock:
+            lines = self._blocks.get(key)
+            if lines is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return lines
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key)) as file:
+                    stored = json.load(file)
+            except (OSError, ValueError):
+                stored = None
+            if stored is not None and stored["key"] == key:
+                lines = tuple(stored["lines"])
+                self.put(key, lines, save=False)
+                with self._lock:
+                    self.hits += 1
+                return lines
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, lines, save=True):
+        lines = tuple(lines)
+        with self._lock:
+            self._blocks[key] = lines
+            self._blocks.move_to_end(key)
+            while len(self._blocks) > self.maxsize:
+                self._blocks.popitem(last=False)
+
+        if save and self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp, "w") as file:
+                json.dump({"key": key, "lines": lines}, file)
+            os.replace(temp, path)  # Atomic, so readers never see half a file
+
+    def clear(self):
+        """
+        Empty the in-memory cache (files in 'directory' are kept).
+        """
+        with self._lock:
+            self._blocks.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by every printer that isn't given its own fragment_cache
+FRAGMENT_CACHE = fragmentCache()
+
+
+class generationProfiler:
+    """
+    Counts the calls to, and adds up the time spent in, the functions
+    that make G-code: the ones marked @marlinPrinter.profiled (every
+    move type, sanitizeCoords, writeToFile, ...) in marlinPrinter and
+    its subclasses, and building or replaying each cached fragment.
+    Times include everything called inside, so nonExtrudeMove's time
+    includes its sanitizeCoords.
+
+    The marked functions are wrapped once, when their class is made
+    (see wrap()), and the wrappers stay. While the profiler is off, a
+    wrapper only checks 'enabled' and calls straight through. enable() and
+    disable() nest, so profiling stays on until every enable() has had its
+    disable(), whichever thread or generation started it. Use the shared
+    PROFILER, ex. through profileGeneration().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}  # Name: [calls, seconds]
+        self._users = 0  # enable() calls not yet disabled
+        self._lock = threading.Lock()
+
+    def enable(self):
+        with self._lock:
+            self._users += 1
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self._users = max(self._users - 1, 0)
+            self.enabled = self._users > 0
+
+    def wrap(self, name, func):
+        """
+        'func', timed under 'name' whenever the profiler is on.
+        """
+        record = self.record
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started)
+
+        timed.profiled = name
+        return timed
+
+    def record(self, name, seconds):
+        with self._lock:
+            entry = self.stats.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def report(self):
+        """
+        One dict per function (name, calls, seconds, us_per_call),
+        the most time first.
+        """
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        return [
+            {
+                "name": name,
+                "calls": calls,
+                "seconds": seconds,
+                "us_per_call": 1e6 * seconds / calls,
+            }
+            for name, (calls, seconds) in stats
+        ]
+
+    def table(self):
+        lines = [f"{'function':<36} {'calls':>9} {'seconds':>9} {'us/call':>9}"]
+        for row in self.report():
+            lines.append(
+                f"{row['name']:<36} {row['calls']:>9} {row['seconds']:>9.4f} "
+                f"{row['us_per_call']:>9.2f}"
+            )
+        return "\n".join(lines)
+
+    def save(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+
+PROFILER = generationProfiler()
+
+
+@contextlib.contextmanager
+def profileGeneration(output=True):
+    """
+    Profiles the G-code made inside the 'with' block (see
+    generationProfiler). At the end, prints a table of where the time
+    went, or if 'output' is a filename, writes it there as JSON.
+    A false 'output' turns profiling off, for a --profile flag:
+        with profileGeneration(profile):
+            main(filename)
+    """
+    if not output:
+        yield None
+        return
+
+    if not PROFILER.enabled:  # Not inside another profileGeneration()
+        PROFILER.reset()
+    PROFILER.enable()
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.disable()
+        if isinstance(output, str):
+            PROFILER.save(output)
+        else:
+            print(PROFILER.table())
+
+
+def profileFlag(args):
+    """
+    Takes "--profile [filename.json]" out of a script's command line args.
+    Returns the other args, and the output to give profileGeneration()
+    (None without the flag).
+    """
+    if "--profile" not in args:
+        return args, None
+    args = list(args)
+    at = args.index("--profile")
+    args.pop(at)
+    if at < len(args) and args[at].endswith(".json"):
+        return args, args.pop(at)
+    return args, True
 
 
 class marlinPrinter:
@@ -38,171 +904,389 @@ class marlinPrinter:
     Y_OFFSET = 14
     Z_OFFSET = 0
 
-    def __init__(self, filename):
+    # Firmware built without ARC_SUPPORT gets arcs as G1 chords that
+    # stray at most ARC_TOLERANCE mm from them (see arcLinearizer.py)
+    ARC_SUPPORT = True
+    ARC_TOLERANCE = 0.01
+
+    # Marlin's GCODE_REPEAT_MARKERS (M808 loops, SD card printing only)
+    REPEAT_MARKERS = False
+
+    def __init__(
+        self,
+        filename,
+        sink=None,
+        chunk_lines=4096,
+        tail_lines=256,
+        machine=None,
+        fragment_cache=None,
+    ):
         """
         Creates the internal command list, captures the gcode filename to write to.
+
+        Passing a 'sink' (an open file, pipe, socket, file descriptor or a
+        callback taking a string) turns on streaming mode: commands are
+        written to the sink in chunks of 'chunk_lines' as they are made,
+        and only the last 'tail_lines' commands are kept in memory.
+
+        'machine' is an optional MachineProfile. Without one the class
+        attributes above are used. Whether arcs are linearized on the way
+        out (ARC_SUPPORT) is decided here, from the class or 'machine'.
+
+        'fragment_cache' is the fragmentCache that repeated blocks (start
+        G-code, loading the syringe, ...) are memoized in. Defaults to the
+        shared FRAGMENT_CACHE.
         """
         self.filename = filename
 
-        self.commands = []  # Create list of G-Code commands
+        # Create the G-Code program
+        self.program = commandBuffer(sink, chunk_lines, tail_lines)
+        self.applyProfile(machine)
+        if sink is not None and not self.ARC_SUPPORT:
+            self.program._write = self.arcLinearizer().writer(self.program._write)
+        self.fragments = FRAGMENT_CACHE if fragment_cache is None else fragment_cache
 
-    def sanitizeCoords(func):
+        # The modal state for checkpoints, and how many commands it has seen
+        self._state = None
+        self._followed = 0
+        self.program.on_flush = self._follow
+
+    def applyProfile(self, *profiles):
         """
-        Takes the coords dict (ex. {'X': 5, 'F': 40.1}), adjusts for the printhead
-        offset, adds decimal places to all coordinates, and limits the decimal places
-        allowed to 4.
+        Use the values of the given MachineProfile/ScanProfile objects for
+        this printer only. The class attributes are left alone, so printers
+        with different profiles can be generated side by side (in threads,
+        too). Can be called part way through a program. None is skipped.
         """
+        for profile in profiles:
+            if profile is None:
+                continue
+            for field in fields(profile):
+                setattr(self, field.name, getattr(profile, field.name))
 
-        def addDecimalPoint(self, coords):
-            """
-            GCode can have some funky issues if locations are 
-            given without decimals (ie. G1 X1 instead of G1 X1.).
-            This function checks for compatibility and fixes if/as needed.
-            """
+    def arcLinearizer(self):
+        """
+        An arcLinearizer for this printer's ARC_TOLERANCE.
+        """
+        from arcLinearizer import arcLinearizer
 
-            result = {}
+        return arcLinearizer(self.ARC_TOLERANCE)
 
-            for axis, value in coords.items():
-                if isinstance(value, int):  # if argument is an integer
-                    result[axis] = f"{value}.0"
-                elif isinstance(value, float) or isinstance(
-                    value, str
-                ):  # if argument is a float or string
-                    str_val = str(value)
-                    if (
-                        "." not in str_val
-                    ):  # if float but doesn't have a decimal point (e.g., 5.0)
-                        result[axis] = f"{value}.0"
-                    else:  # if the number is already formatted correctly
-                        result[axis] = str_val
-                else:
-                    raise Exception(
-                        "Attempted to add decimal point to an incompatible data class."
-                    )
+    @contextlib.contextmanager
+    def repeat(self, count, label="Cycle"):
+        """
+        Runs the commands made in the 'with' block 'count' times in all:
+
+            with scanner.repeat(1000):
+                scanner.loadSyringe()
+                ...
+
+        With REPEAT_MARKERS the block is written once, between
+        "M808 L<count>" and "M808", so a thousand cycles take no more
+        space than one. Otherwise it's written out 'count' times, each
+        after a "; <label> 2 of 1000" comment. The block is only made
+        once and its lines copied, and in streaming mode the copies go
+        to the sink a chunk at a time rather than all being held.
+        """
+        if count < 1:
+            raise ValueError("A block has to be repeated at least once.")
+
+        if self.REPEAT_MARKERS:
+            self.program.append(f"M808 L{count} ; {label} x{count}")
+            yield
+            self.program.append(f"M808 ; End of {label}")
+            return
+
+        self.program.append(f"; {label} 1 of {count}")
+        with self.program.capture() as lines:
+            yield
+        for cycle in range(2, count + 1):
+            self.program.append(f"; {label} {cycle} of {count}")
+            self.program.extend(lines)
+
+    @property
+    def machineProfile(self):
+        """
+        The MachineProfile this printer is currently generating with.
+        """
+        return MachineProfile.fromAttributes(self)
 
-            return result
+    @property
+    def commands(self):
+        """
+        The program as a (lazily rendered) list of G-Code command strings.
+        Supports len(), indexing, iteration, append() and extend().
+        """
+        return self.program
 
-        def adjsutForOffset(self, coords):
-            """"
-            Given a 'coords' dict (ex. {'X': 10.0, 'Y': 5.0}),
-            adjust for the head/tip/nozzle offset.
-            """
-            if coords is None:
-                return {"X": None, "Y": None, "Z": None}
+    @commands.setter
+    def commands(self, commands):
+        self.program.clear()
+        self._followed = 0
+        self.program.extend(commands)
 
-            for axis, value in coords.items():
-                if axis == "X":
-                    coords["X"] = value + marlinPrinter.X_OFFSET
-                if axis == "Y":
-                    coords["Y"] = value + marlinPrinter.Y_OFFSET
-                if axis == "Z":
-                    coords["Z"] = value + marlinPrinter.Z_OFFSET
+    def headOffset(self):
+        """
+        The printhead offset for each axis, in fixed point.
+        """
+        return {
+            "X": toFixed(self.X_OFFSET),
+            "Y": toFixed(self.Y_OFFSET),
+            "Z": toFixed(self.Z_OFFSET),
+        }
 
-            return coords
+    def profiled(func, name=None):
+        """
+        Times a G-code making function with the generationProfiler, under
+        'name' (default: the function's name). While the profiler is off,
+        this costs one check per call.
+        """
+        return PROFILER.wrap(name or func.__name__, func)
 
-        def limitDecimalPlaces(self, coords, places=4):
-            """
-            Limit the decimal places allowed in commands.
-            >>> print = GCodeGenerator("test")
-            >>> print.limitDecimalPlaces({"X": 5.00010})
-            {'X': '5.0001'}
-            >>> print.limitDecimalPlaces({"X": 5.00010, 'Y': 100.1, 'Z': '10.00000'})
-            {'X': '5.0001', 'Y': '100.1000', 'Z': '10.0000'}
-            >>> print.limitDecimalPlaces({"X": "5.00010"})
-            {'X': '5.0001'}
-            """
-            for axis, value in coords.items():
-                value = float(value)
-                coords[axis] = f"{value:.4f}"
-            return coords
+    def sanitizeCoords(func):
+        """
+        Takes the coords dict (ex. {'X': 5, 'F': 40.1}), converts every
+        value to fixed point (integer tenths of a micron, see toFixed) and
+        adjusts for the printhead offset. The decorated function gets a
+        new dict; the caller's dict is left as it was. The decorated
+        function is also profiled.
+        """
 
+        @functools.wraps(func)
         def wrapper(instance, *args, **kwargs):
             """
-            Given coords dict, adjust for offset,
-            add decimals, and return the coordinates
-            as strings. Calls helper functions with
-            these purposes.
+            Given coords dict, convert it to fixed point and
+            adjust for offset before calling the wrapped function.
             """
-            # retrive anything called 'coords' from a function's input
-            coords_arg = kwargs.get("coords", None)
-            # get all the arguments passed into a function
-            args_list = list(args)
-
-            # If no 'coords' arg found, then
-            if not coords_arg:
-                # Iterate through each argument to check for a dictionary containing position related keys
-                for i, arg in enumerate(args):
-                    if isinstance(arg, dict) and any(
-                        key in ["X", "Y", "Z", "E", "F"] for key in arg
-                    ):
-                        coords_arg = arg
-                        # Remove the found coordinates dictionary from the arguments list
-                        args = args[:i] + args[i + 1 :]  # Remove the coords from args
-                        break  # stop looking
-
-            if (
-                not coords_arg
-            ):  # Raise an error if 'coords' argument is still not found after the checks
-                raise ValueError("coords argument not found!")
-
-            coords_arg = adjsutForOffset(instance, coords_arg)
-            coords_arg = addDecimalPoint(instance, coords_arg)
-            coords_arg = limitDecimalPlaces(instance, coords_arg)
-
-            args_list[
-                i
-            ] = coords_arg  # Insert the modified coords_arg back into its original position
-            args_tuple = tuple(
-                args_list
-            )  # Convert list back to tuple (it is initially a tuple)
-
-            return func(instance, *args_tuple, **kwargs)
+            if "coords" in kwargs:
+                kwargs["coords"] = instance._sanitize(kwargs["coords"])
+                return func(instance, *args, **kwargs)
+
+            # Look for the first dictionary containing position related keys
+            args = list(args)
+            for i, arg in enumerate(args):
+                if isinstance(arg, dict) and any(
+                    key in ["X", "Y", "Z", "E", "F"] for key in arg
+                ):
+                    args[i] = instance._sanitize(arg)
+                    return func(instance, *args, **kwargs)
+
+            raise ValueError("coords argument not found!")
+
+        return PROFILER.wrap(func.__name__, wrapper)
+
+    def adjsutForOffset(self, coords):
+        """
+        Given a fixed-point 'coords' dict (ex. {'X': 100000, 'Y': 50000}),
+        adjust for the head/tip/nozzle offset.
+        """
+        offsets = self.headOffset()
+        return {axis: value + offsets.get(axis, 0) for axis, value in coords.items()}
+
+    def _sanitize(self, coords):
+        """
+        The work of sanitizeCoords (and reported under that name).
+        """
+        if not coords:
+            raise ValueError("coords argument not found!")
+        offsets = {"X": self.X_OFFSET, "Y": self.Y_OFFSET, "Z": self.Z_OFFSET}
+        fixed = {}
+        for axis, value in coords.items():
+            if axis in offsets:
+                # Offset first, then round, as f"{value + offset:.4f}" does
+                if isinstance(value, str):
+                    value = float(value)
+                value = value + offsets[axis]
+            fixed[axis] = toFixed(value)
+        return fixed
+
+    _sanitize = profiled(_sanitize, "sanitizeCoords")
+
+    def cachedFragment(func):
+        """
+        Memoizes a block of G-code that only depends on the printer's
+        settings (see _fragmentKey) and the arguments it is called with.
+        The first call runs the function and stores its lines in
+        self.fragments; later calls with the same key append the stored
+        lines as they are (RAW commands), skipping the work of making
+        and formatting them again. The key also holds a hash of this file
+        and the function's, so editing the code invalidates saved blocks.
+        """
+        version = _sourceVersion(__file__, func.__code__.co_filename)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = self.fragments
+            if not cache.maxsize:
+                return func(self, *args, **kwargs)
+
+            # repr() keeps types apart: F2000 and F2000.0 are different G-code
+            key = repr(
+                (
+                    version,
+                    type(self).__qualname__,
+                    func.__name__,
+                    self._fragmentKey(),
+                    args,
+                    sorted(kwargs.items()),
+                )
+            )
+            started = time.perf_counter() if PROFILER.enabled else None
+            lines = cache.get(key)
+            if lines is not None:
+                self.program.extend(lines)
+                if started is not None:
+                    PROFILER.record(
+                        f"{func.__name__} (cached)", time.perf_counter() - started
+                    )
+                return None
+
+            with self.program.capture() as lines:
+                result = func(self, *args, **kwargs)
+            cache.put(key, lines)
+            if started is not None:
+                PROFILER.record(
+                    f"{func.__name__} (built)", time.perf_counter() - started
+                )
+            return result
 
         return wrapper
 
+    def _fragmentKey(self):
+        """
+        Everything a cached fragment can depend on.
+        """
+        return (self.machineProfile,)
+
     def undoHeadOffset(self, coords):
         """
         Some functions need to use the true XY values instead
         of adjusting for the head offset to locate a physical
         point in space. Some examples include the doCircle function,
         which needs the center point to be constant in space, and also
-        when using the cuevette holder.
+        when using the cuevette holder. Takes and returns fixed-point values.
         """
-        for axis, value in coords.items():
-            value = float(value)
-            if axis == "X":
-                fixedX = value - marlinPrinter.X_OFFSET
-                coords["X"] = f"{fixedX:.4f}"
-            if axis == "Y":
-                fixedY = value - marlinPrinter.Y_OFFSET
-                coords["Y"] = f"{fixedY:.4f}"
+        offsets = self.headOffset()
+        return {
+            axis: value - offsets[axis] if axis in ("X", "Y") else value
+            for axis, value in coords.items()
+        }
 
-        return coords
+    def _addMove(self, op, coords, comment=None, flags=0):
+        """
+        Store a move in the program. Axes are written in the order they
+        are in 'coords', so a move whose axes aren't in the command's
+        column order (or that holds an axis with no column) is stored as
+        a plain formatted string instead.
+        """
+        layout = commandBuffer.LAYOUTS[op]
+        if list(coords) != [axis for axis in layout[1] if axis in coords]:
+            move = layout[0]
+            for axis, value in coords.items():
+                style = commandBuffer._style(axis, flags)
+                move += f" {axis}{commandBuffer._formatValue(value, style)}"
+            if comment:
+                move += f"{layout[2]}{comment}"
+            self.program.append(move.strip())
+            return
+
+        self.program.addRecord(op, coords, comment or None, flags)
+
+    def _addMoves(self, op, points, axes):
+        """
+        Store a batch of moves: 'points' is an (N, len(axes)) array,
+        one row per move, with NaN for axes a move leaves alone. Applies
+        the same head offset and default feedrate as the single-move
+        functions, using NumPy over whole columns.
+        """
+        if np is None:
+            raise ImportError("NumPy is required for batch moves.")
+
+        order = commandBuffer.LAYOUTS[op][1]
+        # Lines are written in column order, so the single-move
+        # functions only write the same with the axes in that order
+        if list(axes) != [axis for axis in order if axis in axes]:
+            raise ValueError(f"Batch moves take the axes {order}, in that order.")
+
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != len(axes):
+            raise ValueError(f"Expected an (N, {len(axes)}) array for axes {axes}.")
+        if np.isnan(points).all(axis=1).any():
+            # Like an empty coords dict for the single-move functions
+            raise ValueError("coords argument not found!")
+
+        # Adjust for the head offset and convert to fixed point, kept as
+        # whole-number floats so that NaN stays NaN
+        offsets = {"X": self.X_OFFSET, "Y": self.Y_OFFSET, "Z": self.Z_OFFSET}
+        values = np.full((len(points), len(order)), np.nan)
+        for column, axis in enumerate(axes):
+            column = points[:, column] + offsets.get(axis, 0)
+            values[:, order.index(axis)] = toFixedArray(column)
+
+        # Fill in the default feedrate, written as-is like the single moves do
+        flags = np.zeros(len(values), dtype=np.uint16)
+        feedrate = values[:, order.index("F")]
+        missing = np.isnan(feedrate)
+        if missing.any():
+            zMove = ~np.isnan(values[:, order.index("Z")])
+            for rows, zDefault in ((missing & zMove, True), (missing & ~zMove, False)):
+                default, flag = self._defaultFeedrate(
+                    op == commandBuffer.G0 and zDefault
+                )
+                feedrate[rows] = toFixed(default)
+                flags[rows] = flag
+
+        before = None
+        if op == commandBuffer.G1:
+            before = "M82; Set E to absolute positioning"
+        self.program.addRecords(op, values, flags, before)
+
+    @profiled
+    def travelMoves(self, points, axes="XYZF"):
+        """
+        Batch version of nonExtrudeMove. 'points' is an (N, len(axes))
+        NumPy array of waypoints, ex. columns X, Y, Z, F. Use NaN for an
+        axis that a move shouldn't include. Writes exactly what calling
+        nonExtrudeMove once per row would.
+        """
+        self._addMoves(commandBuffer.G0, points, axes)
+
+    @profiled
+    def extrudeMoves(self, points, axes="XYZEF"):
+        """
+        Batch version of extrudeMove. 'points' is an (N, len(axes))
+        NumPy array of waypoints, ex. columns X, Y, Z, E, F. Use NaN for
+        an axis that a move shouldn't include. Writes exactly what calling
+        extrudeMove once per row would.
+        """
+        self._addMoves(commandBuffer.G1, points, axes)
+
+    def _defaultFeedrate(self, zMove=False):
+        """
+        The feedrate used when a move doesn't give one, and the flag
+        telling the command buffer to write it exactly as Python prints it.
+        """
+        # A bare marlinPrinter has no process values of its own
+        feedrate = getattr(self, "TRAVEL_FEEDRATE", VPDScanner.TRAVEL_FEEDRATE)
+        if zMove:
+            # Decrease feedrate if changing Z.
+            feedrate = feedrate / 1.6
+
+        if isinstance(feedrate, int):
+            return feedrate, commandBuffer.F_AS_INT
+        return feedrate, commandBuffer.F_AS_FLOAT
 
     @sanitizeCoords
     def nonExtrudeMove(self, coords, comment=None):
         """
         Move the extruder without extruding. 
         """
-        move = "G0"  # base command
+        flags = 0
+        if "F" not in coords:
+            feedrate, flags = self._defaultFeedrate("Z" in coords)
+            coords = {**coords, "F": toFixed(feedrate)}
 
-        for axis, value in coords.items():
-            if axis == "F" and "Z" in coords.items():
-                # Decrease feedrate if changing Z.
-                move += f" {axis}{value/1.6}"
-            else:
-                move += f" {axis}{value}"
-
-        if "F" not in move and "Z" in move:
-            move += f" F{VPDScanner.TRAVEL_FEEDRATE / 1.6}"
-        elif "F" not in move:
-            move += f" F{VPDScanner.TRAVEL_FEEDRATE}"
-
-        if move != "G0":
-            if comment:
-                # Add comment as appropriate for G-code clarity
-                move += f" ;{comment}"
-            self.commands.append(move.strip())
+        self._addMove(commandBuffer.G0, coords, comment, flags)
 
     @sanitizeCoords
     def doCircle(self, coords, comment=None):
@@ -210,25 +1294,25 @@ class marlinPrinter:
         Moves the printehead in a complete circle around the point
         specified by the coords dictionary. The values in the 
         dictionary are the relative coordinates from the printhead
-        to the center of rotation.
+        to the center of rotation. Put 'F' in the dictionary to set
+        the feedrate.
         >>> doCircle([], {'X': 20, 'Y': 20})
         ['G2 I20.0000 J20.0000']
         """
-        if len(coords) >= 3:
+        if len(coords.keys() - {"F"}) >= 3:
             raise Exception("Passed 3 or more coordinates to the doCircle funciton.")
 
         coords = self.undoHeadOffset(coords)
-        move = "G2"
-        for axis, value in coords.items():
-            if axis == "X":
-                move += f" I{value}"
-            if axis == "Y":
-                move += f" J{value}"
+        center = {}
+        if "X" in coords:
+            center["I"] = coords["X"]
+        if "Y" in coords:
+            center["J"] = coords["Y"]
 
-        if move != "G2":
-            if comment:
-                move += f" ; {comment}"
-            self.commands.append(move.strip())
+        if center:
+            if "F" in coords:
+                center["F"] = coords["F"]
+            self._addMove(commandBuffer.G2, center, comment)
 
     @sanitizeCoords
     def doCCWArc(self, coords, center_offset, radius, theta_deg, comment=None):
@@ -237,24 +1321,37 @@ class marlinPrinter:
         the center of rot, arc radius, an angle, rotate around the center point
         theta degrees.
         """
-        move = "G3"
-        x = float(coords["X"])
-        y = float(coords["Y"])
+        x = coords["X"] / FIXED_SCALE
+        y = coords["Y"] / FIXED_SCALE
         theta_rad = math.radians(theta_deg)
 
         # Calculate the end point of the arc
         end_x = (x + center_offset[0]) + radius * math.cos(theta_rad)
         end_y = (y + center_offset[1]) + radius * math.sin(theta_rad)
 
+        arc = {}
         if "E" in coords.keys():
-            val = coords["E"]
-            move += f" E{val}"
-        move += f" I{center_offset[0]:.4f} J{center_offset[1]:.4f} X{end_x:.4f} Y{end_y:.4f}"
+            arc["E"] = coords["E"]
+        arc["I"] = toFixed(center_offset[0])
+        arc["J"] = toFixed(center_offset[1])
+        arc["X"] = toFixed(end_x)
+        arc["Y"] = toFixed(end_y)
 
-        if move != "G3":
-            if comment:
-                move += f" ; {comment}"
-            self.commands.append(move.strip())
+        self._addMove(commandBuffer.G3, arc, comment)
+
+    @sanitizeCoords
+    def doCWArc(self, coords, center_offset, comment=None):
+        """
+        Moves the printhead clockwise (G2) along an arc from where it is
+        to the X/Y point in the coords dict. center_offset is the (X, Y)
+        vector from the printhead to the center of the arc. Put 'F' in the
+        coords dict to set the feedrate.
+        """
+        arc = {axis: coords[axis] for axis in ("X", "Y", "F") if axis in coords}
+        arc["I"] = toFixed(center_offset[0])
+        arc["J"] = toFixed(center_offset[1])
+
+        self._addMove(commandBuffer.G2, arc, comment)
 
     @sanitizeCoords
     def extrudeMove(self, coords, comment=None):
@@ -264,20 +1361,14 @@ class marlinPrinter:
         'F' in the coords dict to determine the feedrate.
         """
         # self.commands.append('M83; Set E to relative positioning')
-        self.commands.append("M82; Set E to absolute positioning")
+        self.program.append("M82; Set E to absolute positioning")
 
-        coord_axes = coords.keys()
-        move = "G1"
+        flags = 0
+        if "F" not in coords:
+            feedrate, flags = self._defaultFeedrate()
+            coords = {**coords, "F": toFixed(feedrate)}
 
-        for axis, value in coords.items():
-            move += f" {axis}{value}"
-        if "F" not in move:
-            move += f" F{VPDScanner.TRAVEL_FEEDRATE}"
-
-        if move != "G1":
-            if comment:
-                move += f" ; {comment}"
-            self.commands.append(move.strip())
+        self._addMove(commandBuffer.G1, coords, comment, flags)
 
     @sanitizeCoords
     def setStepsPerUnit(self, coords):
@@ -286,54 +1377,183 @@ class marlinPrinter:
         This setting affects how many steps will be done for each 
         unit of movement.
         """
-        coord_axes = coords.keys()
-        move = "M92"
-
-        for axis, value in coords.items():
-            move += f" {axis}{value}"
-
-        if move != "M92":
-            move += " ; Set steps per unit."
-            self.commands.append(move.strip())
+        self._addMove(commandBuffer.M92, coords, "Set steps per unit.")
 
+    @profiled
     def relativePos(self):
-        self.commands.append("G91 ; Set all axes to relative")
+        self.program.append("G91 ; Set all axes to relative")
 
+    @profiled
     def absPos(self):
-        self.commands.append("G90 ; Set all axes to absolute")
+        self.program.append("G90 ; Set all axes to absolute")
 
+    @profiled
     def homeAxes(self):
-        self.commands.append("G28 ; Home all axes")
+        self.program.append("G28 ; Home all axes")
 
+    @profiled
     def wait(self, seconds=0.5):
-        self.commands.append(f"G4 S{seconds:.4f}")
+        self.program.addRecord(commandBuffer.G4, {"S": toFixed(seconds)})
 
+    @profiled
     def waitForUserInput(self):
-        self.commands.append("M0 ; Stop and wait")
+        self.program.append("M0 ; Stop and wait")
 
+    @profiled
     def waitForMovesToComplete(self):
-        self.commands.append("M400")
+        self.program.append("M400")
 
+    @profiled
     def beep(self, sec=0.2):
         """
         Beep for 'sec' seconds.
         """
         self.waitForMovesToComplete()
-        self.commands.append(f"M300 P{(sec*1000):.4f} ; Beep.")
+        self.program.addRecord(commandBuffer.M300, {"P": toFixed(sec * 1000)}, "Beep.")
 
-    def writeToFile(self):
-        """"
-        To be called at the end of the routine. Writes all
-        commands line by line to a .gcode file. Filename defined
-        when creating class instance.
+    def printerState(self):
+        """
+        The printer's modal state (a gCodeOptimizer.modalState) at the end
+        of the program so far. Only follows the commands since it was
+        first asked for (or, streaming, since CHECKPOINTS was turned on).
+        """
+        program = self.program
+        start = max(self._followed - program.start, 0)
+        return self._readState(program.lines(start), program.start + len(program))
+
+    def _follow(self, first, text):
+        """
+        Streaming mode: with checkpoints on, the modal state reads the
+        commands being written before they are dropped from memory.
+        """
+        if getattr(self, "CHECKPOINTS", False):
+            from gCodeOptimizer import splitProgram
+
+            lines = splitProgram(text)
+            end = first + len(lines)
+            self._readState(lines[max(self._followed - first, 0) :], end)
+
+    def _readState(self, lines, end):
+        if self._state is None:
+            from gCodeOptimizer import modalState
+
+            self._state = modalState()
+        if end > self._followed:
+            self._state.update(lines)
+            self._followed = end
+        return self._state
+
+    @profiled
+    def checkpoint(self, label):
+        """
+        With CHECKPOINTS on, marks a place the program can be resumed from
+        after the printer stops (see printHost.resumeProgram): an M400, so
+        the host knows every move before it is done once the printer
+        acknowledges it, with the label and the printer's modal state there
+        in its comment:
+            M400 ; CHECKPOINT ring 3 | G90 M82 X146.5000 ... E0.0500 F80
+        Does nothing with CHECKPOINTS off. Don't call it in a cachedFragment,
+        the state depends on what came before.
+        """
+        if not getattr(self, "CHECKPOINTS", False):
+            return
+        if "|" in label:
+            raise ValueError("Checkpoint labels can't contain '|'.")
+        state = self.printerState().describe()
+        self.program.append(f"M400 ; CHECKPOINT {label} | {state}")
+
+    def gcodeFilename(self):
+        """
+        The filename to write to, with the .gcode extension added if needed.
         """
         filename = self.filename
         if ".gcode" not in filename:
             filename += ".gcode"
+        return filename
 
-        with open(filename, "w") as file:
-            for command in self.commands:
-                file.write(f"{command}\n")
+    @profiled
+    def writeToFile(self, optimize=False, merge=False):
+        """
+        To be called at the end of the routine. Writes all
+        commands to a .gcode file. Filename defined
+        when creating class instance. In streaming mode, writes
+        whatever is left to the sink instead.
+
+        optimize=True removes commands that change nothing (see
+        gCodeOptimizer.py) on the way out, and returns a report of
+        what was saved. To optimize in streaming mode, wrap the sink
+        instead: sink=modalOptimizer().writer(file.write)
+
+        merge=True drops moves that go nowhere and merges straight runs
+        of moves (see moveMerger.py) first. It needs the whole program
+        at once, so it can't be used in streaming mode.
+
+        Without ARC_SUPPORT, arcs are written as G1 chords (see
+        arcLinearizer.py), before any optimizing.
+        """
+        program = self.program
+
+        if program.sink is not None:
+            if optimize:
+                raise ValueError("Streaming programs are optimized through the sink.")
+            if merge:
+                raise ValueError("Streaming programs can't be merged.")
+            program.flush()
+            if hasattr(program.sink, "flush"):
+                program.sink.flush()
+            return None
+
+        optimizer = None
+        if optimize:
+            from gCodeOptimizer import modalOptimizer
+
+            optimizer = modalOptimizer()
+        merger = None
+        if merge:
+            from moveMerger import moveMerger
+
+            merger = moveMerger()
+
+        with open(self.gcodeFilename(), "w") as file:
+            write = file.write if optimizer is None else optimizer.writer(file.write)
+            if not self.ARC_SUPPORT:
+                write = self.arcLinearizer().writer(write)
+            if merger is not None:
+                write(merger.mergeText(program.render()))
+            else:
+                for start in range(0, len(program), program.chunk_lines):
+                    write(program.render(start, start + program.chunk_lines))
+
+        reports = [r.report() for r in (merger, optimizer) if r is not None]
+        return "\n".join(reports) if reports else None
+
+
+def planRingRadii(
+    wafer_diameter, droplet_diameter, overlap=0.0, edge_gap=0.0, center_gap=0.0
+):
+    """
+    The fewest scan rings (radii, from the outside in) that leave no gap
+    between the edge exclusion and the center. A ring of radius r scans the
+    band r +/- droplet_diameter/2. The outer ring is edge_gap in from the
+    wafer edge (as in doWaferScan), the inner ring reaches center_gap (0
+    scans right across the center), and neighbouring rings share at least
+    'overlap' (a fraction) of the droplet diameter. The rings are spread
+    evenly, so the spacing between any two (also the pitch to use for a
+    spiral scan) is at most droplet_diameter * (1 - overlap).
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be at least 0 and less than 1.")
+
+    outer = wafer_diameter / 2 - edge_gap
+    inner = center_gap + droplet_diameter / 2
+    if outer <= 0:
+        raise ValueError("edge_gap leaves nothing to scan.")
+    if inner >= outer:
+        return [outer]  # One ring covers it all
+
+    spacing = droplet_diameter * (1 - overlap)
+    gaps = math.ceil(round((outer - inner) / spacing, 9))
+    return [outer - (outer - inner) * i / gaps for i in range(gaps + 1)]
 
 
 #####################################################
@@ -345,6 +1565,14 @@ class VPDScanner(marlinPrinter):
     # PROCESS VALUES (in mm unless otherwuise noted)
     TRAVEL_FEEDRATE = 2000  # Standard is 3000
     SCANNING_MOVE_FEEDRATE = 80  # Adjust as needed
+
+    # Per ring scanning feedrates (see ringFeedrate), off by default. The
+    # droplet limits haven't been measured: the speed defaults to the
+    # scanning feedrate, the only one known to hold the droplet. Measure
+    # both for your solution and surface before raising them.
+    RING_FEEDRATES = False
+    DROPLET_MAX_SPEED = SCANNING_MOVE_FEEDRATE  # mm/min, fastest in a line
+    DROPLET_MAX_ACCELERATION = 0.5  # mm/s^2, most centripetal accel. it holds
     EXTRUSION_MOTOR_FEEDRATE = 6
 
     SCAN_HEIGHT = 1.5  # How high from the z-stop should the tip be to scan?
@@ -358,6 +1586,15 @@ class VPDScanner(marlinPrinter):
     # Wafer specific global vars (in mm unless otherwuise noted)
     WAFER_DIAM = 100.0  # 4in wafer
     EDGE_GAP = 10  # How far in from the wafer edge to scan
+    SCAN_MODE = "concentric"  # or "spiral", see doWaferScan
+
+    # Ring placement from planRingRadii, off by default
+    PLAN_RINGS = False
+    RING_OVERLAP = 0.0  # Fraction of the droplet diameter neighbouring rings share
+    CENTER_GAP = 0  # Radius of the center disk that doesn't need scanning
+
+    # Resumable checkpoints after each ring etc. (see checkpoint()), off by default
+    CHECKPOINTS = False
 
     # Only adjust the paramaters below if the physical gears are modified
     RACK_TEETH_PER_CM = 6.36619
@@ -366,17 +1603,33 @@ class VPDScanner(marlinPrinter):
     SYRINGE_CAPACITY = 1.0
     SYRINGE_LENGTH = 58.0
 
-    def __init__(self, filename, sample_volume, **kwargs):
+    SCAN_MODES = ("concentric", "spiral")
+    SPIRAL_ARCS_PER_TURN = 16
+
+    def __init__(self, filename, sample_volume, scan=None, **kwargs):
         """"
         Creates a VPD scanner class object, which is a child of the
         marlinPrinter class. Filename will write the
         gcode to that file. Sample_volume defines how much liquid 
-        the system will use during the scan. Passes other kwargs to 
+        the system will use during the scan. 'scan' is an optional
+        ScanProfile (the class attributes above are used without one).
+        Passes other kwargs (such as machine=MachineProfile(...)) to
         marlinPrinter.
         """
         super().__init__(filename, **kwargs)
+        self.applyProfile(scan)
         self.sample_volume = sample_volume
 
+    @property
+    def scanProfile(self):
+        """
+        The ScanProfile this scanner is currently generating with.
+        """
+        return ScanProfile.fromAttributes(self)
+
+    def _fragmentKey(self):
+        return (self.machineProfile, self.scanProfile, self.sample_volume)
+
     def calcEFeedRate(self):
         """
         Assuming the motor has 3200 steps/rev, 
@@ -385,16 +1638,16 @@ class VPDScanner(marlinPrinter):
         words, the this function calculates the parameter such that
         '1' system unit is equal to 1mL in the syringe.
         """
-        mL = VPDScanner.SYRINGE_CAPACITY
-        mm = VPDScanner.SYRINGE_LENGTH
+        mL = self.SYRINGE_CAPACITY
+        mm = self.SYRINGE_LENGTH
 
         stepsPerRotation = 3200
         stepsPerDeg = stepsPerRotation / 360
 
-        gearTeeth = VPDScanner.GEAR_TEETH
+        gearTeeth = self.GEAR_TEETH
         gearTeethPerDegree = gearTeeth / 360
 
-        rackTeethPerCm = VPDScanner.RACK_TEETH_PER_CM
+        rackTeethPerCm = self.RACK_TEETH_PER_CM
 
         mLPerMM = mL / mm
         mLPerRackTooth = (mLPerMM * 10) / rackTeethPerCm
@@ -406,6 +1659,7 @@ class VPDScanner(marlinPrinter):
 
         return stepsPerML
 
+    @marlinPrinter.cachedFragment
     def startGCode(self):
         """
         Housekeeping -- mainly homes and then moves up.
@@ -446,6 +1700,7 @@ class VPDScanner(marlinPrinter):
         y = float(coords["Y"])
         return (xPoint - x, yPoint - y)
 
+    @marlinPrinter.profiled
     def collectSample(self, volume=None):
         """"
         Assume needle tip is in location where ready to 
@@ -455,16 +1710,17 @@ class VPDScanner(marlinPrinter):
             volume = self.sample_volume
 
         self.extrudeMove(
-            {"E": self.SYRINGE_CAPACITY, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE}
+            {"E": self.SYRINGE_CAPACITY, "F": self.EXTRUSION_MOTOR_FEEDRATE}
         )
         self.wait()
-        self.extrudeMove({"E": 0, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE / 2})
+        self.extrudeMove({"E": 0, "F": self.EXTRUSION_MOTOR_FEEDRATE / 2})
         self.wait()
         self.extrudeMove(
-            {"E": self.SYRINGE_CAPACITY, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE}
+            {"E": self.SYRINGE_CAPACITY, "F": self.EXTRUSION_MOTOR_FEEDRATE}
         )
         self.wait()
 
+    @marlinPrinter.profiled
     def dispenseSample(self, volume=None):
         """"
         Assume needle tip is in location where ready to 
@@ -473,15 +1729,16 @@ class VPDScanner(marlinPrinter):
         if not volume:
             volume = self.sample_volume
 
-        self.extrudeMove({"E": 0, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE})
+        self.extrudeMove({"E": 0, "F": self.EXTRUSION_MOTOR_FEEDRATE})
         self.wait()
         self.extrudeMove(
-            {"E": volume / 2, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE / 2}
+            {"E": volume / 2, "F": self.EXTRUSION_MOTOR_FEEDRATE / 2}
         )
         self.wait()
-        self.extrudeMove({"E": 0, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE / 2})
+        self.extrudeMove({"E": 0, "F": self.EXTRUSION_MOTOR_FEEDRATE / 2})
         self.wait()
 
+    @marlinPrinter.profiled
     def useCuevette(self, dispense: bool):
         """
         If dispense is true, will dispense sample. Otherwise 
@@ -490,132 +1747,322 @@ class VPDScanner(marlinPrinter):
         and deposit the scanned droplet. At the end, move the needle 
         up to clear it out of the way.
         """
+        self._cuevetteMoves(dispense)
+        self.checkpoint("dispensed" if dispense else "collected")
+
+    @marlinPrinter.cachedFragment
+    def _cuevetteMoves(self, dispense):
         # move up
-        self.nonExtrudeMove({"Z": VPDScanner.TRAVEL_HEIGHT})
+        self.nonExtrudeMove({"Z": self.TRAVEL_HEIGHT})
         # move over cuevette
         self.nonExtrudeMove(
             {
-                "X": VPDScanner.CUEVETTE_X - marlinPrinter.X_OFFSET,
-                "Y": VPDScanner.CUEVETTE_Y - marlinPrinter.Y_OFFSET,
+                "X": self.CUEVETTE_X - self.X_OFFSET,
+                "Y": self.CUEVETTE_Y - self.Y_OFFSET,
             }
         )
         # Go in to the cuevette
-        self.nonExtrudeMove({"Z": VPDScanner.CUEVETTE_Z})
+        self.nonExtrudeMove({"Z": self.CUEVETTE_Z})
         if dispense:
             self.dispenseSample()
         else:
             self.collectSample()
         # Go back up
-        self.nonExtrudeMove({"Z": VPDScanner.TRAVEL_HEIGHT})
+        self.nonExtrudeMove({"Z": self.TRAVEL_HEIGHT})
 
+    @marlinPrinter.profiled
     def centerHead(self):
         """"
         Center the head (XY) over the center of the wafer.
-        This function assumes the xOffset & marlinPrinter.Y_OFFSET have been set correctly
+        This function assumes the X_OFFSET & Y_OFFSET have been set correctly
         such that the syringe tip will be over the XY center of the build area.
         """
         self.nonExtrudeMove(
-            {"X": (marlinPrinter.X_MAX / 2), "Y": (marlinPrinter.Y_MAX) / 2},
+            {"X": (self.X_MAX / 2), "Y": (self.Y_MAX) / 2},
             "CENTER HEAD",
         )
 
-    def doWaferScan(self):
+    @marlinPrinter.profiled
+    def doWaferScan(self, mode=None):
         """
         Centers the head over the wafer, moves tip back up.
-        Moves the head to the start of the rotation, and scans 
-        the wafer in concentric circles.
+        Moves the head to the start of the rotation, and scans
+        the wafer in concentric circles, or along a spiral if mode
+        (default: SCAN_MODE) is "spiral". Returns the scanned area.
+        With CHECKPOINTS on, writes a checkpoint after every ring.
         """
+        mode = mode or self.SCAN_MODE
+        if mode not in self.SCAN_MODES:
+            raise ValueError(
+                f"Unknown scan mode {mode!r}, use one of {self.SCAN_MODES}."
+            )
+
         # Calculate the furthest point out from center (radially)
-        max_radius = (VPDScanner.WAFER_DIAM / 2) - VPDScanner.EDGE_GAP
+        max_radius = (self.WAFER_DIAM / 2) - self.EDGE_GAP
         min_radius = max_radius # Used to calculate scanned area
-        # Divide the radius into smaller arcs to be scanned (thin cylinders radially)
-        max_rotations = math.floor(max_radius / VPDScanner.DROPLET_DIAMETER)
+        radii = self.scanRadii()
 
         self.centerHead()
-        self.nonExtrudeMove({"Z": VPDScanner.SCAN_HEIGHT})
+        self.nonExtrudeMove({"Z": self.SCAN_HEIGHT})
         self.nonExtrudeMove(
             {
-                "X": (marlinPrinter.X_MAX / 2) + max_radius,
-                "F": VPDScanner.TRAVEL_FEEDRATE,
+                "X": (self.X_MAX / 2) + max_radius,
+                "F": self.TRAVEL_FEEDRATE,
             },
             "Move to max radius",
         )
         # Dispense the sample at the max radius
-        self.extrudeMove({"E": 0, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE})
-
-        rotation_count = 0
-        current_offset = max_radius - (rotation_count * VPDScanner.DROPLET_DIAMETER)
-        while rotation_count < max_rotations:
-            # Calculate the current scan radius (from center)
-            current_offset = max_radius - (rotation_count * VPDScanner.DROPLET_DIAMETER)
-
-            self.nonExtrudeMove(
-                {
-                    "X": (marlinPrinter.X_MAX / 2) + current_offset,
-                    "F": VPDScanner.SCANNING_MOVE_FEEDRATE,
-                },
-                "Move needle in.",
-            )
-
-            # Calculate relative location & move the head in a circle around the wafer center
-            xRel, yRel = self.calcRelPos(
-                {
-                    "X": (marlinPrinter.X_MAX / 2) + current_offset,
-                    "Y": marlinPrinter.Y_MAX / 2,
-                },
-                (marlinPrinter.X_MAX / 2),
-                (marlinPrinter.Y_MAX / 2),
-            )
-            self.doCircle({"X": xRel, "Y": yRel})
+        self.extrudeMove({"E": 0, "F": self.EXTRUSION_MOTOR_FEEDRATE})
 
+        if mode == "spiral":
+            current_offset = radii[-1]
+            pitch = radii[0] - radii[1] if len(radii) > 1 else None
+            xRel, yRel = self._spiralScan(max_radius, current_offset, pitch)
             min_radius = current_offset
-
-            rotation_count += 1
+            self.checkpoint("spiral")
+        else:
+            for ring, current_offset in enumerate(radii, 1):
+                self.nonExtrudeMove(
+                    {
+                        "X": (self.X_MAX / 2) + current_offset,
+                        "F": self.SCANNING_MOVE_FEEDRATE,
+                    },
+                    "Move needle in.",
+                )
+
+                # Calculate relative location & move the head in a circle around the wafer center
+                xRel, yRel = self.calcRelPos(
+                    {
+                        "X": (self.X_MAX / 2) + current_offset,
+                        "Y": self.Y_MAX / 2,
+                    },
+                    (self.X_MAX / 2),
+                    (self.Y_MAX / 2),
+                )
+                circle = {"X": xRel, "Y": yRel}
+                if self.RING_FEEDRATES:
+                    circle["F"] = self.ringFeedrate(current_offset)
+                self.doCircle(circle)
+                self.checkpoint(f"ring {ring}")
+
+                min_radius = current_offset
 
         # Drop the head down a little bit to pick up the drop better
         self.nonExtrudeMove(
             {
-                "Z": VPDScanner.SCAN_HEIGHT - 0.5,
-                "F": VPDScanner.SCANNING_MOVE_FEEDRATE * 2,
+                "Z": self.SCAN_HEIGHT - 0.5,
+                "F": self.SCANNING_MOVE_FEEDRATE * 2,
             }
         )
 
-        # Rotate backwards in an arc, picking up the drop
+        # Rotate backwards in an arc, picking up the drop, to 60 degrees
+        # past where the scan ended (+X of the center, or -X after a spiral)
         self.doCCWArc(
             {
-                "X": (marlinPrinter.X_MAX / 2) + current_offset,
-                "Y": marlinPrinter.Y_MAX / 2,
+                "X": (self.X_MAX / 2) - xRel,
+                "Y": (self.Y_MAX / 2) - yRel,
                 "E": self.SYRINGE_CAPACITY,
             },
             (xRel, yRel),
             current_offset,
-            60,
+            math.degrees(math.atan2(-yRel, -xRel)) + 60,
             "arc",
         )
 
+        area = (math.pi * max_radius**2) - (math.pi * min_radius**2)
         print(f"Scanned from radius {max_radius} to {min_radius}.")
         print(f"Droplet diameter: {self.DROPLET_DIAMETER}mm.")
-        print(f"Scanned area: {(math.pi * max_radius**2) - (math.pi * min_radius**2):.1f} mm^2")
+        print(f"Scanned area: {area:.1f} mm^2")
+        return area
+
+    def _spiralScan(self, max_radius, min_radius, pitch=None):
+        """
+        Scans from max_radius in to min_radius along an Archimedean spiral
+        that moves 'pitch' (default: DROPLET_DIAMETER) in every turn, then
+        once around the circle at min_radius. The first turn only moves in
+        half a pitch, so the droplet still reaches max_radius all the way
+        around it (the circle a concentric scan starts with). The spiral is
+        written as a chain of clockwise arcs (SPIRAL_ARCS_PER_TURN per
+        turn), each following the spiral's curvature at its middle, all at
+        SCANNING_MOVE_FEEDRATE (or each at its ringFeedrate), so the head
+        never stops between turns.
+        Assumes the head starts at max_radius, directly +X of the center.
+        Returns the vector from the head to the center at the end (the
+        spiral usually ends -X of the center).
+        """
+        xCenter, yCenter = self.X_MAX / 2, self.Y_MAX / 2
+        pitch = (pitch or self.DROPLET_DIAMETER) / (2 * math.pi)  # Per radian
+        turn = 2 * math.pi
+
+        def radius(angle):
+            # Half the pitch for the first turn, the whole pitch after it
+            return max_radius - pitch * (angle - min(angle, turn) / 2)
+
+        def point(angle):
+            x = xCenter + radius(angle) * math.cos(angle)
+            return (x, yCenter - radius(angle) * math.sin(angle))
+
+        # Total angle, in radians
+        if max_radius - min_radius <= pitch * math.pi:
+            sweep = 2 * (max_radius - min_radius) / pitch
+        else:
+            sweep = (max_radius - min_radius) / pitch + math.pi
+        # The first turn on its own, so no arc straddles the change of pitch
+        first = min(sweep, turn)
+        arcs = math.ceil(round(first / turn, 9) * self.SPIRAL_ARCS_PER_TURN)
+        angles = [first * i / arcs for i in range(1, arcs + 1)]
+        arcs = math.ceil(round((sweep - first) / turn, 9) * self.SPIRAL_ARCS_PER_TURN)
+        angles += [first + (sweep - first) * i / arcs for i in range(1, arcs + 1)]
+
+        start, previous = point(0), 0
+        feedrate = None
+        for angle in angles:
+            end = point(angle)
+
+            # Radius of curvature of the spiral halfway along this arc
+            middle = (previous + angle) / 2
+            slope = pitch / 2 if middle < turn else pitch
+            r = radius(middle)
+            curvature = (r**2 + 2 * slope**2) / (r**2 + slope**2) ** 1.5
+
+            # Center: on the chord's perpendicular bisector, to the right
+            chord = math.dist(start, end)
+            height = math.sqrt(max(1 / curvature**2 - (chord / 2) ** 2, 0))
+            xRight, yRight = (end[1] - start[1]) / chord, (start[0] - end[0]) / chord
+            xArc = (start[0] + end[0]) / 2 + xRight * height
+            yArc = (start[1] + end[1]) / 2 + yRight * height
+
+            coords = {"X": end[0], "Y": end[1]}
+            if self.ringFeedrate(r) != feedrate:
+                feedrate = coords["F"] = self.ringFeedrate(r)
+            self.doCWArc(coords, (xArc - start[0], yArc - start[1]))
+            start, previous = end, angle
+
+        xRel, yRel = self.calcRelPos({"X": start[0], "Y": start[1]}, xCenter, yCenter)
+        circle = {"X": xRel, "Y": yRel}
+        if self.ringFeedrate(min_radius) != feedrate:
+            circle["F"] = self.ringFeedrate(min_radius)
+        self.doCircle(circle)
+        return xRel, yRel
+
+    def scanRadii(self):
+        """
+        The radius of every scan ring, from the outside in. The first ring
+        is always EDGE_GAP in from the wafer edge. With PLAN_RINGS on, the
+        rings come from planRingRadii (RING_OVERLAP, CENTER_GAP); otherwise
+        they are one DROPLET_DIAMETER apart, as many as fit.
+        """
+        max_radius = (self.WAFER_DIAM / 2) - self.EDGE_GAP
+        if self.PLAN_RINGS:
+            return planRingRadii(
+                self.WAFER_DIAM,
+                self.DROPLET_DIAMETER,
+                self.RING_OVERLAP,
+                self.EDGE_GAP,
+                self.CENTER_GAP,
+            )
+
+        # Divide the radius into smaller arcs to be scanned (thin cylinders radially)
+        max_rotations = math.floor(max_radius / self.DROPLET_DIAMETER)
+        return [
+            max_radius - (rotation_count * self.DROPLET_DIAMETER)
+            for rotation_count in range(max_rotations)
+        ]
+
+    def ringFeedrate(self, radius):
+        """
+        The scanning feedrate (mm/min) for a ring of this radius. With
+        RING_FEEDRATES on, that is as fast as the droplet can be dragged
+        around the ring without losing it: no faster than
+        DROPLET_MAX_SPEED, and slow enough that the centripetal
+        acceleration v^2/r stays under DROPLET_MAX_ACCELERATION. Small
+        rings are limited by the acceleration, large ones by the speed.
+        Otherwise every ring runs at SCANNING_MOVE_FEEDRATE.
+        """
+        if not self.RING_FEEDRATES:
+            return self.SCANNING_MOVE_FEEDRATE
+        centripetal = math.sqrt(self.DROPLET_MAX_ACCELERATION * radius) * 60
+        return round(min(self.DROPLET_MAX_SPEED, centripetal), 1)
+
+    def compareScans(self, variants):
+        """
+        Generates doWaferScan for each variant of this scanner's settings,
+        without adding it to the program, and prints the scanned area and
+        estimated time of each side by side. 'variants' is a dict of
+        {label: {ScanProfile field: value}}, ex.
+            {"concentric": {}, "spiral": {"SCAN_MODE": "spiral"}}
+        Returns {label: (area in mm^2, estimated seconds)}. The time saved
+        with RING_FEEDRATES only holds if the droplet limits it is given
+        (DROPLET_MAX_SPEED, DROPLET_MAX_ACCELERATION) are measured ones.
+        Needs NumPy (for motionEstimator).
+        """
+        from motionEstimator import estimateTime, formatDuration
+
+        results = {}
+        for label, changes in variants.items():
+            scratch = VPDScanner(
+                None,
+                self.sample_volume,
+                machine=self.machineProfile,
+                scan=replace(self.scanProfile, **changes),
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                area = scratch.doWaferScan()
+            results[label] = (area, estimateTime(scratch.program.render()).total)
+
+        width = max(len(label) for label in results) + 2
+        baseline = next(iter(results.values()))[1]
+        print(f"{'':<{width}}{'Area (mm^2)':>14}{'Est. time':>14}{'Saved':>9}")
+        for label, (area, seconds) in results.items():
+            saved = 100 * (1 - seconds / baseline) if baseline else 0
+            print(
+                f"{label:<{width}}{area:>14.1f}{formatDuration(seconds):>14}"
+                f"{saved:>8.1f}%"
+            )
+        ringFeedrates = [
+            label
+            for label, changes in variants.items()
+            if changes.get("RING_FEEDRATES", self.RING_FEEDRATES)
+        ]
+        if ringFeedrates:
+            print(
+                f"Ring feedrates ({', '.join(ringFeedrates)}) assume the droplet "
+                f"follows at up to {self.DROPLET_MAX_SPEED} mm/min and "
+                f"{self.DROPLET_MAX_ACCELERATION} mm/s^2: the time saved depends "
+                "on measuring those limits."
+            )
+        return results
 
+    def compareScanModes(self, modes=None):
+        """
+        compareScans for each scan mode (default: all of SCAN_MODES).
+        """
+        return self.compareScans(
+            {mode: {"SCAN_MODE": mode} for mode in modes or self.SCAN_MODES}
+        )
+
+
+    @marlinPrinter.cachedFragment
     def loadSyringe(self):
         """
         At the start of any given cycle, ready the system so 
         that a full syringe may be loaded in. Only opens the 
         syringe to the sample volume.
         """
-        self.nonExtrudeMove({"Z": VPDScanner.TRAVEL_HEIGHT})
+        self.nonExtrudeMove({"Z": self.TRAVEL_HEIGHT})
         self.centerHead()
         self.extrudeMove(
-            {"E": self.SYRINGE_CAPACITY / 5, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE},
+            {"E": self.SYRINGE_CAPACITY / 5, "F": self.EXTRUSION_MOTOR_FEEDRATE},
             "Open syringe holder.",
         )
         self.extrudeMove(
-            {"E": self.sample_volume, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE},
+            {"E": self.sample_volume, "F": self.EXTRUSION_MOTOR_FEEDRATE},
             "Open syringe holder.",
         )
         self.beep()
         self.waitForUserInput()
 
+    @marlinPrinter.cachedFragment
     def unloadSyringe(self):
         """
         At the start of any given cycle, ready the system so 
@@ -623,19 +2070,20 @@ class VPDScanner(marlinPrinter):
         unloaded. The system will open the syringe to it's full
         capacity to facilitate removal.
         """
-        self.nonExtrudeMove({"Z": VPDScanner.TRAVEL_HEIGHT})
+        self.nonExtrudeMove({"Z": self.TRAVEL_HEIGHT})
         self.centerHead()
         self.extrudeMove(
-            {"E": self.SYRINGE_CAPACITY, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE},
+            {"E": self.SYRINGE_CAPACITY, "F": self.EXTRUSION_MOTOR_FEEDRATE},
             "Open syringe holder.",
         )
         self.beep()
         self.waitForUserInput()
         self.extrudeMove(
-            {"E": 0, "F": VPDScanner.EXTRUSION_MOTOR_FEEDRATE},
+            {"E": 0, "F": self.EXTRUSION_MOTOR_FEEDRATE},
             "Close syringe holder so it is ready for the next cycle.",
         )
 
+    @marlinPrinter.cachedFragment
     def endGCode(self):
         """
         End G-Code raizes the Z axis and presents the wafer.
@@ -645,5 +2093,93 @@ class VPDScanner(marlinPrinter):
         self.absPos()
         # Using 'commands.append' here avoids the adjustments for head offset, which are unnecesary here
         self.commands.append(
-            f"G0 X0.0000 Y{marlinPrinter.Y_MAX} F{VPDScanner.TRAVEL_FEEDRATE} ;Present print."
+            f"G0 X0.0000 Y{self.Y_MAX} F{self.TRAVEL_FEEDRATE} ;Present print."
         )
+
+
+#####################################################
+################### BEGIN PROFILES ##################
+#####################################################
+
+
+@dataclass(frozen=True)
+class MachineProfile:
+    """
+    The printer's build volume, printhead offset and firmware features,
+    as an immutable (and hashable) object. Field names match the marlinPrinter class
+    attributes, which are the defaults. Pass to marlinPrinter/VPDScanner
+    as machine=..., and use dataclasses.replace() to make variants.
+    """
+
+    X_MAX: float = marlinPrinter.X_MAX
+    Y_MAX: float = marlinPrinter.Y_MAX
+    Z_MAX: float = marlinPrinter.Z_MAX
+
+    X_OFFSET: float = marlinPrinter.X_OFFSET
+    Y_OFFSET: float = marlinPrinter.Y_OFFSET
+    Z_OFFSET: float = marlinPrinter.Z_OFFSET
+
+    ARC_SUPPORT: bool = marlinPrinter.ARC_SUPPORT
+    ARC_TOLERANCE: float = marlinPrinter.ARC_TOLERANCE
+    REPEAT_MARKERS: bool = marlinPrinter.REPEAT_MARKERS
+
+    @classmethod
+    def fromAttributes(cls, source):
+        """
+        Snapshot the values of a class or object, e.g.
+        MachineProfile.fromAttributes(marlinPrinter) picks up
+        any changes a script made to the class attributes.
+        """
+        return cls(**{field.name: getattr(source, field.name) for field in fields(cls)})
+
+
+@dataclass(frozen=True)
+class ScanProfile:
+    """
+    The VPDScanner process values, as an immutable (and hashable) object.
+    Field names match the VPDScanner class attributes, which are the
+    defaults. Pass to VPDScanner as scan=...
+
+    Values are written to the G-code as given, so keep ints as ints
+    (TRAVEL_FEEDRATE=2000 writes F2000, 2000.0 writes F2000.0).
+    """
+
+    TRAVEL_FEEDRATE: float = VPDScanner.TRAVEL_FEEDRATE
+    SCANNING_MOVE_FEEDRATE: float = VPDScanner.SCANNING_MOVE_FEEDRATE
+
+    RING_FEEDRATES: bool = VPDScanner.RING_FEEDRATES
+    DROPLET_MAX_SPEED: float = VPDScanner.DROPLET_MAX_SPEED
+    DROPLET_MAX_ACCELERATION: float = VPDScanner.DROPLET_MAX_ACCELERATION
+    EXTRUSION_MOTOR_FEEDRATE: float = VPDScanner.EXTRUSION_MOTOR_FEEDRATE
+
+    SCAN_HEIGHT: float = VPDScanner.SCAN_HEIGHT
+    TRAVEL_HEIGHT: float = VPDScanner.TRAVEL_HEIGHT
+    DROPLET_DIAMETER: float = VPDScanner.DROPLET_DIAMETER
+
+    CUEVETTE_X: float = VPDScanner.CUEVETTE_X
+    CUEVETTE_Y: float = VPDScanner.CUEVETTE_Y
+    CUEVETTE_Z: float = VPDScanner.CUEVETTE_Z
+
+    WAFER_DIAM: float = VPDScanner.WAFER_DIAM
+    EDGE_GAP: float = VPDScanner.EDGE_GAP
+    SCAN_MODE: str = VPDScanner.SCAN_MODE
+
+    PLAN_RINGS: bool = VPDScanner.PLAN_RINGS
+    RING_OVERLAP: float = VPDScanner.RING_OVERLAP
+    CENTER_GAP: float = VPDScanner.CENTER_GAP
+
+    CHECKPOINTS: bool = VPDScanner.CHECKPOINTS
+
+    RACK_TEETH_PER_CM: float = VPDScanner.RACK_TEETH_PER_CM
+    GEAR_TEETH: int = VPDScanner.GEAR_TEETH
+
+    SYRINGE_CAPACITY: float = VPDScanner.SYRINGE_CAPACITY
+    SYRINGE_LENGTH: float = VPDScanner.SYRINGE_LENGTH
+
+    @classmethod
+    def fromAttributes(cls, source):
+        """
+        Snapshot the values of a class or object,
+        e.g. ScanProfile.fromAttributes(VPDScanner).
+        """
+        return cls(**{field.name: getattr(source, field.name) for field in fields(cls)})
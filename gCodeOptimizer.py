@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+gCodeOptimizer.py removes G-code commands that don't change anything:
+positioning mode changes (G90/G91, M82/M83) when the printer is
+already in that mode, and feedrates (F) on moves that are already
+running at that feedrate.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python gCodeOptimizer.py input.gcode [output.gcode]
+"""
+
+import re
+import sys
+
+MOVES = {"G0", "G1", "G2", "G3"}
+MACROS = {f"M{number}" for number in range(810, 820)}  # Marlin's GCODE_MACROS
+
+# Commands known not to change the positioning modes or the feedrate
+# (G28 saves and restores the feedrate). Anything not listed here makes
+# the optimizer forget what it knows, so it never drops the wrong thing.
+NEUTRAL = {
+    "G4",
+    "G21",
+    "G28",
+    "G92",
+    "M0",
+    "M1",
+    "M18",
+    "M84",
+    "M92",
+    "M117",
+    "M201",
+    "M203",
+    "M204",
+    "M205",
+    "M300",
+    "M302",
+    "M400",
+}
+
+_F_PARAM = re.compile(r" F[-+.0-9]+")
+
+
+def splitProgram(text):
+    """
+    The lines of a program, split the way gCodeParser.parseProgram
+    numbers them: only at '\n' (and '\r\n'), not at the form feeds and
+    other characters str.splitlines() also breaks at, which can turn
+    the end of a comment into a line of its own. A newline at the end
+    doesn't start another line.
+    """
+    lines = text.replace("\r\n", "\n").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def splitLine(line):
+    """
+    Split a line of G-code into (command word, {letter: value}, code).
+    'code' is the part before any comment. Returns (None, {}, code) for
+    blank and comment-only lines, and a params dict of None if a
+    parameter isn't a plain number.
+    """
+    code = line.split(";", 1)[0]
+    tokens = code.split()
+    if not tokens:
+        return None, {}, code
+
+    params = {}
+    for token in tokens[1:]:
+        try:
+            params[token[0].upper()] = float(token[1:])
+        except (ValueError, IndexError):
+            return tokens[0].upper(), None, code
+    return tokens[0].upper(), params, code
+
+
+class modalOptimizer:
+    """
+    A peephole pass that tracks Marlin's modal state and drops:
+        - G90/G91 when all axes are already in that mode
+          (in Marlin, G90/G91 also set the E axis mode),
+        - M82/M83 when E is already in that mode,
+        - F on a G0/G1/G2/G3 already at that feedrate (a move left with
+          nothing to do is dropped entirely).
+
+    Marlin shares one feedrate between G0 and G1 (unless built with
+    VARIABLE_G0_FEEDRATE), which is what this assumes.
+
+    Nothing is assumed about the state at the start of the program, so
+    lines are only dropped once the program itself has set the state.
+    The optimizer keeps its state between calls, so a program can be fed
+    to it in chunks (see writer()).
+    """
+
+    def __init__(self):
+        self.relative = None  # X/Y/Z relative (G91)?  None = unknown
+        self.relativeE = None  # E relative (M83)?
+        self.feedrate = None
+
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped = {"positioning mode": 0, "extruder mode": 0, "feedrate": 0}
+
+    def optimizeLine(self, line):
+        """
+        The line as it should be written, or None to drop it.
+        """
+        self.lines_in += 1
+        self.bytes_in += len(line) + 1
+        line = self._optimize(line)
+        if line is not None:
+            self.lines_out += 1
+            self.bytes_out += len(line) + 1
+        return line
+
+    def _optimize(self, line):
+        word, params, code = splitLine(line)
+        if word is None:
+            return line
+        if params is None:
+            self._forget()
+            return line
+
+        if word in ("G90", "G91"):
+            relative = word == "G91"
+            if self.relative == relative and self.relativeE == relative:
+                self.dropped["positioning mode"] += 1
+                return None
+            self.relative = self.relativeE = relative
+        elif word in ("M82", "M83"):
+            relative = word == "M83"
+            if self.relativeE == relative:
+                self.dropped["extruder mode"] += 1
+                return None
+            self.relativeE = relative
+        elif word in MOVES:
+            if "F" in params:
+                if params["F"] == self.feedrate:
+                    self.dropped["feedrate"] += 1
+                    if len(params) == 1:
+                        return None  # A move with nothing but F
+                    return _F_PARAM.sub("", code, count=1) + line[len(code) :]
+                self.feedrate = params["F"]
+        elif word not in NEUTRAL:
+            self._forget()
+        return line
+
+    def _forget(self):
+        self.relative = self.relativeE = self.feedrate = None
+
+    def optimize(self, lines):
+        """
+        Generator over the optimized lines (without newlines).
+        """
+        for line in lines:
+            line = self.optimizeLine(line)
+            if line is not None:
+                yield line
+
+    def optimizeText(self, text):
+        """
+        Optimize a block of newline-terminated lines.
+        """
+        return "".join([f"{line}\n" for line in self.optimize(splitProgram(text))])
+
+    def writer(self, write):
+        """
+        Wrap a function that writes text (ex. file.write) so that every
+        chunk is optimized first. Can be used as a streaming sink:
+            VPDScanner(..., sink=modalOptimizer().writer(file.write))
+        """
+        return lambda text: write(self.optimizeText(text))
+
+    def report(self):
+        saved_lines = self.lines_in - self.lines_out
+        saved_bytes = self.bytes_in - self.bytes_out
+        percent = 100 * saved_bytes / self.bytes_in if self.bytes_in else 0
+        dropped = ", ".join(f"{count} {kind}" for kind, count in self.dropped.items())
+        return (
+            f"Removed {saved_lines} of {self.lines_in} lines and {saved_bytes} of "
+            f"{self.bytes_in} bytes ({percent:.1f}%). Dropped: {dropped}."
+        )
+
+
+class modalState:
+    """
+    Follows the printer's modal state through a program, which can be
+    fed to it in chunks: the positioning modes, where each axis is and
+    the feedrate. Anything the program hasn't set yet is None. Like the
+    optimizer, it forgets everything at a command it doesn't know.
+
+    describe() writes the state as G-code words, ex.
+    "G90 M82 X146.5000 Y131.5000 Z1.5000 E0.0500 F80", which is how
+    checkpoints carry it (see marlinPrinter.checkpoint), and
+    fromDescription() reads it back.
+    """
+
+    AXES = "XYZE"
+
+    def __init__(self):
+        self.relative = None  # X/Y/Z relative (G91)?
+        self.relativeE = None  # E relative (M83)?
+        self.position = dict.fromkeys(self.AXES)
+        self.feedrate = None
+
+    def update(self, lines):
+        for line in lines:
+            word, params, code = splitLine(line)
+            if word is None:
+                continue
+            if params is None:
+                self._forget()
+            elif word in ("G90", "G91"):
+                self.relative = self.relativeE = word == "G91"
+            elif word in ("M82", "M83"):
+                self.relativeE = word == "M83"
+            elif word in MOVES:
+                self.feedrate = params.get("F", self.feedrate)
+                for axis in self.AXES:
+                    if axis in params:
+                        self._move(axis, params[axis])
+            elif word in ("G28", "G92"):
+                # G28 homes the axes given (or all but E) to 0
+                axes = [axis for axis in self.AXES if axis in params]
+                if not axes:
+                    axes = self.AXES if word == "G92" else self.AXES[:3]
+                for axis in axes:
+                    self.position[axis] = (
+                        params.get(axis, 0.0) if word == "G92" else 0.0
+                    )
+            elif word not in NEUTRAL:
+                self._forget()
+        return self
+
+    def _move(self, axis, value):
+        relative = self.relativeE if axis == "E" else self.relative
+        if relative is None or (relative and self.position[axis] is None):
+            self.position[axis] = None
+        else:
+            self.position[axis] = value + (self.position[axis] if relative else 0)
+
+    def _forget(self):
+        self.__init__()
+
+    def describe(self):
+        words = []
+        if self.relative is not None:
+            words.append("G91" if self.relative else "G90")
+        if self.relativeE is not None:
+            words.append("M83" if self.relativeE else "M82")
+        for axis, value in self.position.items():
+            if value is not None:
+                words.append(f"{axis}{value:.4f}")
+        if self.feedrate is not None:
+            words.append(f"F{self.feedrate:g}")
+        return " ".join(words)
+
+    @classmethod
+    def fromDescription(cls, text):
+        state = cls()
+        for word in text.split():
+            if word in ("G90", "G91"):
+                state.relative = word == "G91"
+            elif word in ("M82", "M83"):
+                state.relativeE = word == "M83"
+            elif word[0] == "F":
+                state.feedrate = float(word[1:])
+            else:
+                state.position[word[0]] = float(word[1:])
+        return state
+
+
+def unrollRepeats(lines):
+    """
+    Yields the lines of a program with its M808 repeat loops (Marlin's
+    GCODE_REPEAT_MARKERS) written out, for printers and tools that
+    don't run them. "M808 L<n>" starts a block that runs n times in all
+    and a bare "M808" ends it; the markers themselves are left out.
+    Only the block being repeated is held in memory, never the copies.
+    Loops can be nested.
+    """
+    # As in Marlin's feature/repeat.cpp: "M808 L<n>" sets the marker's
+    # counter to n - 1 (add_marker), and each bare "M808" jumps back to
+    # the marker and counts down until the counter reaches 0 (loop()),
+    # so the block runs n times. L0 sets it to -1, which never runs out.
+    block, depth, count = [], 0, 0
+    for line in lines:
+        word, params, code = splitLine(line)
+        if word == "M808" and params is not None:
+            if "L" in params:
+                depth += 1
+                if depth == 1:
+                    count = int(params["L"])
+                    if count < 1:
+                        raise ValueError("Can't unroll an endless M808 loop (L0).")
+                    continue
+            elif depth:
+                depth -= 1
+                if not depth:
+                    for _ in range(count):
+                        yield from unrollRepeats(block)
+                    block = []
+                    continue
+        if depth:
+            block.append(line)
+        else:
+            yield line
+
+    if depth:
+        raise ValueError("An M808 loop is never closed.")
+
+
+def expandMacros(lines):
+    """
+    Yields the lines of a program with calls to Marlin's M810-M819
+    macros (GCODE_MACROS) replaced by the commands in them. Setting a
+    macro ("M810 G91|G0 Z5|G90") yields nothing, calling it ("M810")
+    yields "G91", "G0 Z5" and "G90".
+    """
+    macros = {}
+    for line in lines:
+        code = line.split(";", 1)[0].strip()
+        word, _, commands = code.partition(" ")
+        if word.upper() in MACROS:
+            if commands.strip():
+                macros[word.upper()] = commands.strip().split("|")
+            else:
+                yield from macros.get(word.upper(), [])
+        else:
+            yield line
+
+
+def machineTrace(lines, relative=False):
+    """
+    Runs a program on a simple model of the printer, starting in absolute
+    (or relative) mode. Returns the list of everything the printer does
+    (each move with its absolute target and feedrate, and every other
+    command that isn't only a mode or feedrate change) and the final state.
+    """
+    state = {"relative": relative, "relativeE": relative, "F": None}
+    position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+    trace = []
+
+    for line in lines:
+        word, params, code = splitLine(line)
+        if word is None:
+            continue
+        if params is None:
+            trace.append(code.strip())
+        elif word in ("G90", "G91"):
+            state["relative"] = state["relativeE"] = word == "G91"
+        elif word in ("M82", "M83"):
+            state["relativeE"] = word == "M83"
+        elif word in MOVES:
+            state["F"] = params.get("F", state["F"])
+            for axis in position:
+                if axis in params:
+                    mode = state["relativeE" if axis == "E" else "relative"]
+                    position[axis] = params[axis] + (position[axis] if mode else 0)
+            other = {k: v for k, v in params.items() if k not in "XYZEF"}
+            if params.keys() - {"F"}:
+                trace.append((word, tuple(position.values()), state["F"], other))
+        else:
+            if word == "G92":
+                position.update({k: v for k, v in params.items() if k in position})
+            trace.append((word, params))
+
+    return trace, (state, position)
+
+
+def checkEquivalent(original, optimized):
+    """
+    True if both programs (lists of lines) make the printer do exactly the
+    same things and leave it in the same state, whether the printer starts
+    out in absolute or relative mode.
+    """
+    return all(
+        machineTrace(original, relative) == machineTrace(optimized, relative)
+        for relative in (False, True)
+    )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    source = args[0]
+    destination = args[1] if len(args) > 1 else source
+
+    with open(source) as file:
+        original = splitProgram(file.read())
+
+    optimizer = modalOptimizer()
+    optimized = list(optimizer.optimize(original))
+    if not checkEquivalent(original, optimized):
+        raise Exception("Optimized program is not equivalent to the original!")
+
+    with open(destination, "w") as file:
+        file.writelines(f"{line}\n" for line in optimized)
+    print(optimizer.report())
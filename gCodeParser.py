@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+gCodeParser.py reads G-code back in. A whole program (or a large batch
+of it) is parsed at once with NumPy into columns: the command on every
+line, one array per parameter letter, and where each line and comment
+is in the file. Commands can also be read one at a time, as a generator.
+
+The tools that read G-code (motionEstimator.py, coverageAnalyzer.py)
+are built on it.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python gCodeParser.py filename.gcode
+"""
+
+import mmap
+import os
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+
+AXES = "XYZE"
+
+
+def wordCode(word):
+    """
+    The integer code parseProgram uses for a command word, ex. "G1" -> 71001.
+    """
+    return ord(word[0].upper()) * 1000 + int(word[1:])
+
+
+def wordName(code):
+    """
+    The command word for a code from wordCode, ex. 71001 -> "G1".
+    """
+    return f"{chr(code // 1000)}{code % 1000}"
+
+
+G0, G1, G2, G3 = (wordCode(f"G{n}") for n in range(4))
+G28, G90, G91, G92 = (wordCode(w) for w in ("G28", "G90", "G91", "G92"))
+M82, M83 = wordCode("M82"), wordCode("M83")
+MOVES = (G0, G1, G2, G3)
+
+
+@dataclass(frozen=True)
+class Command:
+    """
+    One line of G-code with a command on it. 'comment' is the
+    (start, end) byte span of the comment text (after the ';')
+    in the source, or None.
+    """
+
+    line: int
+    letter: str
+    number: int
+    params: dict
+    comment: tuple = None
+
+    @property
+    def word(self):
+        return f"{self.letter}{self.number}"
+
+
+@dataclass
+class ProgramColumns:
+    """
+    A parsed program (or batch of one), one entry per line:
+        words: int array, the command (see wordCode), -1 if none
+        params: {letter: float array}, NaN where a line doesn't have it
+        line_starts, line_ends: byte offsets of each line in the source
+            (line_ends is where the newline is)
+        comment_starts: byte offset of each line's ';', -1 if none
+        invalid: bool array, lines with a parameter that isn't a number
+            (its value is NaN)
+        first_line: line number of the first line
+    Offsets are from the start of the whole source, also for batches.
+    """
+
+    words: np.ndarray
+    params: dict
+    line_starts: np.ndarray
+    line_ends: np.ndarray
+    comment_starts: np.ndarray
+    invalid: np.ndarray
+    first_line: int = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def column(self, letter):
+        """
+        The values of one parameter letter (all NaN if no line has it).
+        """
+        if letter in self.params:
+            return self.params[letter]
+        return np.full(len(self.words), np.nan)
+
+    def commentSpan(self, i):
+        """
+        (start, end) byte span of line i's comment text, or None.
+        """
+        start = self.comment_starts[i]
+        return None if start < 0 else (int(start) + 1, int(self.line_ends[i]))
+
+    def __iter__(self):
+        """
+        A Command for every line that has one.
+        """
+        lines = np.flatnonzero(self.words >= 0)
+        params = [{} for _ in range(len(self.words))]
+        for letter, values in self.params.items():
+            given = np.flatnonzero(~np.isnan(values))
+            for i, value in zip(given.tolist(), values[given].tolist()):
+                params[i][letter] = value
+
+        # Plain lists: indexing NumPy arrays one line at a time is slow
+        words = self.words[lines]
+        letters = (words // 1000).tolist()
+        numbers = (words % 1000).tolist()
+        starts = self.comment_starts[lines].tolist()
+        ends = self.line_ends[lines].tolist()
+        for i, letter, number, start, end in zip(
+            lines.tolist(), letters, numbers, starts, ends
+        ):
+            yield Command(
+                self.first_line + i,
+                chr(letter),
+                number,
+                params[i],
+                None if start < 0 else (start + 1, end),
+            )
+
+
+def parseProgram(data, first_line=0, offset=0):
+    """
+    Parses a whole program at once into a ProgramColumns. 'data' is the
+    G-code as a str, bytes, or any other buffer (ex. the mmap from
+    readProgram, which isn't copied). Works on all of the bytes at once
+    with NumPy, several times faster than splitting the lines in Python
+    (see Benchmarks/gCodeParsing.py).
+
+    A line number in front of the command (N123 G1 X5*71) is read as
+    parameter N, and the checksum is skipped. first_line and offset
+    are added to the line numbers and byte offsets (see iterBatches).
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if len(data) <= _BATCH_BYTES:
+        return _parseBatch(data, first_line, offset)
+
+    # A large program is parsed a few MB at a time and the columns joined:
+    # that's faster, as the arrays for each batch stay in the cache
+    batches, line = [], first_line
+    for start, batch in _batches(data, _BATCH_BYTES):
+        batches.append(_parseBatch(batch, line, offset + start))
+        line += len(batches[-1])
+    letters = sorted(set().union(*(batch.params for batch in batches)))
+
+    def join(name):
+        return np.concatenate([getattr(batch, name) for batch in batches])
+
+    return ProgramColumns(
+        join("words"),
+        {a: np.concatenate([batch.column(a) for batch in batches]) for a in letters},
+        join("line_starts"),
+        join("line_ends"),
+        join("comment_starts"),
+        join("invalid"),
+        first_line,
+    )
+
+
+def _parseBatch(data, first_line, offset):
+    """
+    parseProgram for one batch of bytes, all at once.
+    """
+    chars = np.frombuffer(data, dtype=np.uint8)
+    size = len(chars)
+    # The newlines, and the marks: a ';' starts a comment and a '*' the
+    # checksum, both lasting until the end of the line (they're blanked
+    # out before splitting tokens). All found in one pass.
+    found = np.flatnonzero((chars == 10) | (chars == 59) | (chars == 42))
+    isNewline = chars[found] == 10
+    newlinesAt, marks = found[isNewline], found[~isNewline]
+    markLine = np.cumsum(isNewline)[~isNewline]  # Newlines before each mark
+    lines = len(newlinesAt) + int(size > 0 and chars[-1] != 10)
+    lineEnds = np.append(newlinesAt, size)[:lines]
+    lineStarts = np.concatenate(([0], newlinesAt + 1))[:lines]
+
+    first = np.ones(len(marks), dtype=bool)
+    first[1:] = markLine[1:] != markLine[:-1]
+    cuts, cutLines = marks[first], markLine[first]
+
+    # Tokens are runs of characters between whitespace and comments
+    separator = chars <= 32
+    if len(cuts):
+        bounds = np.empty(2 * len(cuts) + 2, dtype=np.int64)
+        bounds[0], bounds[-1] = 0, size
+        bounds[1:-1:2], bounds[2:-1:2] = cuts, lineEnds[cutLines]
+        blank = np.zeros(len(bounds) - 1, dtype=bool)
+        blank[1::2] = True
+        separator |= np.repeat(blank, np.diff(bounds))
+    # Where a token starts or ends (the ends of the data count as separators)
+    edge = np.empty(size + 1, dtype=bool)
+    edge[0] = edge[-1] = False
+    if size:
+        edge[0], edge[-1] = not separator[0], not separator[-1]
+        np.not_equal(separator[1:], separator[:-1], out=edge[1:-1])
+    edges = np.flatnonzero(edge)
+    starts, ends = edges[0::2], edges[1::2]
+
+    # The line of each token: how many newlines come before it
+    after = np.searchsorted(starts, newlinesAt)
+    perLine = np.diff(after, prepend=0, append=len(starts))
+    tokenLine = np.repeat(np.arange(len(perLine)), perLine)
+
+    letters = chars[starts] & 0xDF  # Upper case
+    values, bad = _parseNumbers(chars, starts + 1, ends)
+
+    isWord = np.ones(len(starts), dtype=bool)
+    isWord[1:] = tokenLine[1:] != tokenLine[:-1]
+    # A line number isn't the command, the token after it is
+    numbered = np.flatnonzero(isWord[:-1] & (letters[:-1] == ord("N")))
+    numbered = numbered[~isWord[numbered + 1]]
+    isWord[numbered], isWord[numbered + 1] = False, True
+
+    words = np.full(lines, -1, dtype=np.int64)
+    isWord, isParam = np.flatnonzero(isWord), np.flatnonzero(~isWord)
+    number = np.where(bad[isWord], 0, values[isWord]).astype(np.int64)
+    words[tokenLine[isWord]] = letters[isWord].astype(np.int64) * 1000 + number
+
+    # One column per parameter letter, all filled in with one scatter
+    paramLetters = letters[isParam]
+    used = np.zeros(256, dtype=bool)
+    used[paramLetters] = True
+    used = np.flatnonzero(used)
+    slot = np.zeros(256, dtype=np.int64)
+    slot[used] = np.arange(len(used))
+    columns = np.full((len(used), lines), np.nan)
+    at = slot[paramLetters]
+    at *= lines
+    at += tokenLine[isParam]
+    columns.reshape(-1)[at] = values[isParam]
+    params = {chr(letter): column for letter, column in zip(used.tolist(), columns)}
+
+    invalid = np.zeros(lines, dtype=bool)
+    if bad.any():
+        invalid[tokenLine[bad]] = True
+
+    # The first ';' on each line starts its comment
+    semicolons = chars[marks] == 59
+    semicolons, semicolonLine = marks[semicolons], markLine[semicolons]
+    first = np.ones(len(semicolons), dtype=bool)
+    first[1:] = semicolonLine[1:] != semicolonLine[:-1]
+    commentStarts = np.full(lines, -1, dtype=np.int64)
+    commentStarts[semicolonLine[first]] = semicolons[first] + offset
+
+    return ProgramColumns(
+        words,
+        params,
+        lineStarts + offset,
+        lineEnds + offset,
+        commentStarts,
+        invalid,
+        first_line,
+    )
+
+
+def readProgram(filename):
+    """
+    The contents of a G-code file, memory-mapped (read-only) rather than
+    read into memory. Pass it to parseProgram or iterBatches.
+    """
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iterBatches(data, batch_bytes=1 << 24):
+    """
+    Parses a program batch_bytes (split at a line end) at a time,
+    yielding a ProgramColumns for each batch, so a huge file can be read
+    without holding all of its columns in memory. Modal state (positions,
+    G90/G91, ...) isn't carried between batches.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    line = 0
+    for start, batch in _batches(data, batch_bytes):
+        batch = parseProgram(batch, line, start)
+        yield batch
+        line += len(batch)
+
+
+def _batches(data, batch_bytes):
+    """
+    (byte offset, bytes) of each batch_bytes long piece of data, split
+    after a newline. The bytes are a memoryview (not a copy).
+    """
+    if not hasattr(data, "find"):
+        data = bytes(data)
+    view = memoryview(data)
+    start = 0
+    while start < len(view):
+        stop = len(view)
+        if start + batch_bytes < stop:
+            newline = data.find(b"\n", start + batch_bytes - 1)
+            stop = stop if newline < 0 else newline + 1
+        yield start, view[start:stop]
+        start = stop
+
+
+def iterCommands(data, batch_bytes=1 << 24):
+    """
+    A Command for every line of the program that has one, in order.
+    Parses a batch at a time (see iterBatches).
+    """
+    for batch in iterBatches(data, batch_bytes):
+        yield from batch
+
+
+def _parseNumbers(chars, starts, ends):
+    """
+    Converts every chars[start:end] span to a float at once, exactly as
+    float() would. Almost every number in a program fits in 8 bytes
+    (ex. -149.5000), so each is loaded as one 64 bit word and read with
+    a few integer operations on every word at once (SIMD within a
+    register): the digits are lined up, the dot taken out, and 8 digits
+    combined in 3 multiplications. Longer spans, and anything that isn't
+    a plain decimal, go to _parseByLength. Empty spans are 0.
+    """
+    if len(chars) < 8:
+        return _parseByLength(chars, starts, ends)
+    count = len(starts)
+    values = np.empty(count)
+    odd = np.empty(count, dtype=bool)
+    # The 8 bytes ending at each span (spans ending in the first 7 bytes
+    # are read by _parseByLength)
+    words = np.ndarray((len(chars) - 7,), "<u8", chars, strides=(1,))
+    last = len(chars) - 1
+
+    for start in range(0, count, _BLOCK):
+        block = slice(start, start + _BLOCK)
+        spanStarts, spanEnds = starts[block], ends[block]
+        lengths = spanEnds - spanStarts
+        first = chars[np.minimum(spanStarts, last)]  # Only used if not empty
+        negative = (first == 45) & (lengths > 0)
+        body = lengths - (negative | (first == 43))  # Digits and the dot
+        keep = _KEEP[np.clip(body, 0, 8)]
+        # Digits as bytes 0-9 (the first digit in the lowest byte)
+        word = (words[np.maximum(spanEnds - 8, 0)] ^ _ZEROS) & keep
+        notDot = word ^ _DOTS
+        dot = (notDot - _ONES) & ~notDot & _HIGH  # 0x80 in the dot's byte
+        word ^= (dot >> _U7) * _U(0x1E)
+        bad = ((word + _NINES) | word) & _HIGH  # A byte above 9
+        bad |= dot & (dot - _U1)  # More than one dot
+        # Take the dot out, moving the digits before it up a byte
+        before = (dot >> _U7) - _U1
+        joined = (word & ~((dot << _U1) - _U1)) | ((word & before) << _U8)
+        word = np.where(dot != 0, joined, word)
+        word = word * _U(10) + (word >> _U8)
+        word = ((word & _PAIRS) * _C1 + ((word >> _U(16)) & _PAIRS) * _C2) >> _U(32)
+        decimals = ((dot >> _U7) * _PLACES) >> _U(56)
+        number = word / _FLOAT_POWERS[decimals]
+        np.negative(number, out=number, where=negative)
+        values[block] = number
+        odd[block] = (
+            ((bad != 0) | ((dot != 0) >= body)) & (lengths > 0)
+            | (body > 8)
+            | (spanEnds < 8)
+        )
+
+    invalid = np.zeros(count, dtype=bool)
+    redo = np.flatnonzero(odd)
+    if len(redo):
+        values[redo], invalid[redo] = _parseByLength(chars, starts[redo], ends[redo])
+    return values, invalid
+
+
+def _parseByLength(chars, starts, ends):
+    """
+    _parseNumbers for the spans it can't read 8 bytes at a time. Spans of
+    the same length are read together, one character position at a time,
+    into an integer mantissa (the dot read as a 0 digit, then taken out),
+    which is divided by 10**decimals. That gives exactly what float()
+    would. Spans that aren't plain decimals (ex. 1e-3) go through float()
+    one at a time, and are NaN (and flagged) if that fails too. Empty
+    spans are 0.
+    """
+    count = len(starts)
+    lengths = ends - starts
+    values = np.zeros(count)
+    invalid = lengths > 15  # Could overflow the exact range of a float
+
+    for size in np.flatnonzero(np.bincount(lengths)[1:16]) + 1:
+        group = np.flatnonzero(lengths == size)
+        at = starts[group]
+        whole = np.zeros(len(group), dtype=np.int64)
+        digits, dots, dotAt = np.zeros((3, len(group)), dtype=np.uint8)
+        for column in range(size):
+            char = chars[at + column]
+            digit = char - np.uint8(48)  # Wraps around for anything below '0'
+            isDigit = digit < 10
+            whole = whole * 10 + np.where(isDigit, digit, 0)
+            digits += isDigit
+            isDot = char == 46
+            dots += isDot
+            dotAt[isDot] = column
+
+        first = chars[at]
+        negative = first == 45
+        signed = negative | (first == 43)
+        others = size - digits.astype(np.int64) - dots - signed
+        invalid[group] = (others > 0) | (dots > 1) | (digits == 0)
+
+        # Take the 0 read for the dot back out of the mantissa
+        decimals = np.where(dots > 0, size - 1 - dotAt.astype(np.int64), 0)
+        fraction = whole % _POWERS[decimals]
+        mantissa = np.where(dots > 0, fraction + (whole - fraction) // 10, whole)
+        number = mantissa / 10.0**decimals
+        values[group] = np.where(negative, -number, number)
+
+    failed = np.zeros(count, dtype=bool)
+    for i in np.flatnonzero(invalid):
+        try:
+            values[i] = float(chars[starts[i] : ends[i]].tobytes())
+        except ValueError:
+            values[i] = np.nan
+            failed[i] = True
+    return values, failed
+
+
+_POWERS = 10 ** np.arange(16, dtype=np.int64)
+_FLOAT_POWERS = 10.0 ** np.arange(16)
+
+# Constants for _parseNumbers, repeated in every byte of a 64 bit word
+_U = np.uint64
+_U1, _U7, _U8 = _U(1), _U(7), _U(8)
+_ZEROS = _U(0x3030303030303030)  # '0'
+_DOTS = _U(0x1E1E1E1E1E1E1E1E)  # '.' ^ '0'
+_ONES = _U(0x0101010101010101)
+_HIGH = _U(0x8080808080808080)
+_NINES = _U(0x7676767676767676)  # 9 + 0x76 = 0x7F, 10 + 0x76 = 0x80
+_PAIRS = _U(0x000000FF000000FF)
+_C1 = _U(100 + (1000000 << 32))
+_C2 = _U(1 + (10000 << 32))
+_PLACES = _U(0x0706050403020100)  # Byte i holds i: decimals from the dot's byte
+# Masks keeping the last k bytes of a word (k = 0 to 8)
+_KEEP = np.array(
+    [0] + [(1 << 64) - (1 << (64 - 8 * k)) for k in range(1, 9)], dtype=np.uint64
+)
+_BLOCK = 1 << 15  # Words worked on at a time, to stay in the cache
+_BATCH_BYTES = 1 << 22  # Bytes parseProgram parses at a time
+
+
+def forwardFill(mask, values, default):
+    """
+    values[i] where mask[i], else the last such value before i (or default).
+    """
+    at = np.flatnonzero(mask)
+    if not len(at):
+        return np.full(len(mask), default)
+    # The default up to the first value, then each value up to the next one
+    counts = np.empty(len(at) + 1, dtype=np.intp)
+    counts[0], counts[-1] = at[0], len(mask) - at[-1]
+    np.subtract(at[1:], at[:-1], out=counts[1:-1])
+    return np.repeat(np.concatenate(([default], values[at])), counts)
+
+
+def commandIn(words, codes):
+    """
+    Which lines' command is one of 'codes' (see wordCode). The same as
+    np.isin(words, codes), but a lookup table, which is several times
+    faster on a whole program.
+    """
+    codes = list(codes)
+    # One more entry than needed: commands past the end land on a False
+    table = np.zeros(max(codes) + 2, dtype=bool)
+    table[codes] = True
+    return table.take(words, mode="clip")  # -1 (no command) is entry 0
+
+
+def resolvePositions(words, params):
+    """
+    The absolute X/Y/Z/E position after every line, taking G90/G91,
+    M82/M83, G92 and G28 into account, and the feedrate in effect.
+    Returns ({axis: array}, feedrate array).
+    """
+    lines = len(words)
+    nan = np.full(lines, np.nan)
+    isMove = commandIn(words, MOVES)
+
+    modeSet = commandIn(words, (G90, G91))
+    relative = forwardFill(modeSet, words == G91, False)
+    # E is only ever relative if something makes it so
+    relativeE = relative
+    makesRelativeE = (words == G91) | (words == M83)
+    if makesRelativeE.any():
+        modeSetE = modeSet | commandIn(words, (M82, M83))
+        relativeE = forwardFill(modeSetE, makesRelativeE, False)
+
+    homing = words == G28
+    if homing.any():
+        homeAll = homing & np.all([np.isnan(params.get(a, nan)) for a in "XYZ"], axis=0)
+    isG92 = words == G92
+
+    positions = {}
+    for axis in AXES:
+        value = params.get(axis, nan)
+        given = ~np.isnan(value)
+        moving = isMove & given
+        isRelative = relativeE if axis == "E" else relative
+
+        # Where the axis is set to a value: only those values are read
+        setTo = value
+        absolute = (moving & ~isRelative) | (isG92 & given)
+        if axis != "E" and homing.any():
+            homed = homing & (given | homeAll)
+            setTo = np.where(homed, 0.0, setTo)
+            absolute |= homed
+
+        # Most programs have no relative moves on an axis: nothing to add up
+        relativeMove = moving & isRelative
+        travelled = 0.0
+        if relativeMove.any():
+            travelled = np.cumsum(np.where(relativeMove, value, 0.0))
+            setTo = setTo - travelled
+        position = forwardFill(absolute, setTo, 0.0)
+        position += travelled  # Also turns -0.0 into 0.0, as it always has
+        positions[axis] = position
+
+    feedrate = params.get("F", nan)
+    hasFeedrate = isMove & ~np.isnan(feedrate)
+    return positions, forwardFill(hasFeedrate, feedrate, np.nan)
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    program = parseProgram(readProgram(args[0]))
+    words, counts = np.unique(program.words[program.words >= 0], return_counts=True)
+    print(f"{len(program)} lines, {counts.sum()} commands:")
+    for i in np.argsort(-counts, kind="stable"):
+        print(f"    {wordName(int(words[i])):<6}{counts[i]}")
+
+    invalid = np.flatnonzero(program.invalid) + 1
+    if len(invalid):
+        print(f"Lines with a parameter that isn't a number: {invalid.tolist()}")
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+motionEstimator.py estimates how long a G-code program will take to run,
+without the printer, by modelling Marlin's motion planner: trapezoidal
+velocity profiles, junction deviation at corners, per-axis max feedrates
+and accelerations (M203/M201/M204/M205), G4 dwells, and G2/G3 arcs split
+into short segments the way Marlin does.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python motionEstimator.py filename.gcode [shift_hours]
+"""
+
+import math
+import sys
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from gCodeParser import (
+    AXES,
+    G2,
+    G3,
+    G28,
+    MOVES,
+    commandIn,
+    forwardFill,
+    parseProgram,
+    readProgram,
+    resolvePositions,
+    wordCode,
+)
+from gCodeOptimizer import MACROS, expandMacros, splitProgram, unrollRepeats
+
+G4 = wordCode("G4")
+M201, M203, M204, M205 = (wordCode(w) for w in ("M201", "M203", "M204", "M205"))
+
+# Commands after which Marlin waits for every queued move to finish
+SYNC = {wordCode(w) for w in ("G4", "G28", "G29", "M0", "M1", "M400", "M600")}
+USER_WAIT = {wordCode("M0"), wordCode("M1")}
+# M808 repeat markers and M810-M819 macros, which run other lines again
+REPEATS = [wordCode(w) for w in ("M808", *sorted(MACROS))]
+
+
+@dataclass(frozen=True)
+class PlannerProfile:
+    """
+    The printer firmware's motion settings (defaults: stock Ender 3 Marlin).
+    Any M201/M203/M204/M205 in the program overrides these from that line
+    on, just like on the printer.
+    """
+
+    MAX_FEEDRATE: tuple = (500, 500, 5, 25)  # X, Y, Z, E in mm/s (M203)
+    MAX_ACCELERATION: tuple = (500, 500, 100, 5000)  # mm/s^2 (M201)
+    ACCELERATION: float = 500  # Moves that extrude (M204 P)
+    RETRACT_ACCELERATION: float = 500  # E only moves (M204 R)
+    TRAVEL_ACCELERATION: float = 500  # Moves without E (M204 T)
+    JUNCTION_DEVIATION: float = 0.013  # mm (M205 J)
+    MM_PER_ARC_SEGMENT: float = 1.0
+    HOMING_FEEDRATE: tuple = (50, 50, 4)  # X, Y, Z in mm/s
+    DEFAULT_FEEDRATE: float = 1500  # mm/min, until the program sets one
+
+
+@dataclass
+class TimeEstimate:
+    """
+    Estimated run time in seconds, split into categories: travel (linear
+    moves), scanning (G2/G3 rings and arcs), syringe (E only moves), dwell
+    (G4) and homing (G28). Waiting for the user (M0) isn't included; the
+    number of waits is counted instead.
+    """
+
+    total: float = 0.0
+    breakdown: dict = field(default_factory=dict)
+    user_waits: int = 0
+    moves: int = 0
+    segments: int = 0
+
+    def __str__(self):
+        lines = [f"Estimated time: {formatDuration(self.total)}"]
+        for category, seconds in self.breakdown.items():
+            lines.append(f"    {category:<9} {formatDuration(seconds)}")
+        if self.user_waits:
+            lines.append(f"    plus {self.user_waits} wait(s) for the user (M0)")
+        return "\n".join(lines)
+
+
+CATEGORIES = ("travel", "scanning", "syringe", "dwell", "homing")
+
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:06.3f}"
+
+
+def _settings(words, params, profile, line):
+    """
+    The planner limits in effect for every segment (on lines 'line'), as
+    plain numbers where the program never changes them. The per axis
+    limits have a row for each axis.
+    """
+    lines = len(words)
+    nan = np.full(lines, np.nan)
+    # Most programs never change them: skip the forward fills
+    present = {code: bool((words == code).any()) for code in (M201, M203, M204, M205)}
+
+    def column(code, letter, default):
+        if not present[code]:
+            return default
+        value = params.get(letter, nan)
+        return forwardFill((words == code) & ~np.isnan(value), value, default)[line]
+
+    def axisColumns(code, defaults):
+        # One row per axis (X, Y, Z, E)
+        if not present[code]:
+            return np.array(defaults, dtype=float)[:, None]
+        return np.stack([column(code, a, d) for a, d in zip(AXES, defaults)])
+
+    def lastSet(letter):
+        given = (words == M204) & ~np.isnan(params.get(letter, nan))
+        return forwardFill(given, np.arange(lines), -1)[line]
+
+    accelP = column(M204, "P", profile.ACCELERATION)
+    accelT = column(M204, "T", profile.TRAVEL_ACCELERATION)
+    if present[M204]:
+        # M204 S sets both the print and travel acceleration; the latest wins
+        accelS, setS = column(M204, "S", np.nan), lastSet("S")
+        accelP = np.where(setS > lastSet("P"), accelS, accelP)
+        accelT = np.where(setS > lastSet("T"), accelS, accelT)
+    return {
+        "max_feedrate": axisColumns(M203, profile.MAX_FEEDRATE),
+        "max_acceleration": axisColumns(M201, profile.MAX_ACCELERATION),
+        "acceleration": accelP,
+        "retract_acceleration": column(M204, "R", profile.RETRACT_ACCELERATION),
+        "travel_acceleration": accelT,
+        "junction_deviation": column(M205, "J", profile.JUNCTION_DEVIATION),
+    }
+
+
+def arcGeometry(words, params, start, end, arcs):
+    """
+    The center (cx, cy), radius, start angle and signed sweep (radians,
+    positive counterclockwise) of the G2/G3 moves on lines 'arcs', which
+    go from start[arcs] to end[arcs]. An arc back to where it started is
+    a full circle.
+    """
+    nan = np.full(len(words), np.nan)
+    s, e = start[arcs], end[arcs]
+    cx = s[:, 0] + np.nan_to_num(params.get("I", nan)[arcs])
+    cy = s[:, 1] + np.nan_to_num(params.get("J", nan)[arcs])
+    radius = np.hypot(s[:, 0] - cx, s[:, 1] - cy)
+    a0 = np.arctan2(s[:, 1] - cy, s[:, 0] - cx)
+    a1 = np.arctan2(e[:, 1] - cy, e[:, 0] - cx)
+    ccw = words[arcs] == G3
+    sweep = np.where(ccw, a1 - a0, a0 - a1) % (2 * np.pi)
+    full = np.hypot(e[:, 0] - s[:, 0], e[:, 1] - s[:, 1]) < 1e-6
+    sweep = np.where(full | (sweep == 0), 2 * np.pi, sweep)
+    return cx, cy, radius, a0, np.where(ccw, sweep, -sweep)
+
+
+def expandSegments(
+    words, params, positions, mm_per_segment=1.0, tolerance=None, min_length=None
+):
+    """
+    Every straight segment the printer moves along: one per G0/G1 and
+    several per G2/G3. Arcs are split into segments about mm_per_segment
+    long (as Marlin does), or, if a tolerance is given, into just enough
+    segments that none strays further than that from the true arc.
+    With a tolerance, 'min_length' (one per line, or one for all) keeps
+    segments at least that long, even if they then stray further.
+    Returns (line of each segment, start points, end points) with points
+    as (segments, 4) arrays of X, Y, Z, E.
+    """
+    moves = np.flatnonzero(commandIn(words, MOVES))
+    arc = commandIn(words[moves], (G2, G3))
+    if not arc.any():
+        # One segment per move, from where the line before it left off.
+        # Filled in an axis at a time (so the points are in column order).
+        points, before = np.empty((2, len(AXES), len(moves)))
+        for axis, a in enumerate(AXES):
+            positions[a].take(moves, out=points[axis])
+            positions[a].take(moves - 1, out=before[axis], mode="clip")
+        before[:, moves == 0] = 0.0
+        return moves, before.T, points.T
+
+    end = np.stack([positions[a] for a in AXES], axis=1)
+    start = np.vstack((np.zeros((1, 4)), end[:-1]))
+    arcs = moves[arc]
+
+    counts = np.ones(len(moves), dtype=np.int64)
+    if len(arcs):
+        s, e = start[arcs], end[arcs]
+        cx, cy, radius, a0, sweep = arcGeometry(words, params, start, end, arcs)
+        length = np.hypot(sweep * radius, e[:, 2] - s[:, 2])
+        if tolerance is None:
+            counts[arc] = np.maximum(1, np.floor(length / mm_per_segment))
+        else:
+            # A chord spanning angle a strays r * (1 - cos(a / 2)) from the arc
+            step = 2 * np.arccos(np.clip(1 - tolerance / radius, -1, 1))
+            needed = np.ceil(np.abs(sweep) / step)
+            if min_length is not None:
+                shortest = np.broadcast_to(min_length, words.shape)[arcs]
+                needed = np.minimum(needed, np.floor(length / shortest))
+            counts[arc] = np.maximum(1, needed)
+
+    line = np.repeat(moves, counts)
+    last = np.cumsum(counts) - 1
+    points = end[line].copy()
+    if len(arcs):
+        arcIndex = np.cumsum(arc) - 1  # Which arc each move is (if it is one)
+        first = last - counts + 1
+        inArc = np.repeat(arc, counts)
+        k = (np.arange(len(line)) - np.repeat(first, counts) + 1)[inArc]
+        which = np.repeat(arcIndex, counts)[inArc]
+        t = k / np.repeat(counts[arc], counts[arc])
+        angle = a0[which] + sweep[which] * t
+        arcPoints = np.column_stack(
+            (
+                cx[which] + radius[which] * np.cos(angle),
+                cy[which] + radius[which] * np.sin(angle),
+                s[which, 2] + (e[which, 2] - s[which, 2]) * t,
+                s[which, 3] + (e[which, 3] - s[which, 3]) * t,
+            )
+        )
+        arcPoints[k == np.repeat(counts[arc], counts[arc])] = e  # Exact end points
+        points[inArc] = arcPoints
+
+    starts = np.vstack((np.zeros((1, 4)), points[:-1]))
+    firsts = last - counts + 1
+    starts[firsts] = start[moves]
+    return line, starts, points
+
+
+def estimateTime(text, profile=PlannerProfile()):
+    """
+    Estimate how long the program 'text' (G-code as a str, bytes, or the
+    mmap from readProgram) takes to run on a printer with the given
+    PlannerProfile. Returns a TimeEstimate. M808 repeat loops are
+    counted as many times as they run, and M810-M819 macros as the
+    commands in them.
+    """
+    program = parseProgram(text)
+    if commandIn(program.words, REPEATS).any():
+        if not isinstance(text, str):
+            text = bytes(text).decode()
+        lines = expandMacros(unrollRepeats(splitProgram(text)))
+        program = parseProgram("".join([f"{line}\n" for line in lines]))
+    words, params = program.words, program.params
+    positions, feedrate = resolvePositions(words, params)
+    line, start, end = expandSegments(
+        words, params, positions, profile.MM_PER_ARC_SEGMENT
+    )
+
+    # Segment lengths and directions (E only moves are measured in E),
+    # one array per axis
+    delta = np.subtract(end.T, start.T, out=np.empty((4, len(line))))
+    length = np.sqrt(delta[0] ** 2 + delta[1] ** 2 + delta[2] ** 2)
+    eOnly = length < 1e-6
+    length = np.where(eOnly, np.abs(delta[3]), length)
+    keep = length >= 1e-6  # Marlin skips moves too short to step
+    if not keep.all():
+        line, delta = line[keep], delta[:, keep]
+        length, eOnly = length[keep], eOnly[keep]
+    unit = delta / length
+    absUnit = np.abs(unit)
+
+    settings = _settings(words, params, profile, line)
+    feedrate = feedrate[line]
+    feedrate = np.where(np.isnan(feedrate), profile.DEFAULT_FEEDRATE, feedrate)
+    with np.errstate(divide="ignore"):
+        speedLimit = (settings["max_feedrate"] / absUnit).min(axis=0)
+        accelLimit = (settings["max_acceleration"] / absUnit).min(axis=0)
+    nominal = np.maximum(np.minimum(feedrate / 60, speedLimit), 1e-3)
+    acceleration = np.where(
+        eOnly,
+        settings["retract_acceleration"],
+        np.where(
+            delta[3] != 0,
+            settings["acceleration"],
+            settings["travel_acceleration"],
+        ),
+    )
+    acceleration = np.minimum(acceleration, accelLimit)
+
+    # Highest speed (squared) through each junction, by junction deviation
+    segments = len(line)
+    junction = np.zeros(segments + 1)
+    if segments > 1:
+        cosTheta = -np.einsum("ij,ij->j", unit[:, 1:], unit[:, :-1])
+        cosTheta = np.clip(cosTheta, -0.999999, 0.999999)
+        sinHalf = np.sqrt(0.5 * (1 - cosTheta))
+        deviation = np.broadcast_to(settings["junction_deviation"], line.shape)
+        limit = acceleration[1:] * deviation[1:] * sinHalf / (1 - sinHalf)
+        limit = np.minimum(limit, np.minimum(nominal[1:], nominal[:-1]) ** 2)
+        junction[1:-1] = limit
+
+        # The planner comes to a stop at sync commands (G4, M0, M400, ...)
+        sync = commandIn(words, SYNC)
+        if sync.any():
+            syncs = np.cumsum(sync)
+            junction[1:-1][syncs[line[1:] - 1] != syncs[line[:-1]]] = 0.0
+
+    # Forward and backward passes. Speed (squared) can change by at most
+    # 2*a*d over a segment, so the entry speeds are the largest that
+    # satisfy v[i] <= min(junction[i], v[i+1] + c[i], v[i-1] + c[i-1]).
+    # Each pass is a running minimum, so no Python loop is needed.
+    change = 2 * acceleration * length
+    total = np.concatenate(([0.0], np.cumsum(change)))
+    backward = np.minimum.accumulate((junction + total)[::-1])[::-1] - total
+    entry = np.minimum.accumulate(backward - total) + total
+    entry = np.sqrt(np.maximum(entry, 0))
+
+    # Time for each trapezoid (or triangle, if it never reaches cruise)
+    v0, v1 = entry[:-1], entry[1:]
+    rampUp = (nominal**2 - v0**2) / (2 * acceleration)
+    rampDown = (nominal**2 - v1**2) / (2 * acceleration)
+    cruise = length - rampUp - rampDown
+    peak = np.sqrt(np.maximum((2 * acceleration * length + v0**2 + v1**2) / 2, 0))
+    peak = np.where(cruise >= 0, nominal, peak)
+    seconds = (peak - v0) / acceleration + (peak - v1) / acceleration
+    seconds += np.where(cruise > 0, cruise / nominal, 0)
+
+    category = np.where(commandIn(words[line], (G2, G3)), 1, np.where(eOnly, 2, 0))
+    moveTime = np.bincount(category, weights=seconds, minlength=3)
+
+    nan = np.full(len(words), np.nan)
+    dwell = words == G4
+    dwellTime = (
+        np.nan_to_num(params.get("S", nan)[dwell]).sum()
+        + np.nan_to_num(params.get("P", nan)[dwell]).sum() / 1000
+    )
+
+    homing = np.flatnonzero(words == G28)
+    homed = np.stack([positions[a][homing] for a in "XYZ"], axis=1)
+    before = np.stack([positions[a][homing - 1] for a in "XYZ"], axis=1)
+    before[homing == 0] = 0.0
+    homingTime = float((np.abs(before - homed) / profile.HOMING_FEEDRATE).sum())
+
+    times = [*moveTime.tolist(), float(dwellTime), homingTime]
+    breakdown = dict(zip(CATEGORIES, times))
+    return TimeEstimate(
+        total=sum(breakdown.values()),
+        breakdown=breakdown,
+        user_waits=int(commandIn(words, USER_WAIT).sum()),
+        moves=int(commandIn(words, MOVES).sum()),
+        segments=segments,
+    )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    estimate = estimateTime(readProgram(args[0]))
+    print(estimate)
+
+    if len(args) > 1:
+        shift = float(args[1]) * 3600
+        print(
+            f"Runs per {args[1]} hour shift (not counting user waits): "
+            f"{math.floor(shift / estimate.total) if estimate.total else 'unlimited'}"
+        )
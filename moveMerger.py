@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+moveMerger.py cleans up the moves in a program:
+    - moves to where the head already is (ex. a second G0 Z40 to the
+      travel height, or centerHead right after a move to the center)
+      are dropped,
+    - runs of G0/G1 moves along one straight line, at one feedrate,
+      become a single move.
+It follows the absolute position of every axis through the program.
+The G-code is read as written, after adjsutForOffset, so positions are
+where the head really goes. Reports how many lines it saved and how
+much sooner the program finishes according to motionEstimator.py.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python moveMerger.py input.gcode [output.gcode]
+"""
+
+import sys
+
+import numpy as np
+
+from gCodeParser import (
+    AXES,
+    G0,
+    G1,
+    G28,
+    G90,
+    G91,
+    G92,
+    M82,
+    M83,
+    MOVES,
+    forwardFill,
+    parseProgram,
+    resolvePositions,
+    wordCode,
+)
+from gCodeOptimizer import MACROS, splitProgram
+from motionEstimator import PlannerProfile, estimateTime, formatDuration
+
+TOLERANCE = 1e-4  # mm a dropped corner may be off the merged line
+# Lines after which the head could be anywhere: loop markers, macro calls
+JUMPS = tuple(wordCode(word) for word in ("M808", *sorted(MACROS)))
+
+
+class moveMerger:
+    """
+    Drops moves that go nowhere and merges straight runs of moves, and
+    keeps count for report(). Works on a whole program at once.
+    """
+
+    def __init__(self, tolerance=TOLERANCE, profile=None):
+        self.tolerance = tolerance
+        self.profile = profile or PlannerProfile()
+
+        self.dropped = 0
+        self.merged = 0  # Moves merged into the one before them
+        self.lines_in = 0
+        self.lines_out = 0
+        self.seconds_before = 0.0
+        self.seconds_after = 0.0
+
+    def mergeText(self, text):
+        """
+        Clean up a program (newline-terminated lines), returning the new one.
+        """
+        program = parseProgram(text)
+        words, params = program.words, program.params
+        positions, feedrate = resolvePositions(words, params)
+        points = np.stack([positions[a] for a in AXES], axis=1)
+        lines = splitProgram(text)
+
+        modeSet = np.isin(words, (G90, G91))
+        relative = forwardFill(modeSet, words == G91, False)
+        modeSetE = modeSet | np.isin(words, (M82, M83))
+        relativeE = forwardFill(modeSetE, (words == G91) | (words == M83), False)
+
+        nan = np.full(len(words), np.nan)
+        named = np.stack([~np.isnan(params.get(a, nan)) for a in AXES], axis=1)
+        isRelative = np.stack([relative] * 3 + [relativeE], axis=1)
+        known = self._known(program, named, isRelative)
+        before = np.vstack((np.zeros((1, 4)), points[:-1]))
+
+        # G0/G1 moves with nothing but X, Y, Z, E and F, whose named axes
+        # all started from a known position (or moved relative to it)
+        plain = np.isin(words, (G0, G1)) & ~program.invalid
+        for letter, values in params.items():
+            if letter not in "XYZEF":
+                plain &= np.isnan(values)
+        trusted = plain & np.all(~named | isRelative | known, axis=1)
+
+        drop = self._stillMoves(words, params, feedrate, trusted, points, before)
+        runs = self._straightRuns(
+            program, feedrate, relative, relativeE, trusted & ~drop, points, drop
+        )
+
+        replaced = {}
+        for rows in runs:
+            line = self._joined(lines, rows, isRelative, named)
+            replaced[rows[0]] = (rows[-1], line)
+            self.merged += len(rows) - 1
+
+        out = []
+        i = 0
+        while i < len(lines):
+            if i in replaced:
+                i, line = replaced[i]
+                out.append(line)
+            elif not drop[i]:
+                out.append(lines[i])
+            i += 1
+        self.dropped += int(drop.sum())
+
+        merged = "".join([f"{line}\n" for line in out])
+        self.lines_in += len(lines)
+        self.lines_out += len(out)
+        self.seconds_before += estimateTime(text, self.profile).total
+        self.seconds_after += estimateTime(merged, self.profile).total
+        return merged
+
+    @staticmethod
+    def _known(program, named, isRelative):
+        """
+        Whether each axis is at a known position before each line: after
+        an absolute move along it, a G92 setting it, or G28 homing it. A
+        bare G92, an M808 loop marker, a macro call or a line that isn't
+        understood forgets them all.
+        """
+        words = program.words
+        sets = named & ~isRelative & np.isin(words, MOVES)[:, None]
+        sets |= named & (words == G92)[:, None]
+        homing = words == G28
+        homeAll = homing & ~named[:, :3].any(axis=1)
+        sets[:, :3] |= (homing[:, None] & named[:, :3]) | homeAll[:, None]
+        forgets = program.invalid | np.isin(words, JUMPS)
+        forgets |= (words == G92) & ~named.any(axis=1)
+
+        known = np.zeros(named.shape, dtype=bool)
+        for axis in range(len(AXES)):
+            event = sets[:, axis] | forgets
+            state = forwardFill(event, sets[:, axis], False)
+            known[1:, axis] = state[:-1]
+        return known
+
+    @staticmethod
+    def _stillMoves(words, params, feedrate, trusted, points, before):
+        """
+        Moves that end where they start. One that changes the feedrate is
+        only dropped if the next move sets its own.
+        """
+        still = trusted & np.all(points == before, axis=1)
+
+        lines = len(words)
+        nan = np.full(lines, np.nan)
+        setsF = ~np.isnan(params.get("F", nan))
+        previous = np.concatenate(([np.nan], feedrate[:-1]))
+        changesF = setsF & (params.get("F", nan) != previous)
+
+        # Whether the next move after each line sets a feedrate
+        isMove = np.isin(words, MOVES)
+        after = np.arange(lines)[::-1]
+        nextMove = forwardFill(isMove[::-1], after, lines)[::-1]
+        nextMove = np.append(nextMove[1:], lines)
+        nextSetsF = np.append(setsF, False)[nextMove]
+
+        return still & (~changesF | nextSetsF)
+
+    def _straightRuns(
+        self, program, feedrate, relative, relativeE, usable, points, drop
+    ):
+        """
+        The lines of every run of moves along one straight line (in the
+        same direction, at the same feedrate, the same command and modes,
+        with no comment after the first). Lines left out (dropped moves,
+        and mode changes to the mode the printer is already in) don't
+        break a run, and go with it.
+        """
+        words = program.words
+        modes = np.isin(words, (G90, G91, M82, M83))
+        sameMode = np.zeros(len(words), dtype=bool)
+        sameMode[1:] = (relative[1:] == relative[:-1]) & (
+            relativeE[1:] == relativeE[:-1]
+        )
+        kept = np.flatnonzero(~(modes & sameMode) & ~drop)
+        if len(kept) < 3:
+            return
+
+        start = np.vstack((np.zeros((1, 4)), points[kept][:-1]))
+        delta = points[kept] - start
+        moving = usable[kept] & (np.abs(delta).sum(axis=1) > 0)
+
+        # Does each move carry on along the line of the one before? (Its
+        # corner is close to the line past it, and it doesn't turn back)
+        a, b = delta[:-1], delta[1:]
+        whole = a + b
+        along = (a * whole).sum(axis=1) / np.maximum((whole**2).sum(axis=1), 1e-24)
+        across = np.sqrt(((a - along[:, None] * whole) ** 2).sum(axis=1))
+        straight = ((a * b).sum(axis=1) > 0) & (across <= self.tolerance)
+
+        join = np.zeros(len(kept), dtype=bool)
+        join[1:] = (
+            moving[:-1]
+            & moving[1:]
+            & straight
+            & (words[kept][1:] == words[kept][:-1])
+            & (feedrate[kept][1:] == feedrate[kept][:-1])
+            & (relative[kept][1:] == relative[kept][:-1])
+            & (relativeE[kept][1:] == relativeE[kept][:-1])
+            & (program.comment_starts[kept][1:] < 0)
+        )
+        starts = np.flatnonzero(moving & ~join & np.append(join[1:], False))
+        for first in starts.tolist():
+            last = first
+            while last + 1 < len(kept) and join[last + 1]:
+                last += 1
+            path = np.vstack((start[first], points[kept[first : last + 1]]))
+            for low, high in self._pieces(path):
+                if high - low > 1:
+                    yield kept[first + low : first + high]
+
+    def _pieces(self, path):
+        """
+        (first, last) points splitting 'path' into pieces that each stay
+        within tolerance of the straight line between their ends, so a
+        run that bends a little at every corner doesn't add up to a big
+        bend (Douglas-Peucker, without recursion).
+        """
+        pieces, stack = [], [(0, len(path) - 1)]
+        while stack:
+            low, high = stack.pop()
+            inner = path[low + 1 : high] - path[low]
+            line = path[high] - path[low]
+            along = inner @ line / (line @ line)
+            off = np.sqrt(((inner - along[:, None] * line) ** 2).sum(axis=1))
+            if not len(off) or off.max() <= self.tolerance:
+                pieces.append((low, high))
+                continue
+            split = low + 1 + int(np.argmax(off))
+            stack += [(split, high), (low, split)]
+        return pieces
+
+    @staticmethod
+    def _joined(lines, rows, isRelative, named):
+        """
+        One move for a straight run: the first line's command, feedrate
+        and comment, going to where the last line goes.
+        """
+        tokens = [line.split(";", 1)[0].split() for line in (lines[r] for r in rows)]
+        values = [dict((t[0].upper(), t[1:]) for t in line[1:]) for line in tokens]
+        words = [tokens[0][0]]
+        for axis, letter in enumerate(AXES):
+            if not named[rows, axis].any():
+                continue
+            given = [v[letter] for v in values if letter in v]
+            if isRelative[rows[0], axis]:
+                places = max(len(g.partition(".")[2]) for g in given)
+                total = sum(float(g) for g in given)
+                words.append(f"{letter}{total:.{places}f}")
+            else:
+                words.append(f"{letter}{given[-1]}")
+        if "F" in values[0]:
+            words.append(f"F{values[0]['F']}")
+        line = " ".join(words)
+        if ";" in lines[rows[0]]:
+            line += " ;" + lines[rows[0]].split(";", 1)[1]
+        return line
+
+    def report(self):
+        saved = self.seconds_before - self.seconds_after
+        return (
+            f"Dropped {self.dropped} moves that went nowhere and merged "
+            f"{self.merged} moves into the ones before them: {self.lines_in} "
+            f"lines to {self.lines_out}. Estimated time "
+            f"{formatDuration(self.seconds_before)} to "
+            f"{formatDuration(self.seconds_after)} ({saved:.3f} s saved)."
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    source = args[0]
+    destination = args[1] if len(args) > 1 else source
+
+    with open(source) as file:
+        text = file.read()
+
+    merger = moveMerger()
+    text = merger.mergeText(text)
+    with open(destination, "w") as file:
+        file.write(text)
+    print(merger.report())
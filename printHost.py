@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+printHost.py streams G-code to a Marlin printer over USB serial, instead
+of going through Repetier Host or the SD card. Lines are sent with line
+numbers and checksums, and a few lines ahead of the printer (Marlin's
+command queue, BUFSIZE) so the printer never waits on the serial port.
+It's asyncio based, so one process can drive several scanners at once.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python printHost.py port filename.gcode [port filename.gcode ...]
+    python printHost.py port filename.gcode:LINE  (resume from a checkpoint)
+"""
+
+import asyncio
+import os
+import re
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from gCodeOptimizer import (
+    MACROS,
+    modalState,
+    splitLine,
+    splitProgram,
+    unrollRepeats,
+)
+
+try:
+    import termios
+    import tty
+except ImportError:  # Windows: ports are opened with pyserial-asyncio instead
+    termios = None
+
+BAUDRATE = 115200
+
+MOVES = {"G0", "G1", "G2", "G3"}
+ARCS = {"G2", "G3"}
+# Commands Marlin finishes every move for first, emptying the planner
+SYNC = {"G4", "G28", "M0", "M1", "M400", "M18", "M84"}
+
+_ADVANCED_OK = re.compile(r"ok N(\d+) P(\d+) B(\d+)")
+_RESEND = re.compile(r"(?:Resend:|rs)\s*N?(\d+)", re.IGNORECASE)
+_CHECKPOINT = re.compile(r";\s*CHECKPOINT (.*?) \| (.*)$")
+
+# Settings a program makes before it moves, replayed when resuming
+SETUP = {"G21", "M92", "M201", "M203", "M204", "M205", "M302"}
+
+
+def checksum(text):
+    """
+    Marlin's line checksum: every byte of the line XORed together.
+    """
+    value = 0
+    for byte in text.encode():
+        value ^= byte
+    return value
+
+
+def numberLine(number, code):
+    """
+    A line as sent to the printer, ex. numberLine(5, "G28") -> "N5 G28*22".
+    """
+    line = f"N{number} {code}"
+    return f"{line}*{checksum(line)}"
+
+
+def stripLine(line):
+    """
+    The code on a line of G-code, without the comment, or "" if none.
+    """
+    return line.split(";", 1)[0].strip()
+
+
+async def openSerial(port, baudrate=BAUDRATE):
+    """
+    (reader, writer) asyncio streams for a serial port, or the pty of a
+    simulated printer. Needs pyserial-asyncio on Windows.
+    """
+    if termios is None:
+        import serial_asyncio
+
+        return await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+
+    speed = getattr(termios, f"B{baudrate}", None)
+    if speed is None:
+        raise ValueError(f"Baud rate {baudrate} isn't supported here.")
+
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    attributes = termios.tcgetattr(fd)
+    attributes[2] |= termios.CLOCAL | termios.CREAD
+    attributes[4] = attributes[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), open(fd, "rb", buffering=0)
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, open(os.dup(fd), "wb", buffering=0)
+    )
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+@dataclass
+class Checkpoint:
+    """
+    A place a program can be resumed from (see marlinPrinter.checkpoint):
+    its label, its line number in the program (from 1), and the
+    printer's modal state there (a gCodeOptimizer.modalState).
+    """
+
+    label: str
+    line: int
+    state: modalState
+
+
+def readCheckpoint(line, number):
+    """
+    The Checkpoint on this line of G-code (line 'number' of its
+    program), or None if it isn't one.
+    """
+    match = _CHECKPOINT.search(line)
+    if match is None:
+        return None
+    return Checkpoint(
+        match.group(1), number, modalState.fromDescription(match.group(2))
+    )
+
+
+def resumeProgram(lines, checkpoint, scan=None):
+    """
+    The lines to send to carry on with a program from a checkpoint after
+    the printer stopped (a halt, a reset, a dropped connection):
+        - the settings the program made before it (units, steps per unit,
+          feedrate and acceleration limits, M810-M819 macros, ...) and its
+          homing (G28 and any G92 that set the home position right after),
+        - G92 E to tell the printer where the syringe is (E isn't homed),
+        - up to TRAVEL_HEIGHT, over to where the checkpoint was and down,
+        - the checkpoint's positioning modes and feedrate,
+        - then the rest of the program after the checkpoint.
+    'scan' is the ScanProfile the program was made with, for the travel
+    height and feedrate (default: the VPDScanner class attributes).
+    """
+    if scan is None:
+        from gCodeClass import ScanProfile, VPDScanner
+
+        scan = ScanProfile.fromAttributes(VPDScanner)
+
+    lines = list(lines)
+    setup, homing = [], ["G28 ; Home all axes"]
+    homed = False
+    for line in lines[: checkpoint.line]:
+        word, params, code = splitLine(line)
+        if word in SETUP or (word in MACROS and len(code.split()) > 1):
+            setup.append(line)  # Setting a macro, not calling it
+        elif word == "G28":
+            homing, homed = [line], True
+        elif word == "G92" and homed and params:
+            axes = " ".join(f"{a}{params[a]:.4f}" for a in "XYZ" if a in params)
+            if axes:
+                homing.append(f"G92 {axes}")
+        elif word in MOVES:
+            homed = False
+
+    state = checkpoint.state
+    position = state.position
+    travel = scan.TRAVEL_FEEDRATE
+    preamble = [f"; RESUME FROM CHECKPOINT {checkpoint.label} (line {checkpoint.line})"]
+    preamble += setup + homing + ["G90"]
+    if position["E"] is not None:
+        preamble.append(f"G92 E{position['E']:.4f}")
+    preamble.append(f"G0 Z{scan.TRAVEL_HEIGHT:.4f} F{travel / 1.6:g}")
+    xy = " ".join(f"{a}{position[a]:.4f}" for a in "XY" if position[a] is not None)
+    if xy:
+        preamble.append(f"G0 {xy} F{travel:g}")
+    if position["Z"] is not None:
+        preamble.append(f"G0 Z{position['Z']:.4f} F{travel / 1.6:g}")
+    if state.feedrate is not None:
+        preamble.append(f"G0 F{state.feedrate:g}")
+    if state.relative:
+        preamble.append("G91")
+    if state.relativeE is not None:
+        preamble.append("M83" if state.relativeE else "M82")
+    return preamble + lines[checkpoint.line :]
+
+
+@dataclass
+class _Sent:
+    number: int
+    word: str
+    size: int
+    sent_at: float
+
+
+@dataclass
+class StreamStats:
+    """
+    What happened while streaming a program:
+        lines, bytes: sent (resent lines counted again)
+        resends, errors, timeouts: resend requests, 'Error:' messages,
+            and times the printer went quiet for longer than the timeout
+        queue_empty_seconds: time the printer's command queue sat empty
+            while the host still had lines to send (the host was too slow)
+        planner_reports: oks that reported the planner (Marlin's
+            ADVANCED_OK), which the stall counts below come from
+        starved: moves after which the planner held nothing but that
+            move while the printer was moving, for "arcs" and "moves"
+        least_queued: the fewest blocks in the planner after an arc or
+            a move, while the printer was moving
+    """
+
+    lines: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    resends: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    queue_empty_seconds: float = 0.0
+    planner_reports: int = 0
+    starved: dict = field(default_factory=lambda: {"arcs": 0, "moves": 0})
+    least_queued: dict = field(default_factory=dict)
+
+    def __str__(self):
+        rate = self.lines / self.seconds if self.seconds else 0
+        lines = [
+            f"Sent {self.lines} lines ({self.bytes} bytes) in {self.seconds:.1f} s "
+            f"({rate:.0f} lines/s), {self.resends} resend(s), "
+            f"{self.errors} error(s), {self.timeouts} timeout(s)",
+            f"Command queue empty for {self.queue_empty_seconds:.3f} s",
+        ]
+        if self.planner_reports:
+            for kind, count in self.starved.items():
+                least = self.least_queued.get(kind, "-")
+                lines.append(
+                    f"Planner starved after {count} {kind} "
+                    f"(fewest blocks queued: {least})"
+                )
+        else:
+            lines.append("No planner reports (enable ADVANCED_OK in Marlin).")
+        return "\n".join(lines)
+
+
+class printHost:
+    """
+    Streams G-code to one Marlin printer:
+
+        host = await printHost.open("/dev/ttyUSB0")
+        stats = await host.stream(scanner)  # Or any lines of G-code
+        await host.close()
+
+    Every line gets a line number and checksum, and up to 'window' lines
+    (Marlin's BUFSIZE) are sent ahead without waiting for their ok, as
+    long as they fit in the printer's serial buffer (rx_buffer bytes).
+    When the printer asks for a line again (Resend:), everything from
+    that line on is sent again.
+
+    'state' is "idle", "printing", "busy" (a long command like G28),
+    "paused for user" (M0, see resume()), "halted" or "disconnected".
+    on_message(host, text) is called with every message from the printer.
+
+    'checkpoint' is the last Checkpoint of the program the printer has
+    finished (its M400 was acknowledged), so if the printer stops, the
+    program can be carried on from there with resumeProgram().
+    """
+
+    BUFSIZE = 4  # Marlin's command queue, in lines
+    RX_BUFFER_SIZE = 128  # Marlin's serial receive buffer, in bytes
+    MAX_CMD_SIZE = 96  # Longest line Marlin accepts
+    BLOCK_BUFFER_SIZE = 16  # Marlin's planner, in moves
+    HISTORY = 1024  # Sent lines kept for resends
+    RESEND_SETTLE = 0.1  # Seconds to wait for the errors of lines already sent
+    RESEND_TIMEOUT = 5.0  # Marlin says it's busy every 2 s (HOST_KEEPALIVE)
+
+    def __init__(
+        self,
+        reader,
+        writer,
+        window=None,
+        rx_buffer=None,
+        timeout=30.0,
+        on_message=None,
+        name=None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.window = window or self.BUFSIZE
+        self.rx_buffer = rx_buffer or self.RX_BUFFER_SIZE
+        self.timeout = timeout
+        self.on_message = on_message
+        self.name = name
+
+        self.state = "idle"
+        self.stats = StreamStats()
+        self.messages = []  # Since the last command()
+        self.last_error = None
+        self.checkpoint = None
+
+        self._lineNumber = -1  # The first line sent is N0 M110 N0
+        self._history = {}
+        self._checkpoints = {}  # Line number sent: Checkpoint
+        self._toSend = deque()
+        self._inFlight = deque()  # Sent, waiting for an ok
+        self._duplicates = 0  # Lines sent after one the printer asked for again
+        self._resending = False
+        self._rewoundTo = None
+        self._errorOks = 0
+        self._stopped = True  # No moves planned since the start or a SYNC
+        self._emptySince = None
+        self._started = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._readTask = asyncio.get_running_loop().create_task(self._readLoop())
+
+    @classmethod
+    async def open(cls, port, baudrate=BAUDRATE, **kwargs):
+        """
+        Opens the port and connects (see connect()).
+        """
+        reader, writer = await openSerial(port, baudrate)
+        host = cls(reader, writer, name=kwargs.pop("name", port), **kwargs)
+        await host.connect()
+        return host
+
+    async def connect(self, boot_seconds=3.0):
+        """
+        Waits for the printer to boot (most reset when the port opens) and
+        resets the line numbers.
+        """
+        try:
+            await asyncio.wait_for(self._started.wait(), boot_seconds)
+        except asyncio.TimeoutError:
+            pass  # Already running
+        self._lineNumber = -1
+        self._history.clear()
+        await self.command("M110 N0")
+
+    async def close(self):
+        self._readTask.cancel()
+        self.writer.close()
+        self.state = "disconnected"
+
+    async def stream(self, lines):
+        """
+        Sends a program and waits until the printer has taken every line.
+        'lines' is any iterable of lines of G-code, a file, or a
+        marlinPrinter/VPDScanner (not a streaming one). Returns the
+        StreamStats for this program.
+
+        Marlin only runs M808 repeat loops from the SD card, so they're
+        unrolled here (see gCodeOptimizer.unrollRepeats), and line
+        numbers (of checkpoints, too) count the lines as sent.
+        """
+        if hasattr(lines, "program"):
+            if lines.program.sink is not None:
+                raise ValueError("A streaming printer's program can't be read back.")
+            lines = lines.program.lines()
+        lines = unrollRepeats(lines)
+
+        self.stats = StreamStats()
+        self.state = "printing"
+        self.checkpoint = None
+        self._checkpoints.clear()
+        self._emptySince = None
+        started = time.perf_counter()
+        for number, line in enumerate(lines, 1):
+            code = stripLine(line)
+            if code:
+                if "CHECKPOINT" in line:
+                    checkpoint = readCheckpoint(line, number)
+                    if checkpoint is not None:
+                        self._checkpoints[self._lineNumber + 1] = checkpoint
+                await self._send(code)
+        await self._drain()
+        self.stats.seconds = time.perf_counter() - started
+        self.state = "idle"
+        return self.stats
+
+    async def command(self, code):
+        """
+        Sends one command, waits for its ok, and returns what the printer
+        said in the meantime (ex. the position for M114).
+        """
+        await self._drain()
+        self.messages = []
+        await self._send(stripLine(code))
+        await self._drain()
+        return self.messages
+
+    def resume(self):
+        """
+        Continues after an M0 (Marlin reads M108 right away, even while
+        its command queue is full).
+        """
+        self.writer.write(b"M108\n")
+
+    async def _send(self, code):
+        if len(code) + 16 > self.MAX_CMD_SIZE:
+            raise ValueError(f"Line too long for the printer: {code}")
+        self._lineNumber += 1
+        self._history[self._lineNumber] = code
+        self._history.pop(self._lineNumber - self.HISTORY, None)
+        self._toSend.append(self._lineNumber)
+        await self._pump()
+
+    async def _pump(self):
+        """
+        Sends the queued lines (and any being resent) as there's room.
+        """
+        while self._toSend:
+            number = self._toSend[0]
+            text = f"{numberLine(number, self._history[number])}\n".encode()
+            if not self._hasRoom(len(text)):
+                await self._waitForChange()
+                continue
+
+            now = time.perf_counter()
+            if self._emptySince is not None:
+                self.stats.queue_empty_seconds += now - self._emptySince
+                self._emptySince = None
+            self._toSend.popleft()
+            word = self._history[number].split(None, 1)[0].upper()
+            self._inFlight.append(_Sent(number, word, len(text), now))
+            self.writer.write(text)
+            self.stats.lines += 1
+            self.stats.bytes += len(text)
+
+    def _hasRoom(self, size):
+        if self._resending and self._duplicates:
+            return False  # Marlin would drop it with the rest of its buffer
+        if not self._inFlight:
+            return True
+        window = 1 if self._resending else self.window
+        inBuffer = sum(sent.size for sent in self._inFlight)
+        return len(self._inFlight) < window and inBuffer + size <= self.rx_buffer
+
+    async def _drain(self):
+        await self._pump()
+        while self._inFlight:
+            await self._waitForChange()
+            await self._pump()
+        self._emptySince = None
+
+    async def _waitForChange(self):
+        self._changed.clear()
+        timeout = self.timeout
+        if self._resending:
+            settling = self._duplicates > 0
+            timeout = self.RESEND_SETTLE if settling else self.RESEND_TIMEOUT
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            if self._resending and self._duplicates:
+                self._duplicates = 0  # The rest were dropped with the buffer
+            else:
+                # The printer went quiet: the oks (or the line sent again)
+                # were lost, so carry on (or send it again)
+                self.stats.timeouts += 1
+                self._inFlight.clear()
+                if self._resending:
+                    self._toSend = deque(range(self._rewoundTo, self._lineNumber + 1))
+        if self.state in ("halted", "disconnected"):
+            raise Exception(f"Printer {self.state}: {self.last_error}")
+
+    async def _readLoop(self):
+        while True:
+            raw = await self.reader.readline()
+            if not raw:
+                self.state = "disconnected"
+                self._changed.set()
+                return
+            text = raw.decode(errors="replace").strip()
+            if text:
+                self._handle(text)
+                self._changed.set()
+
+    def _handle(self, text):
+        if self.on_message is not None:
+            self.on_message(self, text)
+
+        if text.startswith("ok"):
+            self._ok(text)
+        elif text.startswith(("Resend:", "rs ")):
+            self._resend(int(_RESEND.match(text).group(1)))
+        elif text.startswith("Error:"):
+            self.stats.errors += 1
+            self.last_error = text
+            if "halted" in text or "kill" in text.lower():
+                self.state = "halted"
+        elif text.startswith("echo:busy:"):
+            self.state = "paused for user" if "paused" in text else "busy"
+        elif text == "start":
+            self._started.set()
+        else:
+            self.messages.append(text)
+
+    def _ok(self, text):
+        if self.state in ("busy", "paused for user"):
+            self.state = "printing"
+
+        if self._errorOks:
+            self._errorOks -= 1  # The ok after an error and resend request
+            return
+
+        # Lines are taken in order, so this is the oldest one sent. (The N
+        # of an ADVANCED_OK is the last line received, not this one.)
+        self._resending = False
+        if self._inFlight:
+            acked = self._inFlight.popleft()
+            if acked.number in self._checkpoints:
+                self.checkpoint = self._checkpoints.pop(acked.number)
+            advanced = _ADVANCED_OK.match(text)
+            if advanced:
+                self._plannerReport(acked, int(advanced.group(2)))
+            elif text != "ok":
+                self.messages.append(text[2:].strip())  # ex. M105's temperatures
+
+        if not self._inFlight and self.state == "printing":
+            self._emptySince = time.perf_counter()
+
+    def _plannerReport(self, acked, free):
+        self.stats.planner_reports += 1
+        if acked.word in SYNC:
+            self._stopped = True
+        if acked.word not in MOVES:
+            return  # Others (M82, G90, M117, ...) leave the planner as it is
+        stopped, self._stopped = self._stopped, False
+        if stopped:
+            return  # The printer was stopped before this move anyway
+
+        kind = "arcs" if acked.word in ARCS else "moves"
+        queued = self.BLOCK_BUFFER_SIZE - 1 - free  # Marlin keeps one block free
+        least = self.stats.least_queued.get(kind, queued)
+        self.stats.least_queued[kind] = min(least, queued)
+        if queued <= 1:
+            self.stats.starved[kind] += 1
+
+    def _resend(self, number):
+        """
+        Marlin drops the bad line and whatever else is in its serial buffer,
+        and every line that arrives after that (already on its way) gets
+        another error asking for the same line. Those don't send it again.
+        So the line is sent again once those errors are in (or the printer
+        goes quiet), then one line at a time until the printer takes one.
+        """
+        self._errorOks += 1
+        if number == self._rewoundTo and self._duplicates:
+            self._duplicates -= 1
+            return
+        if number not in self._history:
+            self.last_error = f"Printer asked for line {number}, which wasn't sent."
+            return
+
+        self.stats.resends += 1
+        dropped = [sent for sent in self._inFlight if sent.number >= number]
+        self._rewoundTo, self._duplicates = number, max(len(dropped) - 1, 0)
+        self._resending = True
+        self._inFlight = deque(s for s in self._inFlight if s.number < number)
+        self._toSend = deque(range(number, self._lineNumber + 1))
+
+
+async def streamFiles(jobs, baudrate=BAUDRATE):
+    """
+    Streams a file to each port at the same time, ex.
+    streamFiles({"/dev/ttyUSB0": "4in_Scan.gcode", ...}).
+    "4in_Scan.gcode:412" carries on from the checkpoint on line 412
+    (see resumeProgram), counting the lines of any M808 loops as they
+    were sent. Returns {port: StreamStats}.
+    """
+
+    async def run(port, job):
+        filename, _, number = job.rpartition(":")
+        if not number.isdigit():
+            filename, number = job, None
+        with open(filename) as file:
+            lines = splitProgram(file.read())
+        skipped = 0
+        if number:
+            lines = list(unrollRepeats(lines))
+            resumed = _resume(port, filename, lines, int(number))
+            skipped, lines = len(lines) - len(resumed), resumed
+
+        host = await printHost.open(port, baudrate, on_message=_printMessage)
+        try:
+            return await host.stream(lines)
+        except Exception:
+            if host.checkpoint is not None:
+                print(
+                    f"{port}: finished up to checkpoint {host.checkpoint.label!r}, "
+                    f"carry on with: {filename}:{host.checkpoint.line + skipped}"
+                )
+            raise
+        finally:
+            await host.close()
+
+    results = await asyncio.gather(*(run(p, f) for p, f in jobs.items()))
+    return dict(zip(jobs, results))
+
+
+def _resume(port, filename, lines, number):
+    """
+    The lines to carry on from the checkpoint on line 'number', and how
+    much of the program that saves.
+    """
+    from motionEstimator import estimateTime, formatDuration
+
+    checkpoint = readCheckpoint(lines[number - 1], number)
+    if checkpoint is None:
+        raise ValueError(f"There's no checkpoint on line {number} of {filename}.")
+    saved = estimateTime("\n".join(lines[:number])).total
+    total = estimateTime("\n".join(lines)).total
+    print(
+        f"{port}: resuming {filename} from checkpoint {checkpoint.label!r}, "
+        f"skipping {formatDuration(saved)} of {formatDuration(total)}"
+    )
+    return resumeProgram(lines, checkpoint)
+
+
+def _printMessage(host, text):
+    if text.startswith(("echo:busy: paused", "Error:", "//action:")):
+        print(f"{host.name}: {text}")
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+
+    jobs = dict(zip(args[0::2], args[1::2]))
+    for port, stats in asyncio.run(streamFiles(jobs)).items():
+        print(f"{port}:\n{stats}")
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+repeatFolder.py shrinks programs that do the same thing over and over
+(ex. loadSyringe, doWaferScan, unloadSyringe, a few hundred times) by
+handing the repeats to the printer's firmware:
+    - a block of lines repeated back to back becomes one copy inside an
+      M808 loop (Marlin's GCODE_REPEAT_MARKERS, SD card printing only),
+    - a short run of lines that comes up again and again elsewhere is
+      stored once in an M810-M819 macro (Marlin's GCODE_MACROS) and
+      called by name.
+Lines are compared by their command (comments don't count). Back to
+back repeats are found by comparing the program with itself shifted by
+each likely block length; lines for macros, by rolling hashes of every
+short run of lines. The folded program is then unrolled and expanded
+again and checked against the original command by command.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage (from the command line):
+    python repeatFolder.py input.gcode [output.gcode] [--no-loops] [--no-macros]
+"""
+
+import bisect
+import sys
+
+import numpy as np
+
+from gCodeOptimizer import MACROS, expandMacros, splitProgram, unrollRepeats
+
+PERIODS = 16  # Block lengths tried for loops, the most common first
+MAX_NESTING = 10  # Marlin's MAX_REPEAT_NESTING
+MACRO_SLOTS = sorted(MACROS)
+MACRO_SIZE = 50  # Marlin's GCODE_MACROS_SLOT_SIZE, characters per macro
+MACRO_LINES = 4  # Longest run of lines tried for a macro
+
+
+def _code(line):
+    return line.split(";", 1)[0].strip()
+
+
+def commandsOf(lines):
+    """
+    The commands a program runs, with its loops unrolled and its macros
+    expanded (and no comments or blank lines).
+    """
+    codes = (_code(line) for line in expandMacros(unrollRepeats(lines)))
+    return [code for code in codes if code]
+
+
+def checkFolded(original, folded):
+    """
+    True if both programs (lists of lines) run exactly the same commands.
+    Loops are unrolled the way Marlin runs them ("M808 L<n>" runs its
+    block n times, see unrollRepeats).
+    """
+    return commandsOf(original) == commandsOf(folded)
+
+
+class repeatFolder:
+    """
+    Folds the repeats in a program into M808 loops (loops=True) and
+    M810-M819 macros (macros=True), and keeps count for report().
+    """
+
+    def __init__(self, loops=True, macros=True):
+        self.loops = loops
+        self.macros = macros
+
+        self.loops_made = 0
+        self.macros_made = 0
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def foldText(self, text):
+        """
+        Fold a program (newline-terminated lines), returning the new one.
+        Raises an Exception if it wouldn't run the same commands.
+        """
+        original = splitProgram(text)
+        # Fold what it does, not how it was last folded
+        lines = list(expandMacros(unrollRepeats(original)))
+
+        if self.loops:
+            # Each pass can find loops of the loops the last one made
+            for _ in range(MAX_NESTING):
+                folded = self._foldLoops(lines, 1)
+                if len(folded) == len(lines):
+                    break
+                lines = folded
+        if self.macros:
+            lines = self._foldMacros(lines)
+
+        if not checkFolded(original, lines):
+            raise Exception("Folded program doesn't run the same commands!")
+
+        folded = "".join([f"{line}\n" for line in lines])
+        self.loops_made += int(np.diff(self._depths(lines)).clip(0).sum())
+        self.lines_in += len(original)
+        self.lines_out += len(lines)
+        self.bytes_in += len(text.encode())
+        self.bytes_out += len(folded.encode())
+        return folded
+
+    def _foldLoops(self, lines, depth):
+        """
+        Every block repeated back to back (and saving more lines than
+        its two M808 markers) as one copy in an M808 loop, biggest
+        savings first. Blocks inside loops are folded again, up to
+        MAX_NESTING deep.
+        """
+        ids = self._ids(lines)
+        depths = self._depths(lines)
+
+        chosen = []  # (start, end, period, count), sorted, not overlapping
+        for saving, start, period, count in sorted(self._repeats(ids), reverse=True):
+            end = start + period * count
+            # A block's own loops have to open and close inside it
+            inside = depths[start : start + period + 1] - depths[start]
+            if inside[-1] or inside.min() < 0:
+                continue
+            at = bisect.bisect(chosen, (start,))
+            if at and chosen[at - 1][1] > start:
+                continue
+            if at < len(chosen) and chosen[at][0] < end:
+                continue
+            chosen.insert(at, (start, end, period, count))
+
+        folded = []
+        done = 0
+        for start, end, period, count in chosen:
+            block = lines[start : start + period]
+            if depth < MAX_NESTING:
+                block = self._foldLoops(block, depth + 1)
+            folded += lines[done:start]
+            folded += [f"M808 L{count} ; Repeat x{count}"] + block + ["M808"]
+            done = end
+        return folded + lines[done:]
+
+    @staticmethod
+    def _depths(lines):
+        """
+        How many M808 loops are open before each line (and after the last).
+        """
+        steps = [0]
+        for line in lines:
+            code = _code(line).upper()
+            if code.split(" ")[0] != "M808":
+                steps.append(0)
+            else:
+                steps.append(1 if "L" in code else -1)
+        return np.cumsum(steps)
+
+    @staticmethod
+    def _ids(lines):
+        """
+        A number for every line, the same for lines with the same command.
+        """
+        numbers = {}
+        return np.array(
+            [numbers.setdefault(_code(line), len(numbers)) for line in lines],
+            dtype=np.int64,
+        )
+
+    @staticmethod
+    def _repeats(ids):
+        """
+        (lines saved, start, block length, times) for blocks repeated
+        back to back. The block lengths tried are the most common
+        distances from a line to the next line with the same command.
+        """
+        n = len(ids)
+        order = np.argsort(ids, kind="stable")
+        same = ids[order][1:] == ids[order][:-1]
+        gaps = (order[1:] - order[:-1])[same]
+        gaps = gaps[gaps <= n // 2]
+        if not len(gaps):
+            return []
+        periods, counts = np.unique(gaps, return_counts=True)
+        periods = periods[np.argsort(-counts, kind="stable")][:PERIODS]
+
+        found = []
+        for period in periods.tolist():
+            # Runs where every line matches the one a block length later
+            match = np.concatenate(([False], ids[:-period] == ids[period:], [False]))
+            edges = np.flatnonzero(match[1:] != match[:-1])
+            for start, end in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+                count = (end - start) // period + 1
+                saving = (count - 1) * period - 2
+                if count > 1 and saving > 0:
+                    found.append((saving, start, period, count))
+        return found
+
+    def _foldMacros(self, lines):
+        """
+        Up to ten runs of lines that come up most often (and save the
+        most bytes) as M810-M819 macros, set at the top of the program.
+        Loop markers, comment-only lines and anything too long for a
+        macro slot are left alone.
+        """
+        definitions = []
+        for slot in MACRO_SLOTS:
+            best = self._bestMacro(lines)
+            if best is None:
+                break
+            length, codes = best
+
+            replaced, i, calls = [], 0, 0
+            while i < len(lines):
+                if [_code(line) for line in lines[i : i + length]] == codes:
+                    replaced.append(slot)
+                    i += length
+                    calls += 1
+                else:
+                    replaced.append(lines[i])
+                    i += 1
+            definition = f"{slot} {'|'.join(codes)}"
+            saved = sum(len(line) + 1 for line in lines) - sum(
+                len(line) + 1 for line in replaced
+            )
+            if calls < 2 or saved <= len(definition) + 1:
+                break
+            lines = replaced
+            definitions.append(definition)
+            self.macros_made += 1
+
+        if definitions:
+            definitions.insert(0, "; Macros set by repeatFolder.py")
+        return definitions + lines
+
+    @staticmethod
+    def _bestMacro(lines):
+        """
+        (lines, commands) of the run of lines that would save the most
+        bytes as a macro, going by a rolling hash of every run of up to
+        MACRO_LINES lines. None if nothing is worth it.
+        """
+        codes = [_code(line) for line in lines]
+        usable = np.array(
+            [
+                bool(code)
+                and "|" not in code
+                and code.split()[0].upper() not in MACROS | {"M808"}
+                for code in codes
+            ],
+            dtype=bool,
+        )
+        ids = repeatFolder._ids(lines).astype(np.uint64)
+        sizes = np.array([len(code) for code in codes], dtype=np.int64)
+        lineBytes = np.array([len(line) + 1 for line in lines], dtype=np.int64)
+
+        best, bestSaving = None, 0
+        key = np.zeros(len(lines), dtype=np.uint64)
+        valid = np.ones(len(lines), dtype=bool)
+        size = np.full(len(lines), -1, dtype=np.int64)
+        span = np.zeros(len(lines), dtype=np.int64)
+        for length in range(1, MACRO_LINES + 1):
+            windows = len(lines) - length + 1
+            if windows < 2:
+                break
+            last = length - 1
+            # Extend each window by one line: hash, usability, size, bytes
+            with np.errstate(over="ignore"):
+                key = key[:windows] * np.uint64(1000003) + ids[last:]
+            valid = valid[:windows] & usable[last:]
+            size = size[:windows] + sizes[last:] + 1
+            span = span[:windows] + lineBytes[last:]
+
+            candidates = np.flatnonzero(valid & (size <= MACRO_SIZE))
+            if not len(candidates):
+                continue
+            keys, first, counts = np.unique(
+                key[candidates], return_index=True, return_counts=True
+            )
+            first = candidates[first]
+            saving = counts * (span[first] - len("M810\n")) - (size[first] + 6)
+            pick = int(np.argmax(saving))
+            if saving[pick] > bestSaving:
+                start = int(first[pick])
+                best = (length, codes[start : start + length])
+                bestSaving = saving[pick]
+        return best
+
+    def report(self):
+        if not self.loops_made and not self.macros_made:
+            return f"Nothing to fold in {self.lines_in} lines."
+        return (
+            f"Made {self.loops_made} M808 loop(s) and {self.macros_made} macro(s): "
+            f"{self.lines_in} lines to {self.lines_out} "
+            f"({self.lines_in / self.lines_out:.1f}x), {self.bytes_in} bytes to "
+            f"{self.bytes_out} ({self.bytes_in / self.bytes_out:.1f}x). "
+            "Runs the same commands."
+        )
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    args = sys.argv[1:]
+    loops = "--no-loops" not in args
+    macros = "--no-macros" not in args
+    args = [arg for arg in args if not arg.startswith("--")]
+    source = args[0]
+    destination = args[1] if len(args) > 1 else source
+
+    with open(source) as file:
+        text = file.read()
+
+    folder = repeatFolder(loops, macros)
+    text = folder.foldText(text)
+    with open(destination, "w") as file:
+        file.write(text)
+    print(folder.report())
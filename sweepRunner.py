@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+sweepRunner.py generates one G-code program per point of a parameter
+sweep (a grid or a Latin hypercube over the VPDScanner settings), spread
+across a process pool, and writes a JSON manifest of the results.
+
+Copyright (C) Trevor Jehl, Stanford Nanofabrication Facility
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Example (from the command line):
+    python sweepRunner.py out --grid SCAN_HEIGHT=1.0,1.5,2.0 \
+        --grid sample_volume=0.05,0.1
+    python sweepRunner.py out --lhs 1000 --seed 1 --bounds SCAN_HEIGHT=1.0:2.0 \
+        --bounds SCANNING_MOVE_FEEDRATE=60:120
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, fields, replace
+
+from gCodeClass import FRAGMENT_CACHE, MachineProfile, ScanProfile, VPDScanner
+from motionEstimator import estimateTime
+
+MACHINE_FIELDS = {field.name for field in fields(MachineProfile)}
+SCAN_FIELDS = {field.name for field in fields(ScanProfile)}
+SWEEP_FIELDS = MACHINE_FIELDS | SCAN_FIELDS | {"sample_volume"}
+
+
+def gridDesign(**axes):
+    """
+    Every combination of the given values,
+    ex. gridDesign(SCAN_HEIGHT=[1.0, 1.5], sample_volume=[0.05, 0.1])
+    gives 4 points.
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def latinHypercube(points, seed=None, **bounds):
+    """
+    A Latin hypercube design of 'points' points. Each parameter is given
+    as NAME=(low, high); its range is split into 'points' equal strata
+    and every stratum is sampled exactly once. Pass a seed to get the
+    same design every time.
+    """
+    rng = random.Random(seed)
+    columns = {}
+    for name, (low, high) in bounds.items():
+        strata = list(range(points))
+        rng.shuffle(strata)
+        columns[name] = [
+            low + (high - low) * (stratum + rng.random()) / points for stratum in strata
+        ]
+    return [{name: columns[name][i] for name in columns} for i in range(points)]
+
+
+def scanOnce(scanner):
+    """
+    The default protocol run at each sweep point.
+    """
+    scanner.loadSyringe()
+    scanner.doWaferScan()
+    scanner.unloadSyringe()
+
+
+def splitParams(params, machine, scan, sample_volume):
+    """
+    Sorts a sweep point's values into the machine profile,
+    scan profile and sample volume they belong to.
+    """
+    unknown = set(params) - SWEEP_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown sweep parameter(s): {', '.join(sorted(unknown))}")
+
+    machine = replace(
+        machine, **{k: v for k, v in params.items() if k in MACHINE_FIELDS}
+    )
+    scan = replace(scan, **{k: v for k, v in params.items() if k in SCAN_FIELDS})
+    return machine, scan, params.get("sample_volume", sample_volume)
+
+
+def _renderPoint(job):
+    """
+    Generates the program (or program segment) for one sweep point.
+    Runs in a worker process.
+    """
+    index, params, machine, scan, sample_volume, protocol, wrap, fragment_dir = job
+    if fragment_dir is not None:
+        FRAGMENT_CACHE.directory = fragment_dir
+    machine, scan, sample_volume = splitParams(params, machine, scan, sample_volume)
+
+    scanner = VPDScanner(None, sample_volume, machine=machine, scan=scan)
+    linearizer = None if scanner.ARC_SUPPORT else scanner.arcLinearizer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if wrap:
+            scanner.startGCode()
+        elif scanner.CHECKPOINTS or linearizer:
+            # The point follows the start G-code, and so does the modal state
+            scanner.startGCode()
+            if scanner.CHECKPOINTS:
+                scanner.printerState()
+            if linearizer:
+                linearizer.linearizeText(scanner.program.render())
+            scanner.commands = []
+        protocol(scanner)
+        if wrap:
+            scanner.endGCode()
+        else:
+            scanner.checkpoint(f"sweep point {index}")  # Between cycles
+
+    text = scanner.program.render()
+    if linearizer:
+        text = linearizer.linearizeText(text)
+    return index, text, _summarize(text)
+
+
+def _summarize(text):
+    return {
+        "lines": text.count("\n"),
+        "sha256": hashlib.sha256(text.encode()).hexdigest(),
+        "estimated_duration_s": round(estimateTime(text).total, 3),
+    }
+
+
+def runSweep(
+    design,
+    out_dir,
+    name="sweep",
+    protocol=scanOnce,
+    machine=None,
+    scan=None,
+    sample_volume=0.05,
+    concatenate=False,
+    workers=None,
+    fragment_dir=None,
+):
+    """
+    Generates a program for each point in 'design' (a list of dicts, see
+    gridDesign and latinHypercube) across a process pool. Names in a point
+    can be any MachineProfile/ScanProfile field or 'sample_volume'; any not
+    given come from 'machine', 'scan' and 'sample_volume'.
+
+    Each program is start G-code, protocol(scanner) (a module level
+    function, so it can be sent to the workers) and end G-code, written
+    to out_dir/name_0000.gcode etc. With concatenate=True there is instead
+    one file, out_dir/name.gcode, with the start G-code, each point's
+    protocol in order, then the end G-code. With CHECKPOINTS on in 'scan',
+    there's a checkpoint between the points, so a run can be carried on
+    from the last point done (see printHost.resumeProgram).
+
+    Every worker memoizes the blocks that repeat between points (start
+    G-code, loading the syringe, ...). Give a 'fragment_dir' to share
+    them between workers and keep them for the next sweep.
+
+    Writes out_dir/name_manifest.json and returns the manifest.
+    """
+    machine = machine or MachineProfile.fromAttributes(VPDScanner)
+    scan = scan or ScanProfile.fromAttributes(VPDScanner)
+    os.makedirs(out_dir, exist_ok=True)
+
+    jobs = [
+        (
+            i,
+            params,
+            machine,
+            scan,
+            sample_volume,
+            protocol,
+            not concatenate,
+            fragment_dir,
+        )
+        for i, params in enumerate(design)
+    ]
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+
+    started = time.perf_counter()
+    entries = []
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(_renderPoint, jobs, chunksize=chunksize)
+
+        if concatenate:
+            filename = os.path.join(out_dir, f"{name}.gcode")
+            scanner = VPDScanner(filename, sample_volume, machine=machine, scan=scan)
+            scanner.startGCode()
+            prologue = scanner.program.render()
+            scanner.commands = []
+            scanner.endGCode()
+            epilogue = scanner.program.render()
+
+            with open(filename, "w") as file:
+                file.write(prologue)
+                line = prologue.count("\n")
+                for index, text, summary in results:
+                    file.write(text)
+                    entries.append(
+                        _manifestEntry(design[index], filename, line, summary)
+                    )
+                    line += summary["lines"]
+                file.write(epilogue)
+        else:
+            for index, text, summary in results:
+                filename = os.path.join(out_dir, f"{name}_{index:04d}.gcode")
+                with open(filename, "w") as file:
+                    file.write(text)
+                entries.append(_manifestEntry(design[index], filename, 0, summary))
+
+    manifest = {
+        "name": name,
+        "machine": asdict(machine),
+        "scan": asdict(scan),
+        "sample_volume": sample_volume,
+        "concatenate": concatenate,
+        "seconds_to_generate": time.perf_counter() - started,
+        "points": entries,
+    }
+    with open(os.path.join(out_dir, f"{name}_manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2, default=float)
+    return manifest
+
+
+def _manifestEntry(params, filename, first_line, summary):
+    return {"params": params, "file": filename, "first_line": first_line, **summary}
+
+
+def _parseValue(text):
+    """
+    Keeps ints as ints, since the G-code is written differently for them.
+    Anything that isn't a number (ex. SCAN_MODE=spiral) stays a string.
+    """
+    if re.fullmatch(r"[+-]?\d+", text):
+        return int(text)
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+if __name__ == "__main__":
+    """
+    This is executed when run from the command line.
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="Generate a VPD parameter sweep.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--name", default="sweep")
+    parser.add_argument(
+        "--grid",
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="Grid values for one parameter (repeat for more parameters).",
+    )
+    parser.add_argument(
+        "--lhs",
+        type=int,
+        metavar="POINTS",
+        help="Use a Latin hypercube of this many points over the --bounds.",
+    )
+    parser.add_argument(
+        "--bounds", action="append", default=[], metavar="NAME=LOW:HIGH"
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--sample-volume", type=float, default=0.05)
+    parser.add_argument("--concatenate", action="store_true")
+    parser.add_argument(
+        "--checkpoints", action="store_true", help="Write resumable checkpoints."
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--fragment-dir", help="Where to keep memoized G-code blocks.")
+    args = parser.parse_args()
+
+    if args.lhs:
+        bounds = {}
+        for item in args.bounds:
+            key, values = item.split("=")
+            bounds[key] = tuple(float(v) for v in values.split(":"))
+        design = latinHypercube(args.lhs, seed=args.seed, **bounds)
+    else:
+        axes = {}
+        for item in args.grid:
+            key, values = item.split("=")
+            axes[key] = [_parseValue(v) for v in values.split(",")]
+        design = gridDesign(**axes)
+
+    manifest = runSweep(
+        design,
+        args.out_dir,
+        name=args.name,
+        scan=(
+            replace(ScanProfile.fromAttributes(VPDScanner), CHECKPOINTS=True)
+            if args.checkpoints
+            else None
+        ),
+        sample_volume=args.sample_volume,
+        concatenate=args.concatenate,
+        workers=args.workers,
+        fragment_dir=args.fragment_dir,
+    )
+    print(
+        f"Generated {len(manifest['points'])} programs in "
+        f"{manifest['seconds_to_generate']:.2f} s."
+    )
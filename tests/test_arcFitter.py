@@ -0,0 +1,51 @@
+"""
+Fits arcs to moves along a circle with arcFitter.py.
+"""
+
+import math
+import sys, os
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from arcFitter import arcFitter
+
+
+def circleMoves(points=60, extrude=False):
+    """
+    G1 moves along half of a circle of radius 20 around (100, 100).
+    """
+    lines = []
+    for i in range(points):
+        angle = i * math.pi / points
+        x, y = 100 + 20 * math.cos(angle), 100 + 20 * math.sin(angle)
+        e = f" E{i / 100:.4f}" if extrude else ""
+        lines.append(f"G1 X{x:.4f} Y{y:.4f}{e} F300\n")
+    return "".join(lines)
+
+
+def test_fits_one_arc():
+    text = "G90\n" + circleMoves() + "G1 X0 Y0 F300\n"
+    assert arcFitter().fitText(text) == (
+        "G90\n"
+        "G1 X120.0000 Y100.0000 F300\n"
+        "G3 X80.0274 Y101.0467 I-20.0000 J-0.0000 F300\n"
+        "G1 X0 Y0 F300\n"
+    )
+
+
+def test_form_feed_in_comment():
+    # str.splitlines() would break the comment in two, and every line
+    # after it would be matched with the wrong row of the parsed program
+    plain = "G90\n; page break\n" + circleMoves() + "G1 X0 Y0 F300\n"
+    fed = plain.replace("page break", "page \x0c break")
+    assert arcFitter().fitText(fed) == arcFitter().fitText(plain).replace(
+        "page break", "page \x0c break"
+    )
+
+
+def test_extruding_arc_has_four_decimals():
+    text = "G90\nM82\n" + circleMoves(extrude=True)
+    arc = [line for line in arcFitter().fitText(text).splitlines() if "G3" in line]
+    assert len(arc) == 1
+    e = arc[0].split(" E")[1].split()[0]
+    assert len(e.partition(".")[2]) == 4
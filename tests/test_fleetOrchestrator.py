@@ -0,0 +1,53 @@
+"""
+Runs a few scan jobs on two simulated printers, with the simulated
+operator, through fleetOrchestrator.main().
+"""
+
+import asyncio
+import sys, os
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import fleetOrchestrator
+from fleetOrchestrator import ScanJob
+
+
+def test_fleet_runs_every_job(monkeypatch):
+    # Record every step the operator is given, with the others waiting then
+    taken = []
+    waitForStep = fleetOrchestrator.fleetOrchestrator.waitForStep
+
+    async def recordStep(fleet):
+        step = await waitForStep(fleet)
+        taken.append((step, list(fleet.steps())))
+        return step
+
+    monkeypatch.setattr(fleetOrchestrator.fleetOrchestrator, "waitForStep", recordStep)
+
+    small = {"WAFER_DIAM": 50.8}
+    jobs = [
+        ScanJob("W-1", small, priority=0),
+        ScanJob("W-2", small, priority=2),
+        ScanJob("W-3", small, priority=1),
+        ScanJob("W-4", small, priority=2),
+    ]
+    # simulate=2 runs two fakeMarlins, and autoOperator does the steps
+    fleet = asyncio.run(fleetOrchestrator.main(jobs, [], simulate=2, time_scale=0.01))
+
+    # Every job finished, without errors, on one of the two printers
+    finished = sorted(r.job.wafer_id for r in fleet.results)
+    assert finished == ["W-1", "W-2", "W-3", "W-4"]
+    assert all(r.finished is not None and not r.error for r in fleet.results)
+    assert not fleet.queued
+    assert {r.printer for r in fleet.results} == {p.name for p in fleet.printers}
+
+    # Jobs were started highest priority first
+    started = sorted(fleet.results, key=lambda result: result.started)
+    priorities = [result.job.priority for result in started]
+    assert priorities == sorted(priorities, reverse=True)
+
+    # The operator always got the step after which its printer runs longest
+    assert taken
+    for step, waiting in taken:
+        assert step.runs_after == max(other.runs_after for other in waiting)
+    assert any(len(waiting) > 1 for step, waiting in taken)
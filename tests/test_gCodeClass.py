@@ -0,0 +1,30 @@
+"""
+Checks moves are written the way the single-move functions always have.
+"""
+
+import sys, os
+
+import pytest
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import marlinPrinter
+
+
+def test_axes_keep_callers_order(tmp_path):
+    printer = marlinPrinter(str(tmp_path / "order"))
+    printer.nonExtrudeMove({"Z": 5, "X": 1})
+    printer.nonExtrudeMove({"X": 1, "Z": 5}, "in order")
+    printer.extrudeMove({"E": 0.1, "X": 1, "F": 100})
+    assert list(printer.program) == [
+        "G0 Z5.0000 X-7.0000 F1250.0",
+        "G0 X-7.0000 Z5.0000 F1250.0 ;in order",
+        "M82; Set E to absolute positioning",
+        "G1 E0.1000 X-7.0000 F100.0000",
+    ]
+
+
+def test_batch_axes_in_column_order(tmp_path):
+    printer = marlinPrinter(str(tmp_path / "batch"))
+    with pytest.raises(ValueError):
+        printer.travelMoves([[5, 1]], axes="ZX")
@@ -0,0 +1,52 @@
+"""
+Drops moves that go nowhere and merges straight runs with moveMerger.py.
+"""
+
+import sys, os
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import marlinPrinter
+from moveMerger import moveMerger
+
+PROGRAM = (
+    "G90\n"
+    "; header page\n"
+    "G0 X0 Y0 F100\n"
+    "G0 X0 Y0 F100\n"
+    "G1 X1 Y0 F100\n"
+    "G1 X2 Y0 F100\n"
+    "G1 X3 Y0 F100\n"
+    "G1 X3 Y5\n"
+)
+MERGED = "G90\n; header page\nG0 X0 Y0 F100\nG1 X3 Y0 F100\nG1 X3 Y5\n"
+
+
+def test_merges_moves():
+    merger = moveMerger()
+    assert merger.mergeText(PROGRAM) == MERGED
+    assert (merger.dropped, merger.merged) == (1, 2)
+    assert merger.seconds_after <= merger.seconds_before
+
+
+def test_form_feed_in_comment():
+    # str.splitlines() would break the comment in two, and the lines
+    # would no longer match the rows of the parsed program
+    fed = PROGRAM.replace("header page", "header \x0c page")
+    assert moveMerger().mergeText(fed) == MERGED.replace(
+        "header page", "header \x0c page"
+    )
+
+
+def test_write_to_file_merged(tmp_path):
+    printer = marlinPrinter(str(tmp_path / "merged"))
+    printer.program.append("; page \x0c break")
+    for x in (0, 0, 1, 2, 3):
+        printer.nonExtrudeMove({"X": x, "Y": 0, "F": 100})
+    report = printer.writeToFile(merge=True)
+
+    with open(printer.gcodeFilename()) as file:
+        lines = file.read().split("\n")
+    assert "; page \x0c break" in lines
+    assert sum(line.startswith("G0") for line in lines) == 2
+    assert "Dropped 1 moves" in report
@@ -0,0 +1,53 @@
+"""
+Streams a short program through printHost.py to a simulated printer
+(fakeMarlin.py) that garbles some of the lines.
+"""
+
+import asyncio
+import sys, os
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeClass import marlinPrinter
+from fakeMarlin import fakeMarlin
+from printHost import printHost, stripLine
+
+
+def makeProgram():
+    printer = marlinPrinter("test")
+    printer.program.append("M302 S0")  # The fake printer is cold
+    printer.nonExtrudeMove({"Z": 5, "F": 3000})
+    for i in range(40):
+        coords = {"X": 10 + i % 7, "Y": 10 + i % 5, "E": i / 100, "F": 3000}
+        printer.extrudeMove(coords)
+    return list(printer.program.lines())
+
+
+async def streamProgram(lines):
+    async with fakeMarlin(time_scale=0.01, resend_rate=0.05, seed=1) as printer:
+        host = await printHost.open(printer.port)
+        stats = await host.stream(lines)
+        await host.close()
+    return printer, stats
+
+
+def test_stream_recovers_resends():
+    lines = makeProgram()
+    printer, stats = asyncio.run(streamProgram(lines))
+
+    sent = [stripLine(line) for line in lines if stripLine(line)]
+    assert printer.commands[1:] == sent  # After the M110 from connect()
+    # Lines were garbled, and the host sent them again
+    assert printer.stats.resends > 0
+    assert stats.resends > 0
+    assert stats.lines > len(sent)
+
+
+def test_planner_reports_between_extruding_moves():
+    # extrudeMove writes an M82 before every move. That doesn't empty the
+    # planner, so the moves after it are still measured.
+    lines = makeProgram()
+    printer, stats = asyncio.run(streamProgram(lines))
+
+    assert stats.planner_reports > 0
+    assert "moves" in stats.least_queued
@@ -0,0 +1,71 @@
+"""
+Folds repeats into M808 loops and macros with repeatFolder.py, and
+checks loops run the way Marlin runs them.
+"""
+
+import sys, os
+
+# Allow imports from parent directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gCodeOptimizer import splitLine, splitProgram, unrollRepeats
+from repeatFolder import checkFolded, commandsOf, repeatFolder
+
+TESTING = os.path.join(os.path.dirname(__file__), "..", "Testing")
+
+
+def runLikeMarlin(lines):
+    """
+    The commands run by a program with M808 loops, stepping through it
+    the way Marlin's feature/repeat.cpp does: "M808 L<n>" adds a marker
+    with its counter set to n - 1, and a bare "M808" goes back to the
+    marker, counting down, until the counter is 0.
+    """
+    ran, markers, at = [], [], 0
+    while at < len(lines):
+        word, params, code = splitLine(lines[at])
+        at += 1
+        if word != "M808":
+            if code.strip():
+                ran.append(code.strip())
+        elif "L" in params:
+            count = int(params["L"])
+            markers.append([at, count - 1 if count else -1])
+        elif markers[-1][1] == 0:
+            markers.pop()
+        else:
+            at = markers[-1][0]
+            if markers[-1][1] > 0:
+                markers[-1][1] -= 1
+    return ran
+
+
+def test_loop_count_matches_marlin():
+    program = ["G28", "M808 L3", "G1 X1", "M808 L2", "G1 Y1", "M808", "M808", "M84"]
+    ran = runLikeMarlin(program)
+    assert ran.count("G1 X1") == 3
+    assert ran.count("G1 Y1") == 6
+    assert list(unrollRepeats(program)) == ran
+
+
+def test_folds_longevity_program():
+    with open(os.path.join(TESTING, "longevityTester.gcode")) as file:
+        text = file.read()
+    original = splitProgram(text)
+
+    folder = repeatFolder(macros=False)
+    folded = splitProgram(folder.foldText(text))
+    # 50 copies of the two moves, back to back
+    assert folded[0].startswith("M808 L50")
+    assert folder.loops_made == 1
+    assert runLikeMarlin(folded) == commandsOf(original)
+
+
+def test_folds_level_scanner():
+    with open(os.path.join(TESTING, "levelScanner.gcode")) as file:
+        text = file.read()
+    original = splitProgram(text)
+
+    folder = repeatFolder()
+    folded = splitProgram(folder.foldText(text))
+    assert len(folded) < len(original)
+    assert checkFolded(original, folded)